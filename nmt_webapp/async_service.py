@@ -0,0 +1,252 @@
+"""
+asyncio front end of nmt_service, served by aiohttp (``pip install aiohttp``):
+
+    python nmt_service.py --server asyncio --request-timeout 120
+
+A request doesn't hold a server thread while its segments wait for the models: the pipeline runs on a
+dedicated executor and the handler awaits it. Each request has a deadline (`timeout` argument, at most
+`--request-timeout` seconds). When its client disconnects or its deadline passes, the request is cancelled:
+its segments still queued in the model schedulers are dropped, and its pipeline stops at the next segment.
+"""
+import asyncio
+import functools
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from cancellation import CancelScope, TranslationCancelled, CANCEL_DISCONNECTED, CANCEL_DEADLINE
+from fair_queue import PRIORITY_INTERACTIVE
+from memory_governor import MemoryBudgetExceeded
+
+logger = logging.getLogger(__name__)
+
+# threads running the pipelines of requests, they mostly wait for the model schedulers
+PIPELINE_WORKERS = 64
+# deadline of a request in seconds, a `timeout` argument may only shorten it
+REQUEST_TIMEOUT = 120
+# how often a waiting request checks whether its client is still connected
+DISCONNECT_POLL_SECONDS = 0.1
+
+CORS_HEADERS = {"Access-Control-Allow-Origin": "*"}
+# nginx's status for requests whose client closed the connection, nobody reads it
+CLIENT_CLOSED_REQUEST = 499
+
+json_dumps = functools.partial(json.dumps, ensure_ascii=False)
+
+
+def is_disconnected(request: web.Request):
+    transport = request.transport
+    return transport is None or transport.is_closing()
+
+def make_scope(request: web.Request):
+    """
+    Returns the cancel scope of a request, raises ValueError if its `timeout` isn't a number.
+    """
+    timeout = request.app["request_timeout"]
+    if "timeout" in request.query:
+        try:
+            timeout = min(float(request.query["timeout"]), timeout)
+        except ValueError:
+            raise ValueError(f"Invalid timeout {request.query['timeout']}, expected seconds")
+    return CancelScope(timeout=timeout)
+
+def get_request_flow(request: web.Request):
+    """
+    Returns the priority class and client of a request, see `nmt_service.resolve_request_flow`,
+    raises ValueError for an unknown priority.
+    """
+    return request.app["service"].resolve_request_flow(request.headers, request.remote, PRIORITY_INTERACTIVE)
+
+async def run_cancellable(request: web.Request, scope: CancelScope, fn, *args):
+    """
+    Runs `fn(*args)` on the pipeline executor and returns its result.
+    The scope is cancelled as soon as the client disconnects or the deadline passes, so that the
+    segments of the request are dropped even while the pipeline thread waits for something else.
+    """
+    future = asyncio.get_running_loop().run_in_executor(request.app["executor"], fn, *args)
+    return await wait_cancellable(request, scope, future)
+
+async def wait_cancellable(request: web.Request, scope: CancelScope, future: asyncio.Future):
+    """
+    Returns the result of `future`, running on the pipeline executor, see `run_cancellable`.
+    """
+    try:
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return future.result()
+            if is_disconnected(request):
+                scope.cancel(CANCEL_DISCONNECTED)
+            # cancels the scope once the deadline passed
+            scope.is_cancelled()
+    except asyncio.CancelledError:
+        # the handler is cancelled when aiohttp drops the connection, the pipeline then ends with
+        # TranslationCancelled which nobody awaits anymore
+        scope.cancel(CANCEL_DISCONNECTED)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        raise
+
+def too_many_requests(ex: MemoryBudgetExceeded):
+    return web.json_response({"error": str(ex)}, status=429, dumps=json_dumps,
+                             headers=dict(CORS_HEADERS, **{"Retry-After": str(ex.retry_after)}))
+
+def cancelled_response(ex: TranslationCancelled):
+    if ex.reason == CANCEL_DEADLINE:
+        return web.json_response({"error": str(ex)}, status=504, dumps=json_dumps, headers=CORS_HEADERS)
+    return web.Response(status=CLIENT_CLOSED_REQUEST)
+
+
+async def get_translation(request: web.Request):
+    """
+    Same as GET /translate of nmt_service.
+    """
+    service = request.app["service"]
+    metadata = {}
+    try:
+        src_text = request.query["text"]
+        langpair = request.query["langpair"]
+    except KeyError:
+        return web.json_response({"translation": ""}, dumps=json_dumps, headers=CORS_HEADERS)
+    # decoding policy: fast, balanced or best
+    quality = request.query.get("quality")
+    try:
+        scope = make_scope(request)
+        priority, client = get_request_flow(request)
+        if quality:
+            service.get_decoding_policy(quality)
+    except ValueError as ex:
+        return web.json_response({"error": str(ex)}, status=400, dumps=json_dumps, headers=CORS_HEADERS)
+
+    translate = functools.partial(service.translate, src_text, langpair,
+                                  replace_doi_terms=False,
+                                  merge_en_chunks=False,
+                                  translate_by_sentence=False,
+                                  max_length=512,
+                                  quality=quality,
+                                  scope=scope,
+                                  priority=priority,
+                                  client=client,
+                                  metadata=metadata)
+    try:
+        success, translated_text = await run_cancellable(request, scope, translate)
+    except MemoryBudgetExceeded as ex:
+        return too_many_requests(ex)
+    except TranslationCancelled as ex:
+        return cancelled_response(ex)
+    if not success:
+        return web.json_response({"translation": ""}, dumps=json_dumps, headers=CORS_HEADERS)
+    return web.json_response(dict({"translation": translated_text}, **metadata), dumps=json_dumps, headers=CORS_HEADERS)
+
+async def get_translation_stream(request: web.Request):
+    """
+    Same server-sent events as GET /translate/stream of nmt_service, the last event carries an `error`
+    if the deadline passed.
+    """
+    service = request.app["service"]
+    src_text = request.query.get("text", "")
+    langpair = request.query.get("langpair", "")
+    quality = request.query.get("quality")
+    try:
+        scope = make_scope(request)
+        priority, client = get_request_flow(request)
+        if quality:
+            service.get_decoding_policy(quality)
+    except ValueError as ex:
+        return web.json_response({"error": str(ex)}, status=400, dumps=json_dumps, headers=CORS_HEADERS)
+
+    # admitted before the response starts, so that a rejection can still be a 429
+    admit = functools.partial(service.admit_request, src_text, max_length=512)
+    try:
+        reservation = await asyncio.get_running_loop().run_in_executor(request.app["executor"], admit)
+    except MemoryBudgetExceeded as ex:
+        return too_many_requests(ex)
+
+    response = web.StreamResponse(headers=dict(CORS_HEADERS, **{"Content-Type": "text/event-stream",
+                                                                "Cache-Control": "no-cache"}))
+    events = service.iter_translate(src_text, langpair,
+                                    replace_doi_terms=False,
+                                    merge_en_chunks=False,
+                                    translate_by_sentence=False,
+                                    max_length=512,
+                                    quality=quality,
+                                    scope=scope,
+                                    priority=priority,
+                                    client=client)
+    segments = 0
+    finished = False
+    # the pipeline thread may still run after the handler stopped, the reservation is released after it
+    future = None
+    try:
+        await response.prepare(request)
+        while not finished:
+            try:
+                future = asyncio.get_running_loop().run_in_executor(request.app["executor"], next, events, None)
+                event = await wait_cancellable(request, scope, future)
+            except TranslationCancelled as ex:
+                service.cancelled_requests.inc(reason=ex.reason)
+                event = {"done": True, "error": str(ex)}
+            except Exception as ex:
+                service.record_request_metrics(langpair, False)
+                event = {"done": True, "error": str(ex)}
+            if event is None or event.get("done"):
+                finished = True
+                if event is not None and "error" not in event:
+                    service.record_request_metrics(langpair, True, segments, event)
+            else:
+                segments += 1
+            if event is not None:
+                await response.write(f"data: {json_dumps(event)}\n\n".encode("utf-8"))
+    except (ConnectionResetError, asyncio.CancelledError):
+        scope.cancel(CANCEL_DISCONNECTED)
+        service.cancelled_requests.inc(reason=CANCEL_DISCONNECTED)
+        raise
+    finally:
+        if not finished:
+            # the pipeline stops at its next segment, its queued segments are dropped
+            scope.cancel(CANCEL_DISCONNECTED)
+        if future is not None and not future.done():
+            future.add_done_callback(lambda f: reservation.release())
+        else:
+            reservation.release()
+    return response
+
+async def get_health(request: web.Request):
+    return web.json_response({"status": "ok"})
+
+async def get_ready(request: web.Request):
+    service = request.app["service"]
+    ready, models = service.get_readiness()
+    response = {"ready": ready, "models": models}
+    if service.startup_error is not None:
+        response["error"] = str(service.startup_error)
+    # probed by index.html when a stream fails
+    return web.json_response(response, status=200 if ready else 503, headers=CORS_HEADERS)
+
+async def get_metrics(request: web.Request):
+    service = request.app["service"]
+    service.collect_service_metrics()
+    return web.Response(body=service.METRICS.render().encode("utf-8"),
+                        headers={"Content-Type": service.METRICS_CONTENT_TYPE})
+
+
+def create_app(service, request_timeout: float = REQUEST_TIMEOUT):
+    """
+    Returns the aiohttp application of `service`, the nmt_service module as it runs:
+    it's passed in rather than imported, so that `python nmt_service.py` doesn't load it twice.
+    """
+    app = web.Application()
+    app["service"] = service
+    app["request_timeout"] = request_timeout
+    app["executor"] = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+    app.router.add_get("/translate", get_translation)
+    app.router.add_get("/translate/stream", get_translation_stream)
+    app.router.add_get("/healthz", get_health)
+    app.router.add_get("/readyz", get_ready)
+    app.router.add_get("/metrics", get_metrics)
+    return app
+
+def run_async_app(service, host: str, port: int, request_timeout: float = REQUEST_TIMEOUT):
+    logger.info(f"Serving the asyncio front end on {host}:{port}")
+    web.run_app(create_app(service, request_timeout), host=host, port=port, handler_cancellation=True)
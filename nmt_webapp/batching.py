@@ -0,0 +1,63 @@
+from typing import Callable, List
+
+# default budget of one micro-batch, measured as `batch size x longest segment`
+# so that the padded tensor stays roughly the same size whatever the lengths are
+MAX_BATCH_TOKENS = 4096
+MAX_BATCH_SIZE = 32
+
+
+def is_empty_segment(segment: str):
+    return segment.strip(" ") == ""
+
+def make_micro_batches(segments: List[str],
+                       max_batch_tokens: int = MAX_BATCH_TOKENS,
+                       max_batch_size: int = MAX_BATCH_SIZE,
+                       length_fn: Callable[[str], int] = len):
+    """
+    Groups segment indices into micro-batches of similar length.
+    Segments are sorted by length first so that each batch carries as little padding as possible,
+    a batch is closed when adding the next segment would exceed `max_batch_tokens` padded tokens
+    or `max_batch_size` segments. A segment longer than the budget gets a batch of its own.
+    """
+    lengths = [max(length_fn(s), 1) for s in segments]
+    order = sorted(range(len(segments)), key=lambda i: lengths[i])
+
+    batches = []
+    batch = []
+    for i in order:
+        # lengths are sorted ascending, so the current segment is the longest one of the batch
+        padded_tokens = (len(batch) + 1) * lengths[i]
+        if batch and (padded_tokens > max_batch_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+def translate_segments(segments: List[str],
+                       translate_fn: Callable[[List[str]], List[str]],
+                       max_batch_tokens: int = MAX_BATCH_TOKENS,
+                       max_batch_size: int = MAX_BATCH_SIZE,
+                       length_fn: Callable[[str], int] = len):
+    """
+    Translates all non-empty segments of a document with as few calls to `translate_fn` as possible
+    and returns the translations in the original order, empty segments are translated to "".
+    `max_batch_size=1` gives the former segment-by-segment behaviour.
+    """
+    translations = [""] * len(segments)
+    todo = [i for i, s in enumerate(segments) if not is_empty_segment(s)]
+    todo_segments = [segments[i] for i in todo]
+
+    for batch in make_micro_batches(todo_segments,
+                                    max_batch_tokens=max_batch_tokens,
+                                    max_batch_size=max_batch_size,
+                                    length_fn=length_fn):
+        batch_translations = translate_fn([todo_segments[j] for j in batch])
+        if len(batch_translations) != len(batch):
+            raise ValueError(f"Expected {len(batch)} translations from the model, got {len(batch_translations)}")
+        for j, translated in zip(batch, batch_translations):
+            translations[todo[j]] = translated
+
+    return translations
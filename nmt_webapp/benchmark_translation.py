@@ -0,0 +1,135 @@
+"""
+Throughput and latency benchmark of the translation pipeline over corpora and option grids.
+
+    python benchmark_translation.py --langpair zh-vi --output benchmarks/baseline.json
+    python benchmark_translation.py --split sentence,chunk64,chunk512 --merge-en off --doi-terms on,off
+
+For each combination of options it reports p50/p95/p99 document latency, time to the first paragraph,
+segments/s, source chars/s and the time spent in each stage of `nmt_service.iter_translate`.
+The translation memory is disabled unless `--translation-memory` is given, so that repeated runs measure the models.
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import nmt_service
+from nmt_service import init_nemo, init_nmt_multi, init_en2vi, iter_translate, PIPELINE_STAGES
+from translation_memory import TranslationMemory
+
+# option values of the grid, "sentence" splits by sentence and quotation, "chunkN" in chunks of N characters
+SPLIT_OPTIONS = ["sentence", "chunk64", "chunk512"]
+ON_OFF = {"on": True, "off": False}
+
+
+def parse_split(split: str):
+    """
+    Returns the `translate_by_sentence` and `max_length` arguments of a split option.
+    """
+    if split == "sentence":
+        return True, 64
+    if split.startswith("chunk") and split[len("chunk"):].isdigit():
+        return False, int(split[len("chunk"):])
+    raise ValueError(f"Unknown split option {split}, expected sentence or chunkN")
+
+def translate_timed(document: str, langpair: str, options: dict):
+    """
+    Translates a document and returns its timings and number of translated segments.
+    """
+    segments = 0
+    for event in iter_translate(document, langpair, **options):
+        if event.get("done"):
+            return {"timings": event["timings"], "segments": segments, "chars": len(document)}
+        segments += 1
+
+def run_config(documents: list, langpair: str, options: dict, concurrency: int, repeat: int):
+    records = []
+    time_s = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(repeat):
+            records.extend(executor.map(lambda document: translate_timed(document, langpair, options), documents))
+    wall_seconds = time.time() - time_s
+
+    latencies = [r["timings"]["total"] for r in records]
+    first_paragraph = [r["timings"]["first_paragraph"] for r in records]
+    stages = {stage: sum(r["timings"]["stages"][stage] for r in records) for stage in PIPELINE_STAGES}
+    stages_total = sum(stages.values()) or 1
+    return {
+        "documents": len(records),
+        "wall_seconds": wall_seconds,
+        "latency": {f"p{q}": float(np.percentile(latencies, q)) for q in (50, 95, 99)},
+        "first_paragraph": {f"p{q}": float(np.percentile(first_paragraph, q)) for q in (50, 95, 99)},
+        "segments_per_second": sum(r["segments"] for r in records) / wall_seconds,
+        "chars_per_second": sum(r["chars"] for r in records) / wall_seconds,
+        "stages": {stage: {"seconds": seconds, "share": seconds / stages_total} for stage, seconds in stages.items()},
+    }
+
+def run_benchmark(corpora: dict, langpair: str, splits: list, merge_en: list, doi_terms: list,
+                  concurrency: int = 1, repeat: int = 1, quality: str = None):
+    results = []
+    for corpus_name, documents in corpora.items():
+        for split, merge_en_chunks, replace_doi_terms in itertools.product(splits, merge_en, doi_terms):
+            translate_by_sentence, max_length = parse_split(split)
+            options = {
+                "merge_en_chunks": merge_en_chunks,
+                "replace_doi_terms": replace_doi_terms,
+                "translate_by_sentence": translate_by_sentence,
+                "max_length": max_length,
+                "quality": quality,
+            }
+            # one untimed document, the first calls of a model are slower
+            translate_timed(documents[0], langpair, options)
+
+            result = run_config(documents, langpair, options, concurrency, repeat)
+            result.update({"corpus": corpus_name, "split": split, "merge_en": merge_en_chunks, "doi_terms": replace_doi_terms})
+            results.append(result)
+            print_result(result)
+    return results
+
+def print_result(result: dict):
+    stages = ", ".join(f"{stage} {s['share']:.0%}" for stage, s in result["stages"].items() if s["seconds"] > 0)
+    print (f"{result['corpus']} split={result['split']} merge_en={result['merge_en']} doi_terms={result['doi_terms']}: "
+           f"p50 {result['latency']['p50']:.2f}s, p95 {result['latency']['p95']:.2f}s, p99 {result['latency']['p99']:.2f}s, "
+           f"{result['segments_per_second']:.1f} segments/s, {result['chars_per_second']:.0f} chars/s\n"
+           f"    stages: {stages}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the translation pipeline")
+    parser.add_argument("--corpus", nargs="+", default=["tests/t5_zh_test.json"], help="json arrays of documents")
+    parser.add_argument("--langpair", default="zh-vi")
+    parser.add_argument("--split", default="sentence,chunk512", help=f"comma separated, e.g. {','.join(SPLIT_OPTIONS)}")
+    parser.add_argument("--merge-en", default="on,off", help="comma separated on/off")
+    parser.add_argument("--doi-terms", default="on,off", help="comma separated on/off")
+    parser.add_argument("--quality", default=None, help="decoding policy: fast, balanced or best")
+    parser.add_argument("--concurrency", type=int, default=1, help="documents translated at once")
+    parser.add_argument("--repeat", type=int, default=1, help="passes over each corpus")
+    parser.add_argument("--translation-memory", action="store_true", help="keep the translation memory on")
+    parser.add_argument("--output", default=None, help="write the results to this json file")
+    args = parser.parse_args()
+
+    init_nemo('config.json')
+    init_nmt_multi()
+    init_en2vi()
+    if not args.translation_memory:
+        nmt_service.translation_memory = TranslationMemory(max_entries=0)
+
+    corpora = {os.path.basename(path): json.load(open(path)) for path in args.corpus}
+    results = run_benchmark(corpora, args.langpair,
+                            splits=args.split.split(","),
+                            merge_en=[ON_OFF[v] for v in args.merge_en.split(",")],
+                            doi_terms=[ON_OFF[v] for v in args.doi_terms.split(",")],
+                            concurrency=args.concurrency,
+                            repeat=args.repeat,
+                            quality=args.quality)
+
+    if args.output:
+        if os.path.dirname(args.output):
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"langpair": args.langpair, "concurrency": args.concurrency, "repeat": args.repeat,
+                       "created": time.time(), "results": results}, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,75 @@
+import threading
+import time
+from concurrent.futures import CancelledError, Future, TimeoutError
+from typing import List
+
+# reasons of a cancellation
+CANCEL_DISCONNECTED = "disconnected"
+CANCEL_DEADLINE = "deadline"
+
+
+class TranslationCancelled(Exception):
+    def __init__(self, reason: str):
+        super().__init__(f"Translation cancelled: {reason}")
+        self.reason = reason
+
+
+class CancelScope:
+    """
+    Cancellation of one request, because its client is gone (`cancel()`) or its deadline passed.
+    Futures of segments queued in the model schedulers are tracked, cancelling the scope cancels
+    those not yet in a batch so that schedulers drop them. The pipeline checks the scope
+    between segments and batches with `check()` and waits for segments with `result()`.
+    """
+    def __init__(self, timeout: float = None):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.reason = None
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def track(self, futures: List[Future]):
+        with self.lock:
+            cancelled = self.reason is not None
+            if not cancelled:
+                self.futures.extend(f for f in futures if f is not None)
+        if cancelled:
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+
+    def cancel(self, reason: str = CANCEL_DISCONNECTED):
+        with self.lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            futures, self.futures = self.futures, []
+        for future in futures:
+            future.cancel()
+
+    def is_cancelled(self):
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel(CANCEL_DEADLINE)
+        return self.reason is not None
+
+    def check(self):
+        """
+        Raises TranslationCancelled if the request was cancelled or its deadline passed.
+        """
+        if self.is_cancelled():
+            raise TranslationCancelled(self.reason)
+
+    def result(self, future: Future):
+        """
+        Waits for a segment's translation until the deadline, raises TranslationCancelled if the request
+        is cancelled in the meantime.
+        """
+        self.check()
+        try:
+            if self.deadline is None:
+                return future.result()
+            return future.result(timeout=max(self.deadline - time.monotonic(), 0))
+        except CancelledError:
+            raise TranslationCancelled(self.reason or CANCEL_DISCONNECTED)
+        except TimeoutError:
+            self.cancel(CANCEL_DEADLINE)
+            raise TranslationCancelled(self.reason)
@@ -0,0 +1,122 @@
+"""
+Compares the precisions of a model on tests/t5_zh_test.json: translation time, memory of the loaded
+model and BLEU/chrF drift of each precision against the fp32 translations.
+
+    python compare_precision.py --model zh-en
+    python compare_precision.py --model en2vi --precisions fp32,int8-dynamic
+    python compare_precision.py --model seamless --source-lang km --test-file <km documents json>
+
+The en2vi model is fed with the fp32 zh-en translations of the test documents.
+Set the chosen precision as "precision" of the model's entry in config.json.
+"""
+import argparse
+import json
+import time
+
+import sacrebleu
+
+import nmt_service
+from nmt_service import init_nemo, load_model, split_source_text
+from batching import translate_segments, is_empty_segment
+from model_config import get_model_settings, is_nemo_model_key, SEAMLESS_MODEL_KEY, EN2VI_MODEL_KEY
+from model_registry import model_memory
+from precision import PRECISIONS
+
+
+def get_source_segments(docs: list, model_key: str, src_lang: str, max_length: int):
+    """
+    Returns the non-empty source segments of the test documents for a model, src->en models
+    get the split source text and en2vi gets its fp32 zh-en translation.
+    """
+    doc_lang = "zh" if model_key == EN2VI_MODEL_KEY else src_lang
+    segments = []
+    for doc in docs:
+        paragraphs, _ = split_source_text(doc, doc_lang, translate_by_sentence=False, max_length=max_length)
+        segments.extend(p for p in paragraphs if not is_empty_segment(p))
+
+    if model_key == EN2VI_MODEL_KEY:
+        zh_en = load_model("zh-en")
+        segments = translate_segments(segments, lambda batch: zh_en.translate(batch, source_lang="zh", target_lang="en"))
+        del zh_en
+    return segments
+
+def run_precision(model_key: str, precision: str, segments: list, src_lang: str, tgt_lang: str):
+    settings = dict(get_model_settings(nmt_service.MODELS_CONFIG, model_key))
+    settings["precision"] = precision
+    nmt_service.MODELS_CONFIG[model_key] = settings
+
+    time_s = time.time()
+    model = load_model(model_key)
+    load_seconds = time.time() - time_s
+
+    mt_translate = lambda batch: model.translate(batch, source_lang=src_lang, target_lang=tgt_lang)
+    # one warm-up batch, the first calls are slower
+    mt_translate(segments[:1])
+
+    time_s = time.time()
+    translations = translate_segments(segments, mt_translate,
+                                      max_batch_tokens=settings["max_batch_tokens"],
+                                      max_batch_size=settings["max_batch_size"])
+    translate_seconds = time.time() - time_s
+
+    return {
+        "precision": precision,
+        "load_seconds": load_seconds,
+        "translate_seconds": translate_seconds,
+        "memory": sum(model_memory(model).values()),
+        "translations": translations,
+    }
+
+def compare_precisions(model_key: str, precisions: list, docs: list, max_length: int, seamless_lang: str = "km"):
+    if model_key == EN2VI_MODEL_KEY:
+        src_lang, tgt_lang = "en", "vi"
+    elif model_key == SEAMLESS_MODEL_KEY:
+        src_lang, tgt_lang = seamless_lang, "en"
+    else:
+        src_lang, tgt_lang = model_key.split("-")
+    segments = get_source_segments(docs, model_key, src_lang, max_length)
+
+    # fp32 translations are the reference of the drift
+    results = [run_precision(model_key, precision, segments, src_lang, tgt_lang)
+               for precision in ["fp32"] + [p for p in precisions if p != "fp32"]]
+    reference = results[0]
+    for result in results:
+        result["speedup"] = reference["translate_seconds"] / result["translate_seconds"]
+        result["memory_reduction"] = 1 - result["memory"] / reference["memory"]
+        result["bleu"] = sacrebleu.corpus_bleu(result["translations"], [reference["translations"]]).score
+        result["chrf"] = sacrebleu.corpus_chrf(result["translations"], [reference["translations"]]).score
+        result["changed_segments"] = sum(t != r for t, r in zip(result["translations"], reference["translations"]))
+    return segments, results
+
+def print_report(model_key: str, segments: list, results: list):
+    print (f"{model_key}: {len(segments)} segments, BLEU/chrF against the fp32 translations")
+    print (f"{'precision':<14}{'load s':>8}{'translate s':>13}{'speed-up':>10}{'memory MB':>11}{'reduction':>11}{'BLEU':>8}{'chrF':>8}{'changed':>9}")
+    for r in results:
+        print (f"{r['precision']:<14}{r['load_seconds']:>8.1f}{r['translate_seconds']:>13.2f}{r['speedup']:>9.2f}x"
+               f"{r['memory'] / 1e6:>11.1f}{r['memory_reduction']:>10.1%}{r['bleu']:>8.2f}{r['chrf']:>8.2f}{r['changed_segments']:>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare inference precisions of a model")
+    parser.add_argument("--model", default="zh-en",
+                        help=f"model key of config.json: a NeMo langpair, {SEAMLESS_MODEL_KEY} or {EN2VI_MODEL_KEY}")
+    parser.add_argument("--precisions", default=",".join(PRECISIONS),
+                        help="comma separated precisions to compare with fp32")
+    parser.add_argument("--source-lang", default="km", help=f"source language of the test documents for {SEAMLESS_MODEL_KEY}")
+    parser.add_argument("--test-file", default="tests/t5_zh_test.json")
+    parser.add_argument("--max-length", type=int, default=512)
+    parser.add_argument("--output", default=None, help="also write the results and translations to this json file")
+    args = parser.parse_args()
+
+    init_nemo('config.json')
+    if is_nemo_model_key(args.model) and args.model not in nmt_service.MODELS_CONFIG:
+        raise ValueError(f"{args.model} is not in config.json")
+
+    docs = json.load(open(args.test_file))
+    segments, results = compare_precisions(args.model, args.precisions.split(","), docs, args.max_length,
+                                          seamless_lang=args.source_lang)
+    print_report(args.model, segments, results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"model": args.model, "segments": segments, "results": results}, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,43 @@
+import math
+
+# per-request `quality` argument and per-model "quality" setting in config.json,
+# without one a model decodes as it was shipped
+QUALITY_FAST = "fast"
+QUALITY_BALANCED = "balanced"
+QUALITY_BEST = "best"
+
+
+class DecodingPolicy:
+    """
+    How a model decodes a batch: beam size and a maximum output length
+    of `max_length_ratio x source tokens + max_length_offset` tokens, which bounds
+    runaway generations on noisy input.
+    `num_beams=1` is greedy decoding, the fast path for interactive traffic.
+    """
+    def __init__(self, name: str, num_beams: int, max_length_ratio: float, max_length_offset: int):
+        self.name = name
+        self.num_beams = num_beams
+        self.max_length_ratio = max_length_ratio
+        self.max_length_offset = max_length_offset
+
+    def max_new_tokens(self, num_source_tokens: int):
+        return math.ceil(self.max_length_ratio * num_source_tokens) + self.max_length_offset
+
+    def __repr__(self):
+        return (f"DecodingPolicy({self.name}, num_beams={self.num_beams}, "
+                f"max_length={self.max_length_ratio}x+{self.max_length_offset})")
+
+
+DECODING_POLICIES = {
+    QUALITY_FAST: DecodingPolicy(QUALITY_FAST, num_beams=1, max_length_ratio=1.5, max_length_offset=10),
+    QUALITY_BALANCED: DecodingPolicy(QUALITY_BALANCED, num_beams=3, max_length_ratio=2.0, max_length_offset=10),
+    QUALITY_BEST: DecodingPolicy(QUALITY_BEST, num_beams=5, max_length_ratio=2.0, max_length_offset=20),
+}
+
+def get_decoding_policy(quality: str):
+    """
+    Returns the decoding policy of a quality name, raises ValueError if there's no such policy.
+    """
+    if quality not in DECODING_POLICIES:
+        raise ValueError(f"Unknown quality {quality}, expected one of {list(DECODING_POLICIES)}")
+    return DECODING_POLICIES[quality]
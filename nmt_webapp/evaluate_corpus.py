@@ -0,0 +1,137 @@
+"""
+Evaluates translation quality on a random sample of a parallel corpus, without loading the corpus.
+
+    python evaluate_corpus.py data/train.merged_data.km data/train.merged_data.en --langpair km-en --sample 1000
+    python evaluate_corpus.py corpus.zh corpus.vi --langpair zh-vi --sample 5000 --quality fast --output zh-vi.jsonl
+
+The sample is drawn by reservoir sampling in a single pass over the paired files, line by line.
+It's translated in batches through the pipeline of nmt_service, so any model of config.json can be evaluated
+by its language pair, and each batch is written to the output (one json record per line) as soon as it's done.
+Corpus BLEU and chrF are computed by worker processes while the next batches are translated: each batch gives
+the sufficient statistics of sacrebleu, which add up to the statistics of the whole sample.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sacrebleu.metrics import BLEU, CHRF
+
+from translate_corpus import init_worker, translate_chunk
+
+
+def reservoir_sample(source_path: str, target_path: str, sample_size: int, seed: int = 0):
+    """
+    Returns `sample_size` random (line number, source, target) of paired files in line order,
+    reading both files once, line by line (algorithm R).
+    Raises ValueError if the files don't have the same number of lines.
+    """
+    rng = random.Random(seed)
+    sample = []
+    with open(source_path, encoding="utf-8") as src_file, open(target_path, encoding="utf-8") as tgt_file:
+        for i, (src, tgt) in enumerate(itertools.zip_longest(src_file, tgt_file)):
+            if src is None or tgt is None:
+                raise ValueError(f"{source_path} and {target_path} don't have the same number of lines")
+            if i < sample_size:
+                sample.append((i, src.rstrip("\r\n"), tgt.rstrip("\r\n")))
+            else:
+                j = rng.randint(0, i)
+                if j < sample_size:
+                    sample[j] = (i, src.rstrip("\r\n"), tgt.rstrip("\r\n"))
+    return sorted(sample)
+
+def get_metrics(target_lang: str):
+    # sacrebleu's default tokenization doesn't split chinese
+    return BLEU(tokenize="zh" if target_lang == "zh" else "13a"), CHRF()
+
+def corpus_statistics(hypotheses: list, references: list, target_lang: str):
+    """
+    Returns the BLEU and chrF statistics of a batch, summed over its segments.
+    Statistics of batches add up, the corpus scores are computed once from their sum.
+    """
+    bleu, chrf = get_metrics(target_lang)
+    bleu_stats = np.sum(bleu._extract_corpus_statistics(hypotheses, [references]), axis=0)
+    chrf_stats = np.sum(chrf._extract_corpus_statistics(hypotheses, [references]), axis=0)
+    return bleu_stats.tolist(), chrf_stats.tolist()
+
+def evaluate_sample(sample: list, langpair: str, options: dict, output_path: str,
+                    batch_size: int = 64, score_workers: int = 2):
+    """
+    Translates the sample in batches, writes {"line", "source", "reference", "translation"} records
+    to `output_path` batch by batch and returns the corpus BLEU and chrF scores.
+    """
+    target_lang = langpair.split("-")[1]
+    stats_futures = []
+    errors = 0
+    time_s = time.time()
+    with open(output_path, "w", encoding="utf-8") as output, \
+            ProcessPoolExecutor(max_workers=score_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for start in range(0, len(sample), batch_size):
+            batch = sample[start:start + batch_size]
+            translations = translate_chunk([src for _, src, _ in batch], langpair, options)
+            errors += sum(translated is None for translated in translations)
+            translations = [translated or "" for translated in translations]
+
+            for (line, src, ref), translated in zip(batch, translations):
+                output.write(json.dumps({"line": line, "source": src, "reference": ref, "translation": translated},
+                                        ensure_ascii=False) + "\n")
+            output.flush()
+
+            # scored in the background while the next batch is translated
+            stats_futures.append(executor.submit(corpus_statistics, translations, [ref for _, _, ref in batch], target_lang))
+            done = start + len(batch)
+            print (f"{done}/{len(sample)} lines translated, {done / (time.time() - time_s):.1f} lines/s, {errors} errors")
+
+        stats = [future.result() for future in stats_futures]
+
+    bleu, chrf = get_metrics(target_lang)
+    bleu_score = bleu._compute_score_from_stats(np.sum([s[0] for s in stats], axis=0).tolist())
+    chrf_score = chrf._compute_score_from_stats(np.sum([s[1] for s in stats], axis=0).tolist())
+    return {
+        "langpair": langpair,
+        "lines": len(sample),
+        "errors": errors,
+        "seconds": time.time() - time_s,
+        "bleu": bleu_score.score,
+        "chrf": chrf_score.score,
+        "bleu_signature": str(bleu_score),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate BLEU/chrF on a sample of a parallel corpus")
+    parser.add_argument("source", help="source text file, one segment per line")
+    parser.add_argument("target", help="reference translations, line by line with the source")
+    parser.add_argument("--langpair", required=True, help="e.g. km-en or zh-vi")
+    parser.add_argument("--sample", type=int, default=1000, help="number of random lines to evaluate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=64, help="lines translated and scored together")
+    parser.add_argument("--score-workers", type=int, default=2, help="processes computing BLEU/chrF statistics")
+    parser.add_argument("--torch-threads", type=int, default=0, help="torch intra-op threads, 0 keeps torch's default")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--quality", default="", help="decoding policy: fast, balanced or best")
+    parser.add_argument("--output", default="evaluation.jsonl", help="translated sample, written batch by batch")
+    args = parser.parse_args()
+
+    time_s = time.time()
+    sample = reservoir_sample(args.source, args.target, args.sample, seed=args.seed)
+    print (f"Sampled {len(sample)} lines in {time.time() - time_s:.1f}s")
+
+    # each line of a batch on its own thread, so that the model schedulers batch them together
+    init_worker(args.config, args.torch_threads, args.batch_size)
+    # lines are translated whole, as a corpus segment is usually a sentence
+    options = {"merge_en_chunks": False, "replace_doi_terms": False, "translate_by_sentence": False,
+               "max_length": 512, "quality": args.quality}
+    scores = evaluate_sample(sample, args.langpair, options, args.output,
+                             batch_size=args.batch_size, score_workers=args.score_workers)
+    print (f"{args.langpair}: {scores['lines']} lines, BLEU {scores['bleu']:.2f}, chrF {scores['chrf']:.2f}, "
+           f"{scores['errors']} errors\n{scores['bleu_signature']}")
+
+    scores_path = os.path.splitext(args.output)[0] + ".scores.json"
+    with open(scores_path, "w", encoding="utf-8") as f:
+        json.dump(dict(scores, source=args.source, target=args.target, seed=args.seed), f, ensure_ascii=False, indent=4)
@@ -0,0 +1,82 @@
+"""
+Exports the en2vi model to ONNX: encoder, decoder and decoder with past key-values, for the
+onnx backend of `nmt_en2vi.My_NMT_En2Vi_ONNX`, then checks that both paths translate the same.
+
+    python export_onnx_en2vi.py
+    python export_onnx_en2vi.py --check-only --test-file <json array of English texts>
+
+To serve it, set "backend": "onnx" (and "onnx_dir" if not the default) in the "en2vi" entry of config.json.
+"""
+import argparse
+import json
+import time
+
+from nmt_en2vi import My_NMT_En2Vi, My_NMT_En2Vi_ONNX, EN2VI_MODEL_NAME, EN2VI_ONNX_DIR
+
+# used by the equivalence check when no test file is given
+CHECK_TEXTS = [
+    "When I exercise in a private space, I feel more comfortable.",
+    "i haven't been to a public gym before when i exercise in a private space i feel more comfortable",
+    "From 0800 hours on 13 September to 1200 hours on 14 September, live fire training will be conducted in the areas of 19-59.0 N / 109-11.0E, 19-59.0 N / 109-17.0E, 20-05.0 N / 109-17.0E and 20-05.0 N / 109-11.0E. No Entry.",
+    "Discipline implies adherence to specific well-defined rules.",
+    "The absence of discipline means decay.",
+]
+
+
+def export_en2vi(model_name: str = EN2VI_MODEL_NAME, onnx_dir: str = EN2VI_ONNX_DIR):
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    from transformers import AutoTokenizer
+
+    model = ORTModelForSeq2SeqLM.from_pretrained(model_name, export=True, use_cache=True)
+    model.save_pretrained(onnx_dir)
+    AutoTokenizer.from_pretrained(model_name, src_lang="en_XX").save_pretrained(onnx_dir)
+    print (f"Exported {model_name} to {onnx_dir}")
+
+def check_onnx_equivalence(model_name: str, onnx_dir: str, en_texts: list, batch_size: int = 8):
+    """
+    Equivalence check: the onnx backend must give the same translations as the PyTorch one.
+    Returns the number of texts translated differently.
+    """
+    torch_model = My_NMT_En2Vi(model_name=model_name)
+    onnx_model = My_NMT_En2Vi_ONNX(onnx_dir=onnx_dir)
+
+    timings = {}
+    translations = {}
+    for name, model in (("torch", torch_model), ("onnx", onnx_model)):
+        # one warm-up batch, the first calls are slower
+        model.translate(en_texts[:1])
+        time_s = time.time()
+        translations[name] = []
+        for i in range(0, len(en_texts), batch_size):
+            translations[name].extend(model.translate(en_texts[i:i+batch_size]))
+        timings[name] = time.time() - time_s
+
+    differences = 0
+    for en_text, torch_vi, onnx_vi in zip(en_texts, translations["torch"], translations["onnx"]):
+        if torch_vi != onnx_vi:
+            differences += 1
+            print (f"DIFFERENT: {en_text}\n  torch: {torch_vi}\n  onnx:  {onnx_vi}")
+
+    print (f"{len(en_texts) - differences}/{len(en_texts)} translations are the same, "
+           f"torch: {timings['torch']:.2f}s, onnx: {timings['onnx']:.2f}s, "
+           f"speed-up: {timings['torch'] / timings['onnx']:.2f}x")
+    print (f"memory, torch: {sum(p.numel() * p.element_size() for p in torch_model.model.parameters()) / 1e6:.0f}MB, "
+           f"onnx: {onnx_model.model_memory()['cpu'] / 1e6:.0f}MB")
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the en2vi model to ONNX")
+    parser.add_argument("--model", default=EN2VI_MODEL_NAME)
+    parser.add_argument("--onnx-dir", default=EN2VI_ONNX_DIR)
+    parser.add_argument("--check-only", action="store_true", help="only compare an existing export with PyTorch")
+    parser.add_argument("--test-file", default=None, help="json array of English texts for the equivalence check")
+    args = parser.parse_args()
+
+    if not args.check_only:
+        export_en2vi(args.model, args.onnx_dir)
+
+    en_texts = json.load(open(args.test_file)) if args.test_file else CHECK_TEXTS
+    differences = check_onnx_equivalence(args.model, args.onnx_dir, en_texts)
+    if differences > 0:
+        raise SystemExit(1)
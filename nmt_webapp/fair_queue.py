@@ -0,0 +1,124 @@
+import heapq
+import itertools
+import queue
+import threading
+
+# priority classes, most urgent first: typing users of the UI, then batch scripts, batch requests and jobs
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+PRIORITIES = [PRIORITY_INTERACTIVE, PRIORITY_BULK]
+
+# flows remembered by a class beyond which those already served are forgotten
+MAX_IDLE_FLOWS = 1024
+
+# share of a model's work for each class while several of them wait: bulk gets 1 segment of 17
+# under interactive load and everything when the UI is idle
+PRIORITY_WEIGHTS = {PRIORITY_INTERACTIVE: 16, PRIORITY_BULK: 1}
+
+
+class _ClassQueue:
+    """
+    Self-clocked fair queue of one priority class: each flow gets an equal share of the class,
+    whatever the number of segments it queued.
+    """
+    def __init__(self):
+        self.heap = []
+        self.virtual_time = 0.0
+        # finish tag of the last segment queued by each flow
+        self.finish_tags = {}
+
+    def push(self, item, seq: int):
+        tag = max(self.virtual_time, self.finish_tags.get(item.flow, 0.0)) + item.cost
+        self.finish_tags[item.flow] = tag
+        item.finish_tag = tag
+        heapq.heappush(self.heap, (tag, seq, item))
+
+    def pop(self):
+        tag, _, item = heapq.heappop(self.heap)
+        # requeued segments are older than the virtual time
+        self.virtual_time = max(self.virtual_time, tag)
+        if len(self.finish_tags) > MAX_IDLE_FLOWS:
+            # a flow without segments past the virtual time starts over from it anyway
+            self.finish_tags = {flow: t for flow, t in self.finish_tags.items() if t > tag}
+        return item
+
+
+class FairQueue:
+    """
+    Queue of segments in front of a model, with the get/put interface of `queue.Queue` used by `BatchScheduler`.
+    Segments are served by weighted fair queuing at two levels: priority classes share the model by
+    `weights` (see `PRIORITY_WEIGHTS`), and within a class each flow, e.g. a (client, language pair),
+    gets the same share, so a long document of one client doesn't hold back the others.
+    Items have `priority`, `flow` and `cost` (e.g. characters) attributes, `finish_tag` and `charged` are set on them.
+    """
+    def __init__(self, weights: dict = PRIORITY_WEIGHTS):
+        self.weights = weights
+        self.classes = {priority: _ClassQueue() for priority in weights}
+        # virtual time of each class, it advances by cost / weight as the class is served
+        self.passes = {priority: 0.0 for priority in weights}
+        self.seq = itertools.count()
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def put(self, item):
+        item.charged = False
+        with self.condition:
+            class_queue = self.classes[item.priority]
+            if not class_queue.heap:
+                # a class which was idle starts level with the busy ones, without credit nor debt
+                busy = [self.passes[p] for p, q in self.classes.items() if q.heap]
+                if busy:
+                    self.passes[item.priority] = min(busy)
+            class_queue.push(item, next(self.seq))
+            self.size += 1
+            self.condition.notify()
+
+    def requeue(self, items: list):
+        """
+        Puts back items taken from the queue but not run, ahead of items of their class queued after them.
+        Their class was charged for them already, so that it doesn't keep its turn over the class preempting it.
+        """
+        with self.condition:
+            for item in items:
+                heapq.heappush(self.classes[item.priority].heap, (item.finish_tag, next(self.seq), item))
+                self.size += 1
+            self.condition.notify()
+
+    def get(self, block: bool = True, timeout: float = None):
+        with self.condition:
+            if block and not self.condition.wait_for(lambda: self.size > 0, timeout=timeout):
+                raise queue.Empty
+            if self.size == 0:
+                raise queue.Empty
+            priority = self._next_priority()
+            item = self.classes[priority].pop()
+            if not item.charged:
+                item.charged = True
+                self.passes[priority] += item.cost / self.weights[priority]
+            self.size -= 1
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self.size
+
+    def next_priority(self):
+        """
+        Returns the class served next, None if the queue is empty.
+        """
+        with self.condition:
+            return self._next_priority() if self.size else None
+
+    def waiting(self):
+        """
+        Returns the number of queued segments of each class
+        """
+        with self.condition:
+            return {priority: len(class_queue.heap) for priority, class_queue in self.classes.items()}
+
+    def _next_priority(self):
+        # the busy class which was served least for its weight, the most urgent one on ties
+        busy = [p for p in self.weights if self.classes[p].heap]
+        return min(busy, key=lambda p: (self.passes[p], PRIORITIES.index(p) if p in PRIORITIES else len(PRIORITIES)))
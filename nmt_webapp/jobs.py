@@ -0,0 +1,283 @@
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# a job is owned by the runner which queued it for this long, the runner renews the lease
+# while it's alive: jobs of a crashed worker are taken over by another one once it expires
+JOB_LEASE_SECONDS = 60
+
+
+class JobStore:
+    """
+    Keeps translation jobs in `jobs_dir`, so that jobs survive restarts and don't hold an HTTP worker thread.
+    A job is a json file rewritten when its status changes, its results are appended
+    to a `<id>.results.jsonl` file next to it as documents finish.
+    The jobs of a directory may be run by several processes: an unfinished job is owned by one runner
+    at a time, recorded with the expiry of its lease in a small `<id>.lease` file, see `claim`.
+    """
+    def __init__(self, jobs_dir: str = "jobs"):
+        self.jobs_dir = jobs_dir
+        self.lock = threading.Lock()
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def _path(self, job_id: str):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _results_path(self, job_id: str):
+        return os.path.join(self.jobs_dir, f"{job_id}.results.jsonl")
+
+    def _lease_path(self, job_id: str):
+        return os.path.join(self.jobs_dir, f"{job_id}.lease")
+
+    def create(self, documents: list, owner: str = None):
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": JOB_QUEUED,
+            "created": time.time(),
+            "total": len(documents),
+            "documents": documents,
+        }
+        if owner is not None:
+            self._write_lease(job["id"], owner)
+        self.save(dict(job))
+        job["completed"] = 0
+        job["results"] = [None] * len(documents)
+        return job
+
+    def save(self, header: dict):
+        """
+        Writes the status of a job, its results are appended by `append_result`.
+        """
+        self._write_json(self._path(header["id"]), header)
+
+    def update(self, job_id: str, **fields):
+        """
+        Sets fields of the status of a job, e.g. `status`; a finished job has no owner anymore.
+        """
+        with self._locked_dir():
+            header = self._load_header(job_id)
+            if header is not None:
+                header.update(fields)
+                self.save(header)
+                if header["status"] not in (JOB_QUEUED, JOB_RUNNING) and os.path.exists(self._lease_path(job_id)):
+                    os.remove(self._lease_path(job_id))
+
+    def append_result(self, job_id: str, index: int, result: dict):
+        line = json.dumps({"index": index, "result": result}, ensure_ascii=False)
+        with self.lock:
+            with open(self._results_path(job_id), "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def load(self, job_id: str):
+        """
+        Returns the job with its results or None if there's no such job.
+        """
+        job = self._load_header(job_id)
+        if job is None:
+            return None
+        results = job.get("results") or [None] * job["total"]
+        with self.lock:
+            if os.path.exists(self._results_path(job_id)):
+                with open(self._results_path(job_id), encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # the last line of a worker which crashed while writing it
+                            continue
+                        results[entry["index"]] = entry["result"]
+        job["results"] = results
+        job["completed"] = sum(result is not None for result in results)
+        return job
+
+    def owner(self, job_id: str):
+        """
+        Returns the owner of a job and the expiry time of its lease, (None, 0) if it has none.
+        """
+        try:
+            with open(self._lease_path(job_id), encoding="utf-8") as f:
+                lease = json.load(f)
+            return lease["owner"], lease["expires"]
+        except (FileNotFoundError, ValueError):
+            return None, 0
+
+    def claim(self, job_id: str, owner: str, force: bool = False):
+        """
+        Makes `owner` the owner of an unfinished job for `JOB_LEASE_SECONDS` and returns True,
+        False if it's finished or another owner's lease didn't expire (unless `force`).
+        """
+        with self._locked_dir():
+            header = self._load_header(job_id)
+            if header is None or header["status"] not in (JOB_QUEUED, JOB_RUNNING):
+                return False
+            current_owner, expires = self.owner(job_id)
+            if not force and current_owner not in (None, owner) and expires > time.time():
+                return False
+            self._write_lease(job_id, owner)
+            return True
+
+    def renew(self, job_ids: list, owner: str):
+        """
+        Extends the lease of the jobs still owned by `owner`.
+        """
+        with self._locked_dir():
+            for job_id in job_ids:
+                if self.owner(job_id)[0] == owner:
+                    self._write_lease(job_id, owner)
+
+    def expired_jobs(self):
+        """
+        Returns the ids of unfinished jobs whose lease expired.
+        """
+        job_ids = []
+        for file_name in os.listdir(self.jobs_dir):
+            if file_name.endswith(".lease"):
+                job_id = file_name[:-len(".lease")]
+                if self.owner(job_id)[1] < time.time():
+                    job_ids.append(job_id)
+        return job_ids
+
+    def unfinished_jobs(self):
+        """
+        Returns the status of unfinished jobs, without their results.
+        """
+        jobs = []
+        for file_name in os.listdir(self.jobs_dir):
+            if file_name.endswith(".json"):
+                job = self._load_header(file_name[:-len(".json")])
+                if job is not None and job["status"] in (JOB_QUEUED, JOB_RUNNING):
+                    jobs.append(job)
+        return sorted(jobs, key=lambda job: job["created"])
+
+    def _write_lease(self, job_id: str, owner: str):
+        self._write_json(self._lease_path(job_id), {"owner": owner, "expires": time.time() + JOB_LEASE_SECONDS})
+
+    def _write_json(self, path: str, content: dict):
+        # write to a temporary file first so a crash never leaves a truncated file behind
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self.lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(content, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+
+    def _load_header(self, job_id: str):
+        # job ids are uuid hex strings, never paths
+        if not job_id.isalnum():
+            return None
+        try:
+            with self.lock:
+                with open(self._path(job_id), encoding="utf-8") as f:
+                    return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _locked_dir(self):
+        # claims and renewals of the processes sharing the directory don't interleave
+        return _FileLock(os.path.join(self.jobs_dir, ".lock"))
+
+
+class _FileLock:
+    def __init__(self, path: str):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+class JobRunner:
+    """
+    Runs jobs of a `JobStore` on background threads.
+    `translate_documents(documents, on_document_done)` translates a list of documents and
+    calls `on_document_done(index, result)` as each one finishes.
+    With `resume`, jobs left unfinished by a previous run are picked up again on start. Jobs whose
+    lease expired, e.g. those of a pre-fork worker which crashed, are taken over at any time.
+    """
+    def __init__(self, store: JobStore, translate_documents: Callable, num_workers: int = 1, resume: bool = True):
+        self.store = store
+        self.translate_documents = translate_documents
+        self.queue = queue.Queue()
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # jobs queued or running here, whose leases are renewed
+        self.owned = set()
+        self.owned_lock = threading.Lock()
+
+        if resume:
+            for job in store.unfinished_jobs():
+                if store.claim(job["id"], self.owner, force=True):
+                    logger.info(f"Resuming job {job['id']}")
+                    self._enqueue(job["id"])
+
+        for i in range(num_workers):
+            threading.Thread(target=self._run, name=f"job-runner-{i}", daemon=True).start()
+        threading.Thread(target=self._keep_leases, name="job-leases", daemon=True).start()
+
+    def submit(self, documents: list):
+        job = self.store.create(documents, owner=self.owner)
+        self._enqueue(job["id"])
+        return job
+
+    def _enqueue(self, job_id: str):
+        with self.owned_lock:
+            self.owned.add(job_id)
+        self.queue.put(job_id)
+
+    def _keep_leases(self):
+        while True:
+            time.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                with self.owned_lock:
+                    owned = list(self.owned)
+                self.store.renew(owned, self.owner)
+                for job_id in self.store.expired_jobs():
+                    previous_owner = self.store.owner(job_id)[0]
+                    if job_id not in owned and self.store.claim(job_id, self.owner):
+                        logger.info(f"Taking over job {job_id} from {previous_owner}")
+                        self._enqueue(job_id)
+            except Exception:
+                logger.exception("Failed to renew job leases")
+
+    def _run(self):
+        while True:
+            job_id = self.queue.get()
+            try:
+                self._run_job(job_id)
+            finally:
+                with self.owned_lock:
+                    self.owned.discard(job_id)
+
+    def _run_job(self, job_id: str):
+        job = self.store.load(job_id)
+        if job is None or self.store.owner(job_id)[0] != self.owner:
+            return
+        self.store.update(job_id, status=JOB_RUNNING)
+
+        # documents finished before a restart are not translated again
+        todo = [i for i, result in enumerate(job["results"]) if result is None]
+
+        def on_document_done(todo_idx: int, result: dict):
+            self.store.append_result(job_id, todo[todo_idx], result)
+
+        try:
+            self.translate_documents([job["documents"][i] for i in todo], on_document_done)
+            self.store.update(job_id, status=JOB_DONE)
+        except Exception as ex:
+            logger.error(f"Job {job_id} failed: {ex}")
+            self.store.update(job_id, status=JOB_FAILED, error=str(ex))
@@ -0,0 +1,186 @@
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# estimated footprint of a request in flight: a fixed part, plus its segments (queued requests,
+# futures, their share of padded batches) and its text through the pipeline stages
+REQUEST_BASE_BYTES = 1 << 20
+SEGMENT_BYTES = 256 << 10
+CHAR_BYTES = 1 << 10
+
+# requests waiting for memory, beyond it they are rejected at once
+MAX_WAITING_REQUESTS = 64
+
+
+class MemoryBudgetExceeded(Exception):
+    """
+    Raised when a request doesn't fit in the memory budget, `retry_after` is in seconds.
+    """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def process_memory():
+    """
+    Returns {device type: bytes} used by this process: its resident set size,
+    and the memory held by torch's CUDA allocator if there's a GPU.
+    """
+    memory = {}
+    try:
+        with open("/proc/self/statm") as f:
+            memory["cpu"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # no procfs: the peak resident set size, in kilobytes on linux and bytes on macOS
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        memory["cpu"] = max_rss if sys.platform == "darwin" else max_rss * 1024
+    if torch.cuda.is_available():
+        memory["cuda"] = torch.cuda.memory_reserved()
+    return memory
+
+def release_cuda_cache(used_thresh: float = 0.5):
+    """
+    Gives the cached blocks of torch's CUDA allocator back when more than `used_thresh` of the GPU is used,
+    does nothing without GPU.
+    """
+    if not torch.cuda.is_available():
+        return
+    free, total = torch.cuda.mem_get_info()
+    if free / total < used_thresh:
+        torch.cuda.empty_cache()
+
+
+class _Reservation:
+    def __init__(self, governor, footprint: dict):
+        self.governor = governor
+        self.footprint = footprint
+        self.time_s = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.governor._release(self.footprint, time.monotonic() - self.time_s)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class MemoryGovernor:
+    """
+    Admission control by memory, for CPU RAM and GPU memory alike.
+    A request reserves an estimate of its footprint (see `estimate`) before it runs and gives it back when done.
+    It's admitted while the memory of the process fits `budget` ({device type: bytes}, e.g. {"cpu": 24e9, "cuda": 14e9}), else it waits for requests
+    to finish, up to `max_wait` seconds, then MemoryBudgetExceeded is raised with a Retry-After estimate.
+    The memory of the process is what it used the last time no request was in flight plus the reservations
+    in flight, or the measured memory if higher: requests in flight are counted once, whether they already
+    allocated their memory or not.
+    A request is always admitted when no other one is in flight. An empty budget admits every request.
+    """
+    def __init__(self, budget: dict = None, max_wait: float = 10, max_waiting: int = MAX_WAITING_REQUESTS):
+        self.budget = budget if budget is not None else {}
+        self.max_wait = max_wait
+        self.max_waiting = max_waiting
+        self.condition = threading.Condition()
+
+        self.reserved = {}
+        # measured memory the last time no request was in flight
+        self.baseline = {}
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        # moving average of the seconds a request holds its reservation, for Retry-After
+        self.hold_seconds = 1.0
+
+    def estimate(self, num_segments: int, num_chars: int):
+        """
+        Returns the estimated footprint of a request {device type: bytes}, on the GPU too if there's one.
+        """
+        size = REQUEST_BASE_BYTES + num_segments * SEGMENT_BYTES + num_chars * CHAR_BYTES
+        footprint = {"cpu": size}
+        if torch.cuda.is_available():
+            footprint["cuda"] = size
+        return footprint
+
+    def admit(self, footprint: dict, block: bool = False):
+        """
+        Reserves `footprint` and returns the reservation, a context manager releasing it.
+        With `block`, waits as long as needed instead of raising MemoryBudgetExceeded, for background work.
+        """
+        with self.condition:
+            if not self._fits(footprint):
+                if not block and self.waiting >= self.max_waiting:
+                    self._reject(footprint)
+                self.queued += 1
+                self.waiting += 1
+                deadline = None if block else time.monotonic() + self.max_wait
+                try:
+                    # memory of finished requests may still be cached by the allocator
+                    release_cuda_cache()
+                    while not self._fits(footprint):
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            self._reject(footprint)
+                        # measured memory goes down without notification, check it again every second
+                        self.condition.wait(timeout=1 if remaining is None else min(remaining, 1))
+                finally:
+                    self.waiting -= 1
+            for device_type, size in footprint.items():
+                self.reserved[device_type] = self.reserved.get(device_type, 0) + size
+            self.in_flight += 1
+            self.admitted += 1
+        return _Reservation(self, footprint)
+
+    def retry_after(self):
+        return max(1, math.ceil(self.hold_seconds))
+
+    def stats(self):
+        with self.condition:
+            return {
+                "budget": self.budget,
+                "usage": process_memory(),
+                "reserved": dict(self.reserved),
+                "baseline": dict(self.baseline),
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+            }
+
+    def _fits(self, footprint: dict):
+        if not self.budget:
+            return True
+        usage = process_memory()
+        if self.in_flight == 0:
+            self.baseline = usage
+            return True
+        return all(max(usage.get(device_type, 0), self.baseline.get(device_type, 0) + self.reserved.get(device_type, 0))
+                   + footprint.get(device_type, 0) <= budget
+                   for device_type, budget in self.budget.items())
+
+    def _reject(self, footprint: dict):
+        self.rejected += 1
+        raise MemoryBudgetExceeded(f"Not enough memory for the request ({footprint} bytes), "
+                                   f"budget: {self.budget}, reserved: {self.reserved}", self.retry_after())
+
+    def _release(self, footprint: dict, hold_seconds: float):
+        with self.condition:
+            for device_type, size in footprint.items():
+                self.reserved[device_type] -= size
+            self.in_flight -= 1
+            self.hold_seconds = 0.9 * self.hold_seconds + 0.1 * hold_seconds
+            self.condition.notify_all()
@@ -0,0 +1,65 @@
+import json
+
+# config entries which are not NeMo language pairs but settings of the other backends
+SEAMLESS_MODEL_KEY = "seamless"
+EN2VI_MODEL_KEY = "en2vi"
+BACKEND_MODEL_KEYS = [SEAMLESS_MODEL_KEY, EN2VI_MODEL_KEY]
+
+# per-model setting defaults, see `scheduler.BatchScheduler` for dynamic batching
+DEFAULT_MODEL_SETTINGS = {
+    "max_batch_size": 32,
+    "max_wait_ms": 10,
+    "max_batch_tokens": 4096,
+    # pinned models are loaded at start and never unloaded, see `model_registry.ModelRegistry`
+    "pinned": False,
+    # inference precision: "fp32", "bf16" or "int8-dynamic", see `precision.apply_precision`
+    "precision": "fp32",
+    # inference runtime: "torch", or "onnx" for en2vi, see `nmt_en2vi.My_NMT_En2Vi_ONNX`
+    "backend": "torch",
+    # decoding policy when requests don't ask for one: "fast", "balanced" or "best", see `decoding.DecodingPolicy`,
+    # None for the decoding the model was shipped with
+    "quality": None,
+    # token budget of a paragraph when translating by chunks, measured by the model's tokenizer,
+    # None to use the `max_length` characters of the request instead
+    "max_segment_tokens": None,
+    # warmup batches run after loading at start, one per length in characters, see `nmt_service.warmup_model`
+    "warmup_lengths": [64, 256],
+    "warmup_batch_size": 4,
+    # language pairs the model translates for routing, e.g. ["km-en", "en-km"], None for the backend's defaults
+    # (the NeMo language pair of the key, `nmt_service.SEAMLESS_SUPPORTED_LANG_PAIRS`, en-vi for en2vi)
+    "langpairs": None,
+    # multiplies the model's measured latency when choosing routes, above 1 for a model of lower quality,
+    # see `routing.RoutingGraph`
+    "routing_weight": 1.0,
+}
+
+def read_models_config(config_file_path: str):
+    """
+    Reads config.json and returns {model key: settings}.
+    A model key is either a NeMo language pair or one of `BACKEND_MODEL_KEYS`.
+    An entry is either the model location (old format) or a dict with a "model" location
+    and optional per-model settings.
+    """
+    with open(config_file_path) as f:
+        config = json.load(f)
+
+    if not config:
+        raise ValueError("Did not find the config.json or it was empty")
+
+    models_config = {}
+    for key, value in config.items():
+        settings = dict(DEFAULT_MODEL_SETTINGS)
+        if isinstance(value, str):
+            settings["model"] = value
+        else:
+            settings["model"] = None
+            settings.update(value)
+        models_config[key] = settings
+
+    return models_config
+
+def is_nemo_model_key(key: str):
+    return key not in BACKEND_MODEL_KEYS
+
+def get_model_settings(models_config: dict, key: str):
+    return models_config.get(key, DEFAULT_MODEL_SETTINGS)
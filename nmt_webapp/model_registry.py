@@ -0,0 +1,161 @@
+import gc
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def model_memory(model):
+    """
+    Returns {device type: bytes} taken by the parameters and buffers of a model.
+    Wrappers like `My_NMT_T2TT` are searched one level deep for torch modules,
+    models which are not torch based report their memory with a `model_memory()` method.
+    """
+    if hasattr(model, "model_memory"):
+        return model.model_memory()
+
+    modules = []
+    if isinstance(model, torch.nn.Module):
+        modules.append(model)
+    else:
+        modules.extend(v for v in vars(model).values() if isinstance(v, torch.nn.Module))
+
+    memory = {}
+    seen = set()
+    for module in modules:
+        tensors = list(module.parameters()) + list(module.buffers())
+        # weights of dynamically quantized Linear layers are packed, neither parameters nor buffers
+        for submodule in module.modules():
+            if hasattr(submodule, "_packed_params") and callable(getattr(submodule, "weight", None)):
+                tensors.append(submodule.weight())
+        for tensor in tensors:
+            if tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            device_type = tensor.device.type
+            memory[device_type] = memory.get(device_type, 0) + tensor.numel() * tensor.element_size()
+    return memory
+
+
+class ModelRegistry:
+    """
+    Loads models on first use and keeps the resident ones within a memory budget.
+    `register(key, loader)` declares a model, `get(key)` loads it if needed.
+    When the memory taken by loaded models exceeds `memory_budget` ({device type: bytes},
+    e.g. {"cpu": 8e9, "cuda": 10e9}) the least recently used models are unloaded,
+    except pinned ones. Loaded models are marked warm with `set_warm(key)` once a warmup batch ran.
+    """
+    def __init__(self, memory_budget: dict = None):
+        self.memory_budget = memory_budget if memory_budget is not None else {}
+        self.loaders = {}
+        self.pinned = set()
+        self.models = OrderedDict()
+        self.memory = {}
+        self.load_seconds = {}
+        self.warm = set()
+        self.lock = threading.Lock()
+        self.load_locks = {}
+
+    def register(self, key: str, loader: Callable, pinned: bool = False):
+        with self.lock:
+            self.loaders[key] = loader
+            self.load_locks[key] = threading.Lock()
+            if pinned:
+                self.pinned.add(key)
+
+    def has(self, key: str):
+        return key in self.loaders
+
+    def is_loaded(self, key: str):
+        return key in self.models
+
+    def is_warm(self, key: str):
+        return key in self.warm
+
+    def set_warm(self, key: str):
+        with self.lock:
+            if key in self.models:
+                self.warm.add(key)
+
+    def get(self, key: str):
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            if key not in self.loaders:
+                raise KeyError(f"No model registered for {key}")
+
+        # one thread loads a model while the others wait for it
+        with self.load_locks[key]:
+            with self.lock:
+                if key in self.models:
+                    self.models.move_to_end(key)
+                    return self.models[key]
+                # make room beforehand if the model was loaded before and its size is known
+                if key in self.memory:
+                    self._evict_over_budget(keep=key, extra=self.memory[key])
+
+            logger.info(f"Loading model {key}")
+            time_s = time.time()
+            model = self.loaders[key]()
+            load_seconds = time.time() - time_s
+
+            with self.lock:
+                self.models[key] = model
+                self.memory[key] = model_memory(model)
+                self.load_seconds[key] = load_seconds
+                logger.info(f"Loaded model {key} in {load_seconds:.1f}s, memory: {self.memory[key]}")
+                self._evict_over_budget(keep=key)
+            return model
+
+    def evict(self, key: str):
+        with self.lock:
+            self._unload(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "loaded": list(self.models),
+                "pinned": sorted(self.pinned),
+                "warm": sorted(self.warm),
+                "memory": {key: self.memory[key] for key in self.models},
+                "total_memory": self._total_memory(),
+                "memory_budget": self.memory_budget,
+            }
+
+    def _total_memory(self, extra: dict = None):
+        total = dict(extra or {})
+        for key in self.models:
+            for device_type, size in self.memory[key].items():
+                total[device_type] = total.get(device_type, 0) + size
+        return total
+
+    def _is_over_budget(self, extra: dict = None):
+        total = self._total_memory(extra)
+        return any(total.get(device_type, 0) > budget for device_type, budget in self.memory_budget.items())
+
+    def _evict_over_budget(self, keep: str, extra: dict = None):
+        # models are kept in least recently used first order
+        for key in list(self.models):
+            if not self._is_over_budget(extra):
+                break
+            if key != keep and key not in self.pinned:
+                self._unload(key)
+        if self._is_over_budget(extra):
+            logger.warning(f"Loaded models exceed the memory budget {self.memory_budget}: {self._total_memory(extra)}")
+
+    def _unload(self, key: str):
+        if key not in self.models:
+            return
+        logger.info(f"Unloading model {key}, memory: {self.memory[key]}")
+        del self.models[key]
+        self.warm.discard(key)
+        # running batches keep their own reference, the model is freed once they're done
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
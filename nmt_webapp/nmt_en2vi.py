@@ -1,24 +1,75 @@
+import os
+import threading
 import torch
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 from typing import List
 
-tokenizer_en2vi = AutoTokenizer.from_pretrained("vinai/vinai-translate-en2vi", src_lang="en_XX")
-model_en2vi = AutoModelForSeq2SeqLM.from_pretrained("vinai/vinai-translate-en2vi")
-device_en2vi = torch.device("cpu")
-model_en2vi.to(device_en2vi)
+EN2VI_MODEL_NAME = "vinai/vinai-translate-en2vi"
+# written by export_onnx_en2vi.py
+EN2VI_ONNX_DIR = "models/en2vi-onnx"
 
 
+class My_NMT_En2Vi:
+    def __init__(self, model_name: str = EN2VI_MODEL_NAME):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, src_lang="en_XX")
+        self.model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+        self.device = torch.device("cpu")
+        self.model.to(self.device)
+
+    def translate(self, inputs: List[str], source_lang: str = "en", target_lang: str = "vi", decoding=None):
+        input_ids = self.tokenizer(inputs, padding=True, return_tensors="pt").to(self.device)
+        # `decoding` is a `decoding.DecodingPolicy`, 5 beams without length limit if not given
+        decoding_kwargs = {"num_beams": 5, "early_stopping": True}
+        if decoding is not None:
+            decoding_kwargs = {
+                "num_beams": decoding.num_beams,
+                "early_stopping": True,
+                "max_new_tokens": decoding.max_new_tokens(input_ids["input_ids"].shape[1]),
+            }
+        output_ids = self.model.generate(
+            **input_ids,
+            decoder_start_token_id=self.tokenizer.lang_code_to_id["vi_VN"],
+            num_return_sequences=1,
+            **decoding_kwargs
+        )
+        vi_texts = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+        return vi_texts
+
+    def count_tokens(self, text: str):
+        # tokens of the text itself: segments are packed by it, the special tokens are added once per segment
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+class My_NMT_En2Vi_ONNX(My_NMT_En2Vi):
+    """
+    Same beam search as `My_NMT_En2Vi`, with the encoder and the decoder (with past key-values)
+    run by ONNX Runtime on CPU, from the directory written by export_onnx_en2vi.py.
+    """
+    def __init__(self, onnx_dir: str = EN2VI_ONNX_DIR):
+        # optional dependency, only needed by the onnx backend
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+
+        self.onnx_dir = onnx_dir
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir, src_lang="en_XX")
+        self.model = ORTModelForSeq2SeqLM.from_pretrained(onnx_dir, provider="CPUExecutionProvider", use_cache=True)
+        self.device = torch.device("cpu")
+
+    def model_memory(self):
+        # onnx runtime sessions are not torch modules, their weights take about the size of the files
+        onnx_files = [f for f in os.listdir(self.onnx_dir) if f.endswith(".onnx") or f.endswith(".onnx_data")]
+        return {"cpu": sum(os.path.getsize(os.path.join(self.onnx_dir, f)) for f in onnx_files)}
+
+
+# the model is loaded by the first call of `translate_en2vi`, not on import
+_default_model = None
+_default_model_lock = threading.Lock()
+
 def translate_en2vi(en_texts: List[str]) -> List[str]:
-    input_ids = tokenizer_en2vi(en_texts, padding=True, return_tensors="pt").to(device_en2vi)
-    output_ids = model_en2vi.generate(
-        **input_ids,
-        decoder_start_token_id=tokenizer_en2vi.lang_code_to_id["vi_VN"],
-        num_return_sequences=1,
-        num_beams=5,
-        early_stopping=True
-    )
-    vi_texts = tokenizer_en2vi.batch_decode(output_ids, skip_special_tokens=True)
-    return vi_texts
+    global _default_model
+    with _default_model_lock:
+        if _default_model is None:
+            _default_model = My_NMT_En2Vi()
+    return _default_model.translate(en_texts)
 
 if __name__ == "__main__":
     # The input may consist of multiple text sequences, with the number of text sequences in the input ranging from 1 up to 8, 16, 32, or even higher, depending on the GPU memory.
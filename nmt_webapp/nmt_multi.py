@@ -8,7 +8,8 @@ import torch
 import random
 import csv
 import numpy as np
-from seamless_communication.inference import Translator
+from seamless_communication.inference import Translator, SequenceGeneratorOptions
+from seamless_communication.inference.translator import Modality
 from typing import List
 
 logging.basicConfig(
@@ -27,38 +28,88 @@ LANGUAGE_MAP = {
     "th": "tha"
 }
 
+SEAMLESS_MODEL_NAME = "seamlessM4T_medium"
+
 class My_NMT_T2TT:
-    def __init__(self, model_name: str = "seamlessM4T_medium"):
+    """
+    Text-to-text SeamlessM4T: the speech encoder, the text-to-unit model and the vocoder are not loaded,
+    and a list of inputs is translated with one padded batch through the text encoder-decoder.
+    """
+    def __init__(self, model_name: str = SEAMLESS_MODEL_NAME, dtype: torch.dtype = None):
 
         if torch.cuda.is_available():
             device = torch.device("cuda:0")
-            dtype = torch.float16
+            dtype = dtype or torch.float16
             logger.info(f"Running inference on the GPU in {dtype}.")
         else:
             device = torch.device("cpu")
-            dtype = torch.float32
+            dtype = dtype or torch.float32
             logger.info(f"Running inference on the CPU in {dtype}.")
     
+        # text in and text out only, no speech modules
         self.translator = Translator(
                             model_name_or_card=model_name,
-                            vocoder_name_or_card="vocoder_36langs",
+                            vocoder_name_or_card=None,
                             device=device,
-                            dtype=dtype
+                            dtype=dtype,
+                            input_modality=Modality.TEXT,
+                            output_modality=Modality.TEXT
                         )
+        # source text encoders by seamless language code, created on first use
+        self._text_encoders = {}
+
+    def _get_text_encoder(self, src_lang: str):
+        if src_lang not in self._text_encoders:
+            self._text_encoders[src_lang] = self.translator.text_tokenizer.create_encoder(
+                task="translation", lang=src_lang, mode="source", device=self.translator.device)
+        return self._text_encoders[src_lang]
     
-    def translate(self, inputs: List[str], source_lang: str = "km", target_lang: str = "en"):
-
-        translations = []
-        for input_text in inputs:
-            translated_text, _ = self.translator.predict(input_text,
-                                            task_str="t2tt",
-                                            tgt_lang=LANGUAGE_MAP[target_lang],
-                                            src_lang=LANGUAGE_MAP[source_lang]
-                                        )
-            translations.append(translated_text[0].__str__())
-            
-        return translations
+    def translate(self, inputs: List[str], source_lang: str = "km", target_lang: str = "en", decoding=None):
+
+        # `decoding` is a `decoding.DecodingPolicy`, seamless' default decoding if not given
+        decoding_kwargs = {}
+        if decoding is not None:
+            decoding_kwargs["text_generation_opts"] = SequenceGeneratorOptions(
+                beam_size=decoding.num_beams,
+                soft_max_seq_len=(decoding.max_length_ratio, decoding.max_length_offset)
+            )
+
+        # all inputs are encoded and padded into one batch, `predict` takes it as is
+        text_encoder = self._get_text_encoder(LANGUAGE_MAP[source_lang])
+        src = self.translator.collate([text_encoder(input_text) for input_text in inputs])
+        translated_texts, _ = self.translator.predict(src,
+                                        task_str="t2tt",
+                                        tgt_lang=LANGUAGE_MAP[target_lang],
+                                        src_lang=LANGUAGE_MAP[source_lang],
+                                        **decoding_kwargs
+                                    )
+
+        return [translated_text.__str__() for translated_text in translated_texts]
+
+    def count_tokens(self, text: str):
+        # the language token is the only difference between source languages, english counts the same;
+        # it and the end of sentence token are added once per segment, they're not counted
+        text_encoder = self._get_text_encoder(LANGUAGE_MAP["en"])
+        special_tokens = sum(len(indices) for indices in (text_encoder.prefix_indices, text_encoder.suffix_indices)
+                             if indices is not None)
+        return len(text_encoder(text)) - special_tokens
 
 if __name__ == "__main__":
+    import time
+    from test_nmt_multi import KM_TEXTS, translate_one_by_one
+
+    km_texts = KM_TEXTS
     m4t_model = My_NMT_T2TT()
-    print (m4t_model.translate(["យ៉ាង ណា ក៏ ដោយ បូតុលូសស៊ី ស៊ុត ចូល លើក ទី ៤ នៃ ការ ទាត់ បាល់ ពិន័យ នៃ ប្រកួត នេះ ហើយ បន្ទាប់ មក ម័ររូ ប៊ីហ្គាម៉ាស្កូ និង អេនត្រា ម៉ាស៊ី បាន ស៊ុត ចូល នាំ អោយ អ៊ីតាលី ឈ្នះ ។"]))
\ No newline at end of file
+
+    time_s = time.time()
+    one_by_one = translate_one_by_one(m4t_model, km_texts)
+    one_by_one_duration = time.time() - time_s
+
+    time_s = time.time()
+    batched = m4t_model.translate(km_texts, source_lang="km", target_lang="en")
+    batched_duration = time.time() - time_s
+
+    for text, expected, translated in zip(km_texts, one_by_one, batched):
+        print (f"{text}\n  one by one: {expected}\n  batched:    {translated}")
+    print (f"{sum(a == b for a, b in zip(one_by_one, batched))}/{len(km_texts)} translations are the same, "
+           f"one by one: {one_by_one_duration:.2f}s, batched: {batched_duration:.2f}s")
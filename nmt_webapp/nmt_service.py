@@ -11,8 +11,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import argparse
+import atexit
+import functools
+import hmac
 import json
+import math
+import re
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import flask
 import torch
@@ -22,16 +31,38 @@ from waitress import serve
 
 import nemo.collections.nlp as nemo_nlp
 from nemo.utils import logging
-from utils import split_long_text, split_long_text_by_sentence_and_quotation, replace_doi_terms, remove_troll_characters
+from utils import remove_troll_characters
+from segmentation import split_text
+from term_replacer import replace_terms
 
-from nmt_multi import My_NMT_T2TT
-from nmt_en2vi import translate_en2vi
+from nmt_multi import My_NMT_T2TT, SEAMLESS_MODEL_NAME
+from nmt_en2vi import My_NMT_En2Vi, My_NMT_En2Vi_ONNX, EN2VI_MODEL_NAME, EN2VI_ONNX_DIR
+from batching import is_empty_segment
+from model_config import read_models_config, is_nemo_model_key, get_model_settings, SEAMLESS_MODEL_KEY, EN2VI_MODEL_KEY
+from scheduler import BatchScheduler
+from pivot_pipeline import EnglishChunkMerger, iter_pivot_pipeline
+from translation_memory import TranslationMemory
+from jobs import JobStore, JobRunner, JOB_DONE
+from model_registry import ModelRegistry
+from precision import apply_precision
+from prefork import PreforkServer
+from decoding import get_decoding_policy
+from single_flight import SingleFlight
+from memory_governor import MemoryGovernor, MemoryBudgetExceeded, release_cuda_cache
+from cancellation import CancelScope, TranslationCancelled
+from fair_queue import PRIORITIES, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from routing import RoutingGraph
+from metrics import MetricsRegistry, COUNT_BUCKETS, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
-# save both nemo and seamlessM4T models
-NEMO_MODELS_DICT = {}
+# nemo, seamlessM4T and en2vi models, loaded on first use and unloaded
+# least recently used first when they don't fit in the memory budget,
+# {device type: bytes}, e.g. {"cpu": 16e9, "cuda": 10e9}, empty for no limit
+MODEL_MEMORY_BUDGET = {}
+MODEL_REGISTRY = ModelRegistry(MODEL_MEMORY_BUDGET)
+# language pairs of the registered models, requests take the cheapest chain of models
+# given their latencies and the segments queued in their schedulers
+ROUTING_GRAPH = RoutingGraph(queued_fn=lambda model_key: queued_segments(model_key))
 
-# declare seamless multi-model
-nmt_multi_model = None
 # seamless supported language pairs
 SEAMLESS_SUPPORTED_LANG_PAIRS = [
     "ru-en",
@@ -41,20 +72,215 @@ SEAMLESS_SUPPORTED_LANG_PAIRS = [
     "th-en"
 ]
 
+# per-model settings read from config.json
+MODELS_CONFIG = {}
+
+# models loaded at once at start, /readyz reports ready once they're loaded and warmed up
+PRELOAD_WORKERS = 4
+startup_done = threading.Event()
+startup_error = None
+
+# source text of warmup batches by language, repeated or cut to the "warmup_lengths" of a model
+WARMUP_TEXTS = {
+    "zh": "从9月13日0800时至9月14日1200时，在下列各点连线范围内进行实弹射击训练，禁止驶入。",
+    "km": "យ៉ាង ណា ក៏ ដោយ បូតុលូសស៊ី ស៊ុត ចូល លើក ទី ៤ នៃ ការ ទាត់ បាល់ ពិន័យ នៃ ប្រកួត នេះ ។ ",
+    "en": "From 0800 hours on 13 September to 1200 hours on 14 September, live fire training will be conducted. ",
+}
+
+# one dynamic batching scheduler per model, created on first use
+SCHEDULERS = {}
+schedulers_lock = threading.Lock()
+# a model call running longer than this is stuck, see `schedulers_healthy`
+MAX_MODEL_CALL_SECONDS = 120
+
+# segment-level translation memory, set `TRANSLATION_MEMORY_DB` to None
+# to keep it in process memory only
+TRANSLATION_MEMORY_SIZE = 100000
+TRANSLATION_MEMORY_DB = "cache/translation_memory.db"
+translation_memory = TranslationMemory(max_entries=TRANSLATION_MEMORY_SIZE)
+
+# memory of the whole process allowed for requests to be admitted, {device type: bytes},
+# e.g. {"cpu": 24e9, "cuda": 14e9}, empty to admit every request; per worker with --workers
+MEMORY_BUDGET = {}
+memory_governor = MemoryGovernor(MEMORY_BUDGET)
+
+# identical requests (text, langpair and options) running at the same time are translated once
+translate_flights = SingleFlight()
+
+# beam size and max_delta_len of the NeMo models as loaded, by model key
+NEMO_SHIPPED_DECODING = {}
+
+# token counts of segments by model key, shared by the segmentation and the schedulers;
+# only texts up to TOKEN_COUNT_CACHE_MAX_CHARS are cached, so that it holds sentences rather than documents
+TOKEN_COUNT_CACHE_SIZE = 100000
+TOKEN_COUNT_CACHE_MAX_CHARS = 1000
+
+# stages of `iter_translate` timed in its final event
+PIPELINE_STAGES = ["cleanup", "term_replacement", "segmentation", "src_en", "en_vi", "assembly"]
+
+# served by /metrics in Prometheus text format, per serving process
+METRICS = MetricsRegistry()
+requests_total = METRICS.counter("nmt_requests_total", "Translation requests by language pair and outcome",
+                                 ["langpair", "outcome"])
+request_seconds = METRICS.histogram("nmt_request_seconds", "Latency of translation requests", ["langpair"])
+request_segments = METRICS.histogram("nmt_request_segments", "Segments per translation request", ["langpair"],
+                                     buckets=COUNT_BUCKETS)
+stage_seconds = METRICS.histogram("nmt_stage_seconds", "Time spent in each pipeline stage per request", ["stage"])
+model_batch_seconds = METRICS.histogram("nmt_model_batch_seconds", "Latency of model calls per batch", ["model"])
+model_batch_size = METRICS.histogram("nmt_model_batch_size", "Segments per model call", ["model"], buckets=COUNT_BUCKETS)
+scheduler_queue_depth = METRICS.gauge("nmt_scheduler_queue_depth", "Segments waiting for a model", ["model"])
+scheduled_segments = METRICS.counter("nmt_scheduled_segments_total", "Segments translated by the schedulers by priority class",
+                                     ["model", "priority"])
+scheduler_wait_seconds = METRICS.counter("nmt_scheduler_wait_seconds_total", "Seconds segments waited for a model "
+                                         "by priority class", ["model", "priority"])
+preempted_segments = METRICS.counter("nmt_preempted_segments_total", "Segments of gathered batches queued again for "
+                                     "more urgent ones", ["model"])
+dropped_segments = METRICS.counter("nmt_dropped_segments_total", "Queued segments of cancelled requests dropped by "
+                                   "the schedulers", ["model"])
+tm_lookups = METRICS.counter("nmt_translation_memory_lookups_total", "Translation memory lookups by result", ["result"])
+tm_hit_rate = METRICS.gauge("nmt_translation_memory_hit_rate", "Translation memory hits per lookup")
+tm_entries = METRICS.gauge("nmt_translation_memory_entries", "Segments kept in process memory by the translation memory")
+model_memory_bytes = METRICS.gauge("nmt_model_memory_bytes", "Memory taken by loaded models", ["model", "device"])
+models_loaded = METRICS.gauge("nmt_model_loaded", "Whether a registered model is loaded", ["model"])
+coalesced_requests = METRICS.counter("nmt_coalesced_requests_total",
+                                     "Requests which joined an identical request in progress instead of running")
+admissions = METRICS.counter("nmt_admissions_total", "Requests admitted or rejected by the memory governor", ["result"])
+cancelled_requests = METRICS.counter("nmt_cancelled_requests_total", "Requests cancelled by a client disconnection "
+                                     "or their deadline", ["reason"])
+admission_waits = METRICS.counter("nmt_admission_waits_total", "Requests which waited for memory before being admitted or rejected")
+process_memory_bytes = METRICS.gauge("nmt_process_memory_bytes", "Memory used by the serving process", ["device"])
+reserved_memory_bytes = METRICS.gauge("nmt_reserved_memory_bytes", "Estimated memory of the requests in flight", ["device"])
+duplicate_segments = METRICS.counter("nmt_duplicate_segments_total",
+                                     "Segments translated once for several identical segments of a document")
+
+# documents of batch requests are translated concurrently,
+# so that their segments meet in the model schedulers
+DOCUMENT_WORKERS = 16
+documents_executor = ThreadPoolExecutor(max_workers=DOCUMENT_WORKERS)
+# documents of jobs have their own threads: a large job doesn't queue batch requests behind its documents,
+# and its documents waiting for memory don't hold the threads of batch requests
+JOB_DOCUMENT_WORKERS = 8
+jobs_executor = ThreadPoolExecutor(max_workers=JOB_DOCUMENT_WORKERS, thread_name_prefix="jobs")
+
+# on-disk store of asynchronous translation jobs
+JOBS_DIR = "jobs"
+job_runner = None
+
+# options of a document in batch requests and jobs, defaults are those of GET /translate
+DOCUMENT_OPTIONS = {
+    "merge_en_chunks": False,
+    "replace_doi_terms": False,
+    "translate_by_sentence": False,
+    "max_length": 512,
+    # decoding policy, "" for the models' default
+    "quality": "",
+}
+
+# request headers overriding the priority class of a route (`interactive` or `bulk`)
+# and naming the client for fair queuing, its address by default
+PRIORITY_HEADER = "X-Priority"
+CLIENT_HEADER = "X-Client-Id"
+# addresses whose headers are trusted (--trusted-clients), e.g. a proxy setting X-Client-Id;
+# other clients may only lower their priority and are told apart by address
+TRUSTED_CLIENTS = set()
+
+# token expected in the `X-Admin-Token` header of /admin routes (--admin-token),
+# without one they only answer requests from this host
+ADMIN_TOKEN = None
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+LOCAL_ADDRESSES = {"127.0.0.1", "::1"}
+
 model = None
 api = Flask(__name__)
-CORS(api)
+# /admin routes are not meant for browsers of other origins
+CORS(api, resources=r"^(?!/admin/).*")
 
 api.config['JSON_AS_ASCII'] = False
 
-def init_nemo(config_file_path: str):
+def load_nemo_model(location: str):
+    if location.startswith("NGC/"):
+        model = nemo_nlp.models.machine_translation.MTEncDecModel.from_pretrained(model_name=location[4:])
+    else:
+        model = nemo_nlp.models.machine_translation.MTEncDecModel.restore_from(restore_path=location)
+    if torch.cuda.is_available():
+        model = model.cuda()
+    return model
+
+def count_tokens(model_key: str, text: str):
+    """
+    Returns the number of source tokens of `text` for the model of a model key, without special tokens,
+    counted by the model's tokenizer: NeMo's source tokenizer, vinai's or seamless' text tokenizer.
+    """
+    if len(text) > TOKEN_COUNT_CACHE_MAX_CHARS:
+        return count_tokens_uncached(model_key, text)
+    return count_tokens_cached(model_key, text)
+
+def count_tokens_uncached(model_key: str, text: str):
+    model = MODEL_REGISTRY.get(model_key)
+    if is_nemo_model_key(model_key):
+        # NeMo adds BOS/EOS when batching, not in text_to_ids
+        return len(model.encoder_tokenizer.text_to_ids(text))
+    return model.count_tokens(text)
+
+count_tokens_cached = functools.lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)(count_tokens_uncached)
+
+def set_nemo_decoding(model_key: str, model, decoding, batch: list):
+    """
+    Sets the beam size and the maximum output length of a NeMo model's beam search for a batch,
+    NeMo bounds the output length by source tokens + `max_delta_len`.
+    Without a decoding policy, the settings the model was shipped with are put back.
+    """
+    shipped = NEMO_SHIPPED_DECODING.setdefault(model_key, (model.beam_search.beam_size,
+                                                           model.beam_search.max_delta_len))
+    if decoding is None:
+        model.beam_search.beam_size, model.beam_search.max_delta_len = shipped
+        return
+    num_source_tokens = max(len(model.encoder_tokenizer.text_to_ids(text)) for text in batch)
+    model.beam_search.beam_size = decoding.num_beams
+    model.beam_search.max_delta_len = decoding.max_new_tokens(num_source_tokens) - num_source_tokens
+
+def load_model(model_key: str):
     """
-    Loads 'language-pair to NMT model mapping'
+    Loads the model of a model key with the backend and precision set for it in config.json
     """
-    __MODELS_DICT = None
+    settings = get_model_settings(MODELS_CONFIG, model_key)
+    precision = settings["precision"]
+    if settings["backend"] == "onnx":
+        if model_key != EN2VI_MODEL_KEY:
+            raise ValueError(f"The onnx backend is only available for {EN2VI_MODEL_KEY}, not {model_key}")
+        if precision != "fp32":
+            logging.warning(f"Precision {precision} is not applied to the onnx backend of {model_key}")
+        return My_NMT_En2Vi_ONNX(onnx_dir=settings.get("onnx_dir") or EN2VI_ONNX_DIR)
+    if model_key == SEAMLESS_MODEL_KEY:
+        # seamless converts its weights itself when given a dtype
+        dtype = torch.bfloat16 if precision == "bf16" else None
+        model = My_NMT_T2TT(model_name=settings.get("model") or SEAMLESS_MODEL_NAME, dtype=dtype)
+        if precision == "bf16":
+            return model
+    elif model_key == EN2VI_MODEL_KEY:
+        model = My_NMT_En2Vi(model_name=settings.get("model") or EN2VI_MODEL_NAME)
+    else:
+        model = load_nemo_model(settings["model"])
+    return apply_precision(model, precision)
 
+def get_model_version(model_key: str):
+    """
+    Returns the model location with its backend and precision if not the defaults,
+    part of translation memory keys
+    """
+    settings = get_model_settings(MODELS_CONFIG, model_key)
+    if settings["backend"] != "torch":
+        return f"{settings.get('model')}@{settings['backend']}"
+    if settings["precision"] != "fp32":
+        return f"{settings.get('model')}@{settings['precision']}"
+    return str(settings.get("model"))
+
+def init_nemo(config_file_path: str):
+    """
+    Registers 'language-pair to NMT model mapping', models are loaded on first use
+    """
     logging.info("Starting NMT service")
-    logging.info(f"I will attempt to load all the models listed in {config_file_path}.")
+    logging.info(f"I will load the models listed in {config_file_path} when they're first requested.")
     logging.info(f"Edit {config_file_path} to disable models you don't need.")
     if torch.cuda.is_available():
         logging.info("CUDA is available. Running on GPU")
@@ -62,318 +288,988 @@ def init_nemo(config_file_path: str):
         logging.info("CUDA is not available. Defaulting to CPUs")
 
     # read config
-    with open(config_file_path) as f:
-        __MODELS_DICT = json.load(f)
-
-    if __MODELS_DICT is not None:
-        for key, value in __MODELS_DICT.items():
-            logging.info(f"Loading model for {key} from file: {value}")
-            if value.startswith("NGC/"):
-                model = nemo_nlp.models.machine_translation.MTEncDecModel.from_pretrained(model_name=value[4:])
-            else:
-                model = nemo_nlp.models.machine_translation.MTEncDecModel.restore_from(restore_path=value)
-            if torch.cuda.is_available():
-                model = model.cuda()
-            NEMO_MODELS_DICT[key] = model
-    else:
-        raise ValueError("Did not find the config.json or it was empty")
+    MODELS_CONFIG.update(read_models_config(config_file_path))
+
+    for key, settings in MODELS_CONFIG.items():
+        if not is_nemo_model_key(key):
+            continue
+        logging.info(f"Registering model for {key} from file: {settings['model']} in {settings['precision']}")
+        MODEL_REGISTRY.register(key, lambda key=key: load_model(key), pinned=settings["pinned"])
+        ROUTING_GRAPH.add_model(key, get_model_langpairs(key), settings["routing_weight"])
     logging.info("NMT service started")
 
 def init_nmt_multi():
-    global nmt_multi_model
-    nmt_multi_model = My_NMT_T2TT()
+    settings = get_model_settings(MODELS_CONFIG, SEAMLESS_MODEL_KEY)
+    MODEL_REGISTRY.register(SEAMLESS_MODEL_KEY, lambda: load_model(SEAMLESS_MODEL_KEY), pinned=settings["pinned"])
+    ROUTING_GRAPH.add_model(SEAMLESS_MODEL_KEY, get_model_langpairs(SEAMLESS_MODEL_KEY), settings["routing_weight"])
+
+def init_en2vi():
+    settings = get_model_settings(MODELS_CONFIG, EN2VI_MODEL_KEY)
+    MODEL_REGISTRY.register(EN2VI_MODEL_KEY, lambda: load_model(EN2VI_MODEL_KEY), pinned=settings["pinned"])
+    ROUTING_GRAPH.add_model(EN2VI_MODEL_KEY, get_model_langpairs(EN2VI_MODEL_KEY), settings["routing_weight"])
+
+def get_model_langpairs(model_key: str):
+    """
+    Returns the language pairs a model translates: its "langpairs" setting, or the defaults of its backend
+    """
+    langpairs = get_model_settings(MODELS_CONFIG, model_key)["langpairs"]
+    if langpairs:
+        return langpairs
+    if model_key == EN2VI_MODEL_KEY:
+        return ["en-vi"]
+    if model_key == SEAMLESS_MODEL_KEY:
+        return SEAMLESS_SUPPORTED_LANG_PAIRS
+    return [model_key]
+
+def get_model_langpair(model_key: str):
+    """
+    Returns the source and target language a model is warmed up with
+    """
+    return get_model_langpairs(model_key)[0].split("-")
+
+def warmup_model(model_key: str):
+    """
+    Translates one batch per "warmup_lengths" of the model's settings with its default decoding policy,
+    so that lazy initializations and allocator growth happen before the first request.
+    Batches go through the model's scheduler as bulk traffic, as requests may already be served.
+    """
+    settings = get_model_settings(MODELS_CONFIG, model_key)
+    source_lang, target_lang = get_model_langpair(model_key)
+    text = WARMUP_TEXTS.get(source_lang, WARMUP_TEXTS["en"])
+    decoding = get_model_decoding(model_key)
+    time_s = time.time()
+    for length in settings["warmup_lengths"]:
+        segment = (text * (length // len(text) + 1))[:length]
+        batch_time_s = time.time()
+        get_scheduler(model_key).translate([segment] * settings["warmup_batch_size"], source_lang, target_lang,
+                                           decoding, priority=PRIORITY_BULK, client="warmup")
+        # the last batch runs on a warm model, its latency seeds the routing costs
+        ROUTING_GRAPH.set_latency(model_key, time.time() - batch_time_s, settings["warmup_batch_size"])
+    MODEL_REGISTRY.set_warm(model_key)
+    logging.info(f"Warmed up model {model_key} with lengths {settings['warmup_lengths']} in {time.time() - time_s:.1f}s")
+
+def preload_models(keys: list, warmup: bool = True):
+    """
+    Loads models concurrently, each one is warmed up as soon as it's loaded
+    """
+    with ThreadPoolExecutor(max_workers=PRELOAD_WORKERS) as executor:
+        futures = {executor.submit(MODEL_REGISTRY.get, key): key for key in sorted(keys)}
+        for future in as_completed(futures):
+            future.result()
+            if warmup:
+                warmup_model(futures[future])
+
+def warmup_models(keys: list):
+    for key in sorted(keys):
+        if MODEL_REGISTRY.is_loaded(key):
+            warmup_model(key)
+
+def start_models(keys: list, warmup: bool = True):
+    """
+    Preloads models and records the outcome for /readyz
+    """
+    global startup_error
+    try:
+        preload_models(keys, warmup=warmup)
+    except Exception as ex:
+        startup_error = ex
+        logging.error(f"Failed to load models at start: {ex}")
+        raise
+    finally:
+        startup_done.set()
+
+def get_readiness():
+    """
+    Returns whether the service is ready to translate and the state of each model:
+    ready once the models of the start are loaded and pinned models are warm.
+    """
+    models = {key: {"loaded": MODEL_REGISTRY.is_loaded(key), "warm": MODEL_REGISTRY.is_warm(key),
+                    "pinned": key in MODEL_REGISTRY.pinned}
+              for key in sorted(MODEL_REGISTRY.loaders)}
+    ready = (startup_done.is_set() and startup_error is None
+             and all(state["loaded"] and state["warm"] for state in models.values() if state["pinned"]))
+    return ready, models
+
+def init_worker(worker_id: int, restarted: bool, torch_threads: int):
+    """
+    Runs in each worker process of the pre-fork mode, after the fork: threads,
+    the translation memory database and the job runner are per process.
+    """
+    if torch_threads > 0:
+        torch.set_num_threads(torch_threads)
+    # models are loaded before the fork, warmed up in each worker as torch threads are per process
+    warmup_models(MODEL_REGISTRY.loaders)
+    init_translation_memory()
+    # unfinished jobs are resumed by a single worker, once; the jobs of a worker which crashed
+    # are taken over by another one when their lease expires
+    init_jobs(resume=(worker_id == 0 and not restarted))
+    logging.info(f"Worker {worker_id} started with {torch.get_num_threads()} torch threads")
+
+def schedulers_healthy():
+    """
+    Whether no model call has been running for more than `MAX_MODEL_CALL_SECONDS`,
+    a worker of the pre-fork mode stops its heartbeats otherwise and gets restarted.
+    """
+    return all(scheduler.busy_seconds() < MAX_MODEL_CALL_SECONDS for scheduler in list(SCHEDULERS.values()))
+
+def init_translation_memory(db_path: str = TRANSLATION_MEMORY_DB):
+    global translation_memory
+    translation_memory = TranslationMemory(max_entries=TRANSLATION_MEMORY_SIZE, db_path=db_path)
+    # entries put within the last write interval
+    atexit.register(translation_memory.flush)
+
+def init_jobs(jobs_dir: str = JOBS_DIR, resume: bool = True):
+    global job_runner
+    # jobs run in the background, their documents wait for memory instead of failing
+    job_runner = JobRunner(JobStore(jobs_dir),
+                           lambda documents, on_document_done: translate_documents(documents, on_document_done,
+                                                                                   wait_for_memory=True,
+                                                                                   client="jobs",
+                                                                                   executor=jobs_executor),
+                           resume=resume)
+
+def queued_segments(model_key: str):
+    scheduler = SCHEDULERS.get(model_key)
+    return scheduler.queue.qsize() if scheduler is not None else 0
+
+def get_scheduler(model_key: str):
+    """
+    Returns the batching scheduler of a model key: a NeMo langpair, `SEAMLESS_MODEL_KEY` or `EN2VI_MODEL_KEY`.
+    All requests share it, so segments of concurrent requests are translated together.
+    """
+    with schedulers_lock:
+        if model_key not in SCHEDULERS:
+            # the model is looked up for each batch as it may have been unloaded in the meantime
+            translate_fn = lambda batch, source_lang, target_lang, decoding: \
+                translate_batch(model_key, batch, source_lang, target_lang, decoding)
+
+            # micro-batches are made of segments with close numbers of tokens, which keeps padding low
+            length_fn = lambda text: count_tokens(model_key, text)
+
+            settings = get_model_settings(MODELS_CONFIG, model_key)
+            SCHEDULERS[model_key] = BatchScheduler(model_key, translate_fn,
+                                                   max_batch_size=settings["max_batch_size"],
+                                                   max_wait_ms=settings["max_wait_ms"],
+                                                   max_batch_tokens=settings["max_batch_tokens"],
+                                                   length_fn=length_fn)
+        return SCHEDULERS[model_key]
+
+def run_model(model_key: str, model, batch: list, source_lang: str, target_lang: str, decoding=None):
+    # seamless and en2vi models take the decoding policy, nemo models are set up for it
+    if not is_nemo_model_key(model_key):
+        return model.translate(batch, source_lang=source_lang, target_lang=target_lang, decoding=decoding)
+    set_nemo_decoding(model_key, model, decoding, batch)
+    return model.translate(batch, source_lang=source_lang, target_lang=target_lang)
+
+def translate_batch(model_key: str, batch: list, source_lang: str, target_lang: str, decoding=None):
+    """
+    Translates a batch with the model of a model key and a `decoding.DecodingPolicy`
+    """
+    model = MODEL_REGISTRY.get(model_key)
+    time_s = time.time()
+    translations = run_model(model_key, model, batch, source_lang, target_lang, decoding)
+    duration = time.time() - time_s
+    model_batch_seconds.observe(duration, model=model_key)
+    model_batch_size.observe(len(batch), model=model_key)
+    ROUTING_GRAPH.record_latency(model_key, duration, len(batch))
+    return translations
+
+def get_model_decoding(model_key: str, quality: str = None):
+    """
+    Returns the decoding policy of a request's `quality`, or the model's one from config.json,
+    None to decode as the model was shipped.
+    """
+    quality = quality or get_model_settings(MODELS_CONFIG, model_key)["quality"]
+    return get_decoding_policy(quality) if quality else None
+
+def iter_translate_with_model(model_key: str, segments: list, source_lang: str, target_lang: str, tm_counts: dict,
+                              quality: str = None, scope: CancelScope = None,
+                              priority: str = PRIORITY_INTERACTIVE, client: str = ""):
+    """
+    Translates segments with a model, reusing the translation memory, and yields
+    the translations in order as soon as they are ready.
+    Only the segments missing from the memory go through the model's scheduler.
+    `tm_counts` accumulates the request's translation memory hits and misses.
+    Raises TranslationCancelled if `scope` is cancelled, its segments still queued are dropped.
+    `priority` and `client` place the segments in the scheduler's fair queue.
+    """
+    model_version = get_model_version(model_key)
+    langpair = f"{source_lang}-{target_lang}"
+    decoding = get_model_decoding(model_key, quality)
+
+    translations = [""] * len(segments)
+    keys, missing = {}, []
+    for i, segment in enumerate(segments):
+        if is_empty_segment(segment):
+            continue
+        keys[i] = TranslationMemory.make_key(model_key, model_version, langpair,
+                                             decoding.name if decoding is not None else "", segment)
+        cached = translation_memory.get(keys[i])
+        if cached is None:
+            missing.append(i)
+        else:
+            translations[i] = cached
+
+    tm_counts["hits"] += len(keys) - len(missing)
+    tm_counts["misses"] += len(missing)
+
+    # identical segments of the document are translated once, by their first occurrence
+    first_index = {}
+    for i in missing:
+        first_index.setdefault(keys[i], i)
+    unique = sorted(first_index.values())
+    if len(unique) < len(missing):
+        duplicate_segments.inc(len(missing) - len(unique))
+
+    futures = {}
+    if len(unique) > 0:
+        unique_futures = dict(zip(unique, get_scheduler(model_key).submit([segments[i] for i in unique],
+                                                                          source_lang, target_lang, decoding,
+                                                                          priority, client)))
+        futures = {i: unique_futures[first_index[keys[i]]] for i in missing}
+        if scope is not None:
+            scope.track(list(unique_futures.values()))
 
-def write_response(content: str):
+    for i in range(len(segments)):
+        if i in futures:
+            translations[i] = futures[i].result() if scope is None else scope.result(futures[i])
+            if first_index[keys[i]] == i:
+                translation_memory.put(keys[i], translations[i])
+        yield translations[i]
+
+def iter_timed(items, stage_timings: dict, stage: str):
+    """
+    Yields the items of an iterable, adding the time spent waiting for them to `stage_timings[stage]`
+    """
+    iterator = iter(items)
+    while True:
+        time_s = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            stage_timings[stage] += time.time() - time_s
+        yield item
+
+def translate_with_model(model_key: str, segments: list, source_lang: str, target_lang: str, tm_counts: dict,
+                         quality: str = None, scope: CancelScope = None,
+                         priority: str = PRIORITY_INTERACTIVE, client: str = ""):
+    return list(iter_translate_with_model(model_key, segments, source_lang, target_lang, tm_counts, quality, scope,
+                                          priority, client))
+
+def resolve_request_flow(headers, remote_addr: str, default_priority: str):
+    """
+    Returns the priority class and client of a request from its headers and address,
+    raises ValueError for an unknown priority.
+    Only `TRUSTED_CLIENTS` may raise the priority of a route or name their clients.
+    """
+    priority = headers.get(PRIORITY_HEADER, default_priority).lower()
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority {priority}, expected one of {PRIORITIES}")
+    remote_addr = remote_addr or ""
+    if remote_addr not in TRUSTED_CLIENTS:
+        # the most urgent of the route's class and the requested one is ignored
+        priority = PRIORITIES[max(PRIORITIES.index(priority), PRIORITIES.index(default_priority))]
+        return priority, remote_addr
+    return priority, headers.get(CLIENT_HEADER) or remote_addr
+
+def get_request_flow(default_priority: str):
+    """
+    Returns the priority class and client of the current request, see `resolve_request_flow`.
+    """
+    return resolve_request_flow(request.headers, request.remote_addr, default_priority)
+
+def write_response(content: str, route: dict = None):
     res = {'translation': content}
+    if route is not None:
+        res['route'] = route
     response = flask.jsonify(res, )
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response
 
-def free_cache(used_thresh: int = 0.5):
-    # delete cache data from GPU if the used memory larger than 50% out of total
-    memory_info = torch.cuda.mem_get_info()
-    free = memory_info[0]
-    total = memory_info[1]
+def too_many_requests(ex: MemoryBudgetExceeded):
+    response = flask.jsonify({'error': str(ex)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(ex.retry_after)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
 
-    if free/total < used_thresh:
-        torch.cuda.empty_cache()
+def admit_request(src_text: str, max_length: int = 64, block: bool = False):
+    """
+    Reserves the estimated memory of a request, from its number of segments and length, and returns the
+    reservation to release once it's done. Raises MemoryBudgetExceeded if it doesn't fit in time, see `MemoryGovernor`.
+    """
+    # at least a segment per line or per `max_length` characters, the text isn't split twice for an estimate
+    num_segments = max(src_text.count("\n") + 1, math.ceil(len(src_text) / max(max_length, 1)))
+    return memory_governor.admit(memory_governor.estimate(num_segments, len(src_text)), block=block)
 
 def merge_english_chunks(translated_en_paragraphs: list, ext_characters: list):
-    merged_paragraphs = []
-    merged_ext_characters = []
-    cur_paragraph = ""
-    last_ext_character = ""
+    merger = EnglishChunkMerger()
+    merged = []
     for p,ext in zip(translated_en_paragraphs, ext_characters):
-        if p.strip() != "" and (last_ext_character.strip() == "," or last_ext_character.startswith("\"")):
-            p = p[0].lower() + p[1:]
-        if ext.strip() == ".":
-            cur_paragraph += (p.strip() + ext.strip())
-            merged_paragraphs.append(cur_paragraph)
-            # make empty list of ext_characters to have the same structure
-            # as not merging english chunks
-            merged_ext_characters.append(' ') 
-            cur_paragraph = ""
-        else:
-            cur_paragraph += (p.strip() + ext)
-        
-        last_ext_character = ext
-    # check very last chunk
-    if cur_paragraph.strip() != "":
-        merged_paragraphs.append(cur_paragraph.strip())
-        # make empty list of ext_characters to have the same structure 
-        # as not merging english chunks
-        merged_ext_characters.append('')
-    
+        merged.extend(merger.push(p, ext))
+    merged.extend(merger.flush())
+
+    merged_paragraphs = [p for p, _ in merged]
+    merged_ext_characters = [ext for _, ext in merged]
     return merged_paragraphs, merged_ext_characters
 
+def split_source_text(src_text: str, src_lang: str,
+                      translate_by_sentence: bool = True,
+                      max_length: int = 64,
+                      model_key: str = None):
+    """
+    Splits source text into paragraphs and the characters to put back after each translated paragraph,
+    with the punctuation of the source language, see `segmentation.LANGUAGE_PROFILES`.
+    When translating by chunks for a model with "max_segment_tokens" in config.json, paragraphs are packed
+    up to that many tokens of the model's tokenizer instead of `max_length` characters.
+    """
+    length_fn = len
+    if not translate_by_sentence and model_key is not None:
+        max_segment_tokens = get_model_settings(MODELS_CONFIG, model_key)["max_segment_tokens"]
+        if max_segment_tokens:
+            length_fn = lambda text: count_tokens(model_key, text)
+            max_length = max_segment_tokens
+    return split_text(src_text, src_lang, translate_by_sentence=translate_by_sentence, max_length=max_length,
+                      length_fn=length_fn)
+
+def iter_translate(src_text: str, langpair: str, 
+                   merge_en_chunks: bool = True, 
+                   replace_doi_terms: bool = True,
+                   translate_by_sentence: bool = True, 
+                   max_length: int = 64,
+                   quality: str = None,
+                   scope: CancelScope = None,
+                   priority: str = PRIORITY_INTERACTIVE,
+                   client: str = ""):
+    """
+    Translates a document and yields each translated paragraph as soon as it's ready, in order:
+    {"index", "translation", "ext_character"}. The last item carries the assembled translation,
+    timings and route: {"done": True, "translation", "timings", "route"}, with the seconds spent in each stage under
+    timings["stages"] (src->en and en->vi overlap in pivot translation, their sum may exceed the total)
+    and the models translating the document under route["hops"], see `routing.RoutingGraph`.
+    `quality` is the decoding policy, "fast", "balanced" or "best", the models' default if not given.
+    Raises ValueError if there's no model for the language pair or the quality is unknown,
+    TranslationCancelled if `scope` is cancelled or its deadline passes: checked between segments and batches.
+    `priority` (`PRIORITY_INTERACTIVE` or `PRIORITY_BULK`) and `client` schedule the segments fairly with other requests.
+    """
+    time_s = time.time()
+    tm_counts = {"hits": 0, "misses": 0}
+    stage_timings = dict.fromkeys(PIPELINE_STAGES, 0.0)
+
+    if quality:
+        get_decoding_policy(quality)
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority {priority}, expected one of {PRIORITIES}")
+
+    # if there's no text to translate
+    if len(src_text.strip()) == 0:
+        yield {"done": True, "translation": "", "timings": {"first_paragraph": 0, "total": 0, "stages": stage_timings}}
+        return
+
+    src_lang = langpair.split('-')[0]
+    dest_lang = langpair.split('-')[1]
+
+    # cheapest chain of models for the language pair by their measured latency, e.g. zh-en then en2vi for zh-vi
+    try:
+        route = ROUTING_GRAPH.find_route(src_lang, dest_lang)
+    except ValueError as ex:
+        logging.error(str(ex))
+        raise
+    hops = route.hops
+    logging.info(f"Route of {langpair}: {route.to_dict()}")
+
+    # whether to merge english chunks before the last model of a pivot route, e.g. en->vi
+    is_merge_english_chunks = merge_en_chunks and len(hops) > 1 and hops[-1][1] == 'en'
+
+    # remove troll characters from text if exists
+    stage_s = time.time()
+    src_text = remove_troll_characters(src_text)
+    stage_timings["cleanup"] += time.time() - stage_s
+
+    # ---------------------------------------------
+    # replace special terms for given language
+    # ---------------------------------------------
+    stage_s = time.time()
+    if replace_doi_terms:
+        src_text = replace_terms(src_text, lang=src_lang)
+    stage_timings["term_replacement"] += time.time() - stage_s
+
+    stage_s = time.time()
+    paragraphs, ext_characters = split_source_text(src_text, src_lang,
+                                                   translate_by_sentence=translate_by_sentence,
+                                                   max_length=max_length,
+                                                   model_key=hops[0][0])
+    stage_timings["segmentation"] += time.time() - stage_s
+
+    # print ('>>> paragraphs splitted: ', paragraphs)
+    logging.info(f"paragraphs: {paragraphs}")
+    logging.info(f"ext_characters: {ext_characters}")
+
+    def hop_stage(hop_index: int):
+        # stages are named after the usual pivot route: every model but the last one is src->en, the last one en->vi
+        if hop_index == len(hops) - 1 and (len(hops) > 1 or hops[0][0] == EN2VI_MODEL_KEY):
+            return "en_vi"
+        return "src_en"
+
+    def is_cleaned(hop_index: int):
+        # translations are cleaned of punctuations and quotations,
+        # except merged sentences and those of en2vi on its own
+        if hop_index < len(hops) - 1:
+            return True
+        return not is_merge_english_chunks and not (len(hops) == 1 and hops[0][0] == EN2VI_MODEL_KEY)
+
+    # same interface for nemo, seamless and en2vi models,
+    # the model's scheduler sorts paragraphs of this and concurrent requests
+    # by length into micro-batches and hands the translations back in order
+    def translate_hop(hop_index: int, batch: list, counts: dict):
+        model_key, source_lang, target_lang = hops[hop_index]
+        stage_s = time.time()
+        translated = translate_with_model(model_key, batch, source_lang, target_lang, counts, quality, scope,
+                                          priority, client)
+        stage_timings[hop_stage(hop_index)] += time.time() - stage_s
+        if is_cleaned(hop_index):
+            translated = [p.strip('." ') for p in translated]
+        return translated
+
+    def translate_hops(first: int, last: int, counts: dict):
+        # translates a batch through the models of hops first..last-1, one after the other
+        def translate_fn(batch: list):
+            for hop_index in range(first, last):
+                batch = translate_hop(hop_index, batch, counts)
+            return batch
+        return translate_fn
+
+    def iter_translate_hops(first: int, last: int, segments: list, counts: dict):
+        # translates segments through the models of hops first..last-1, all segments of a hop are submitted
+        # to its scheduler at once, the translations of the last one are yielded in order as soon as they're ready
+        for hop_index in range(first, last - 1):
+            segments = translate_hop(hop_index, segments, counts)
+        model_key, source_lang, target_lang = hops[last - 1]
+        translations = iter_timed(iter_translate_with_model(model_key, segments, source_lang, target_lang, counts,
+                                                            quality, scope, priority, client),
+                                  stage_timings, hop_stage(last - 1))
+        for translated in translations:
+            yield translated.strip('." ') if is_cleaned(last - 1) else translated
+
+    # the first stage of pivot translation runs on its own thread
+    stage1_tm_counts = {"hits": 0, "misses": 0}
+
+    if len(hops) == 1:
+        # paragraphs are batched together with those of concurrent requests
+        translated_pairs = zip(iter_translate_hops(0, 1, paragraphs, tm_counts), ext_characters)
+    else:
+        # segments (or merged english sentences) go on to the last model as soon as the previous ones are done,
+        # overlapping the models instead of running them one after the other
+        translated_pairs = iter_pivot_pipeline(iter_translate_hops(0, len(hops) - 1, paragraphs, stage1_tm_counts),
+                                               ext_characters,
+                                               second_stage_fn=translate_hops(len(hops) - 1, len(hops), tm_counts),
+                                               merge_chunks=is_merge_english_chunks)
+
+    translated_paragraphs = []
+    translated_text = ""
+    first_paragraph_time = None
+    for idx, (text, ext_chr) in enumerate(translated_pairs):
+        if scope is not None:
+            scope.check()
+        stage_s = time.time()
+        if first_paragraph_time is None:
+            first_paragraph_time = time.time() - time_s
+        translated_paragraphs.append(text)
+        # if text.strip(" ") != "" and last_ext_chr.strip(" ") == comma_en:
+        #     text = text[0].lower() + text[1:]               
+        translated_text += (text.strip(" ") + ext_chr)
+        stage_timings["assembly"] += time.time() - stage_s
+        yield {"index": idx, "translation": text.strip(" "), "ext_character": ext_chr}
+
+    logging.info(f"translated_paragraphs: {translated_paragraphs}")
+
+    # strip last space character
+    stage_s = time.time()
+    translated_text = translated_text.strip(" ")
+    stage_timings["assembly"] += time.time() - stage_s
+
+    for k in tm_counts:
+        tm_counts[k] += stage1_tm_counts[k]
+
+    duration = time.time() - time_s
+    logging.info(
+        f"Translated in {duration}\nInput was: {src_text}\nTranslation was: {translated_text}"
+    )
+    logging.info(f"Translation memory: {tm_counts['hits']} hits, {tm_counts['misses']} misses")
+
+    # try to free cache if necessary
+    release_cuda_cache()
+
+    yield {"done": True,
+           "translation": translated_text,
+           "timings": {"first_paragraph": first_paragraph_time or duration, "total": duration, "stages": stage_timings},
+           "route": route.to_dict()}
+
+def metrics_langpair(langpair: str):
+    # anything but a language pair shares one label value, so that label values stay bounded
+    return langpair if re.fullmatch("[a-z]{2}-[a-z]{2}", langpair) else "other"
+
+def record_request_metrics(langpair: str, success: bool, segments: int = 0, done_event: dict = None):
+    requests_total.inc(langpair=metrics_langpair(langpair), outcome="success" if success else "error")
+    if done_event is not None:
+        record_pipeline_metrics(langpair, segments, done_event)
+
+def record_pipeline_metrics(langpair: str, segments: int, done_event: dict):
+    """
+    Records the duration, segments and stage timings of a pipeline run, once for the requests sharing it.
+    """
+    langpair = metrics_langpair(langpair)
+    request_seconds.observe(done_event["timings"]["total"], langpair=langpair)
+    request_segments.observe(segments, langpair=langpair)
+    for stage, seconds in done_event["timings"]["stages"].items():
+        stage_seconds.observe(seconds, stage=stage)
+
+def collect_service_metrics():
+    """
+    Updates the metrics read from the schedulers, the translation memory and the model registry
+    """
+    scheduler_queue_depth.clear()
+    dropped_segments.clear()
+    preempted_segments.clear()
+    scheduled_segments.clear()
+    scheduler_wait_seconds.clear()
+    for key, scheduler in list(SCHEDULERS.items()):
+        scheduler_stats = scheduler.stats()
+        scheduler_queue_depth.set(scheduler_stats["queue_depth"], model=key)
+        dropped_segments.set(scheduler_stats["dropped"], model=key)
+        preempted_segments.set(scheduler_stats["preempted"], model=key)
+        for priority, priority_stats in scheduler_stats["priorities"].items():
+            scheduled_segments.set(priority_stats["segments"], model=key, priority=priority)
+            scheduler_wait_seconds.set(priority_stats["wait_seconds"], model=key, priority=priority)
+
+    tm_stats = translation_memory.stats()
+    tm_lookups.set(tm_stats["hits"] - tm_stats["disk_hits"], result="hit")
+    tm_lookups.set(tm_stats["disk_hits"], result="disk_hit")
+    tm_lookups.set(tm_stats["misses"], result="miss")
+    tm_hit_rate.set(tm_stats["hit_rate"])
+    tm_entries.set(tm_stats["entries"])
+
+    coalesced_requests.set(translate_flights.stats()["coalesced"])
+
+    memory_stats = memory_governor.stats()
+    admissions.set(memory_stats["admitted"], result="admitted")
+    admissions.set(memory_stats["rejected"], result="rejected")
+    admission_waits.set(memory_stats["queued"])
+    process_memory_bytes.clear()
+    for device_type, size in memory_stats["usage"].items():
+        process_memory_bytes.set(size, device=device_type)
+    reserved_memory_bytes.clear()
+    for device_type, size in memory_stats["reserved"].items():
+        reserved_memory_bytes.set(size, device=device_type)
+
+    model_stats = MODEL_REGISTRY.stats()
+    model_memory_bytes.clear()
+    for key, memory in model_stats["memory"].items():
+        for device_type, size in memory.items():
+            model_memory_bytes.set(size, model=key, device=device_type)
+    models_loaded.clear()
+    for key in MODEL_REGISTRY.loaders:
+        models_loaded.set(1 if key in model_stats["loaded"] else 0, model=key)
+
+def run_translate(src_text: str, langpair: str, wait_for_memory: bool = False, **options):
+    """
+    Runs the pipeline of `translate` once admitted by the memory governor,
+    returns the number of translated segments and the final event
+    """
+    with admit_request(src_text, options["max_length"], block=wait_for_memory):
+        segments = 0
+        for event in iter_translate(src_text, langpair, **options):
+            if not event.get("done"):
+                segments += 1
+    # once per run, the identical requests which waited for it are counted as coalesced
+    record_pipeline_metrics(langpair, segments, event)
+    return segments, event
+
 def translate(src_text: str, langpair: str, 
               merge_en_chunks: bool = True, 
               replace_doi_terms: bool = True,
               translate_by_sentence: bool = True, 
-              max_length: int = 64):
+              max_length: int = 64,
+              quality: str = None,
+              wait_for_memory: bool = False,
+              scope: CancelScope = None,
+              priority: str = PRIORITY_INTERACTIVE,
+              client: str = "",
+              metadata: dict = None):
+    """
+    Translates a document, returns whether it succeeded and the translation or the error.
+    `metadata`, if given, gets the routing decision of a successful translation under "route".
+    Raises MemoryBudgetExceeded if there's no memory for it, unless `wait_for_memory` which waits as long as needed,
+    and TranslationCancelled if `scope` is cancelled.
+    Batch scripts should pass `priority=PRIORITY_BULK` so that they don't slow down interactive users.
+    """
+    options = {
+        "merge_en_chunks": merge_en_chunks,
+        "replace_doi_terms": replace_doi_terms,
+        "translate_by_sentence": translate_by_sentence,
+        "max_length": max_length,
+        "quality": quality,
+    }
     try:
-        # if there's no text to translate
-        if len(src_text.strip()) == 0:
-            return write_response("")
-            
-        src_lang = langpair.split('-')[0]
-        dest_lang = langpair.split('-')[1]
-
-        # whether to merge english chunks before translating from en to vi
-        is_merge_english_chunks = merge_en_chunks
-        # translate by sentence or by chunk of texts
-        is_translate_by_sentence = translate_by_sentence
-        
-        time_s = time.time()
-        max_length = max_length
-
-        # remove troll characters from text if exists
-        src_text = remove_troll_characters(src_text)
-
-        # ---------------------------------------------
-        # replace special terms for given language
-        # ---------------------------------------------
-        if replace_doi_terms:
-            src_text = replace_doi_terms(src_text, lang=src_lang)
-
-        print ("replaced src text:", src_text)
-
-        if src_lang == "zh":
-            period_char = "。"
-            comma_char = "，"
-            open_quotes: str =  '“‘『「'
-            close_quotes: str = '”’』」'
-        elif src_lang == "jp":
-            period_char = "。"
-            comma_char = "，"
-            open_quotes: str =  '“‘『「'
-            close_quotes: str = '”’』」'
-        elif src_lang == "km":
-            period_char = "។"
-            comma_char = ","
-            open_quotes: str =  '«“'
-            close_quotes: str = '»”'
-        elif src_lang == "lo":
-            period_char = "."
-            comma_char = ","
-            open_quotes: str =  '“'
-            close_quotes: str = '”'
-        else:
-            period_char = "."
-            comma_char = ","
-            open_quotes: str =  '"'
-            close_quotes: str = '"'
-        
-        # This is something kind of headache, considering `en` as proxy language
-        # if target language is `vi`
-        use_en2vi = False
-        only_en2vi = False
-        if dest_lang == "vi":
-            use_en2vi = True
-            if src_lang == 'en':
-                only_en2vi = True
-            else:
-                # update langpair to `-en`
-                langpair = f'{src_lang}-en'
-                dest_lang = 'en'
-        
-        if only_en2vi:
-            if not is_translate_by_sentence:
-                # deal with long source text
-                # bool array `paragaph_flags` with same length as `passages` array 
-                # indicating if passage at index `i` of `passages` finishes current paragraph
-                # and the next passage will belong to a new paragraph
-                paragraphs, ext_characters = split_long_text(src_text, 
-                                                            max_length=max_length, 
-                                                            period_char=period_char)
-            else:
-                paragraphs, ext_characters = split_long_text_by_sentence_and_quotation(
-                                                    long_text=src_text, 
-                                                    period_char=period_char,
-                                                    comma_char=comma_char,
-                                                    open_quotes=open_quotes,
-                                                    close_quotes=close_quotes)
-
-            translated_to_vi_paragraphs = []
-            for p in paragraphs: 
-                if p.strip(" ") == "":
-                    translated_p = [""]
-                else:
-                    translated_p = translate_en2vi([p])
-                
-                # if not is_merge_english_chunks:
-                #     # clean punctuations and quotations
-                #     translated_p[0] = translated_p[0].strip('." ')
-
-                translated_to_vi_paragraphs.extend(translated_p)
-            translated_paragraphs = translated_to_vi_paragraphs
-
-            logging.info(f"translated_to_vi_paragraphs: {translated_paragraphs}")                
-
-            translated_text = ""
-            last_ext_chr = ""
-            comma_en = ","
-            for text, ext_chr in zip(translated_paragraphs, ext_characters): 
-                # if text.strip(" ") != "" and last_ext_chr.strip(" ") == comma_en:
-                #     text = text[0].lower() + text[1:]               
-                translated_text += (text.strip(" ") + ext_chr)
-                last_ext_chr = ext_chr
-
-            # strip last space character
-            translated_text = translated_text.strip(" ")
-
-            duration = time.time() - time_s
-            logging.info(
-                f"Translated in {duration}\nInput was: {src_text}\nTranslation was: {translated_text}"
-            )
-
-            # try to free cache if necessary
-            free_cache()
-            translate_success = True
-            return translate_success, translated_text
+        if scope is not None:
+            # not shared, cancelling one request must not fail identical ones
+            segments, event = run_translate(src_text, langpair, wait_for_memory, scope=scope,
+                                            priority=priority, client=client, **options)
         else:
-            # set mt model
-            mt_model = None
-            if langpair in NEMO_MODELS_DICT:
-                mt_model = NEMO_MODELS_DICT[langpair]
-            elif langpair in SEAMLESS_SUPPORTED_LANG_PAIRS:
-                mt_model = nmt_multi_model
-            else:
-                logging.error(f"Got the following langpair: {langpair} which was not found")
-
-            if mt_model is not None:
-                if not is_translate_by_sentence:
-                    # deal with long source text
-                    # bool array `paragaph_flags` with same length as `passages` array 
-                    # indicating if passage at index `i` of `passages` finishes current paragraph
-                    # and the next passage will belong to a new paragraph
-                    paragraphs, ext_characters = split_long_text(src_text, 
-                                                                max_length=max_length, 
-                                                                period_char=period_char)
-                else:
-                    paragraphs, ext_characters = split_long_text_by_sentence_and_quotation(
-                                                        long_text=src_text, 
-                                                        period_char=period_char,
-                                                        comma_char=comma_char,
-                                                        open_quotes=open_quotes,
-                                                        close_quotes=close_quotes)
-
-                # print ('>>> paragraphs splitted: ', paragraphs)
-                logging.info(f"paragraphs: {paragraphs}")
-                logging.info(f"ext_characters: {ext_characters}")
-                
-                # same interface for both nemo and seamless models
-                # due to missing translation with batch translation 
-                # we translate single paragraph at a time and combine them
-                translated_paragraphs = []
-                for p in paragraphs:
-                    if p.strip(" ") == "":
-                        translated_p = [""]
-                    else:
-                        translated_p = mt_model.translate([p],
-                                                source_lang=src_lang, 
-                                                target_lang=dest_lang)
-                    
-                    # clean punctuations and quotations
-                    translated_p[0] = translated_p[0].strip('." ')
-                    
-                    translated_paragraphs.extend(translated_p)            
-
-                logging.info(f"translated_paragraphs: {translated_paragraphs}")
-                
-                # check if we need to translate to vi
-                if use_en2vi:
-                    if is_merge_english_chunks:
-                        translated_paragraphs, ext_characters = merge_english_chunks(translated_paragraphs, ext_characters)
-
-                        print ("> After merging:\n> translated_paragraphs: ", translated_paragraphs)
-                        print ("> > ext_characters: ", ext_characters)
-
-                    translated_to_vi_paragraphs = []
-                    for p in translated_paragraphs: 
-                        if p.strip(" ") == "":
-                            translated_p = [""]
-                        else:
-                            translated_p = translate_en2vi([p])
-                        
-                        if not is_merge_english_chunks:
-                            # clean punctuations and quotations
-                            translated_p[0] = translated_p[0].strip('." ')
-
-                        translated_to_vi_paragraphs.extend(translated_p)
-                    translated_paragraphs = translated_to_vi_paragraphs
-
-                    logging.info(f"translated_to_vi_paragraphs: {translated_to_vi_paragraphs}")
-
-                translated_text = ""
-                last_ext_chr = ""
-                comma_en = ","
-                for text, ext_chr in zip(translated_paragraphs, ext_characters): 
-                    # if text.strip(" ") != "" and last_ext_chr.strip(" ") == comma_en:
-                    #     text = text[0].lower() + text[1:]               
-                    translated_text += (text.strip(" ") + ext_chr)
-                    last_ext_chr = ext_chr
-
-                # strip last space character
-                translated_text = translated_text.strip(" ")
-
-                duration = time.time() - time_s
-                logging.info(
-                    f"Translated in {duration}\nInput was: {src_text}\nTranslation was: {translated_text}"
-                )
-
-                # try to free cache if necessary
-                free_cache()
-                translate_success = True
-                return translate_success, translated_text
-            else:
-                translate_success = False
-                return translate_success, f"ERROR! Got the following langpair: {langpair} which was not found."
+            # a request identical to one in progress waits for its translation instead of running again,
+            # unless it's more urgent
+            key = (src_text, langpair, priority) + tuple(sorted(options.items()))
+            segments, event = translate_flights.do(key, lambda: run_translate(src_text, langpair, wait_for_memory,
+                                                                              priority=priority, client=client,
+                                                                              **options))
+        translate_success = True
+        record_request_metrics(langpair, translate_success)
+        if metadata is not None and "route" in event:
+            metadata["route"] = event["route"]
+        return translate_success, event["translation"]
+    except MemoryBudgetExceeded:
+        # counted by the memory governor, the client is asked to retry later
+        raise
+    except TranslationCancelled as ex:
+        cancelled_requests.inc(reason=ex.reason)
+        raise
     except Exception as ex:
         translate_success = False
+        record_request_metrics(langpair, translate_success)
         return translate_success, f"ERROR! {ex}" 
 
+def parse_document(document: dict):
+    """
+    Validates a document of a batch request or job and returns the arguments of `translate`.
+    """
+    if not isinstance(document, dict):
+        raise ValueError("A document must be an object with `text` and `langpair`")
+    if not isinstance(document.get("text"), str) or not isinstance(document.get("langpair"), str):
+        raise ValueError("A document must have string `text` and `langpair`")
+
+    kwargs = {"src_text": document["text"], "langpair": document["langpair"]}
+    for option, default in DOCUMENT_OPTIONS.items():
+        value = document.get(option, default)
+        if type(value) != type(default):
+            raise ValueError(f"`{option}` must be a {type(default).__name__}")
+        kwargs[option] = value
+    if kwargs["quality"]:
+        get_decoding_policy(kwargs["quality"])
+    return kwargs
+
+def translate_document(document: dict, wait_for_memory: bool = False,
+                       priority: str = PRIORITY_BULK, client: str = ""):
+    """
+    Returns the result of a document of a batch, with an `error` and `retry_after` if it didn't fit in memory.
+    """
+    metadata = {}
+    try:
+        success, translated_text = translate(**parse_document(document), wait_for_memory=wait_for_memory,
+                                             priority=priority, client=client, metadata=metadata)
+    except MemoryBudgetExceeded as ex:
+        # the other documents of the batch go on
+        return {"success": False, "translation": "", "error": str(ex), "retry_after": ex.retry_after}
+    return dict({"success": success, "translation": translated_text}, **metadata)
+
+def translate_documents(documents: list, on_document_done=None, wait_for_memory: bool = False,
+                        priority: str = PRIORITY_BULK, client: str = "", executor: ThreadPoolExecutor = None):
+    """
+    Translates documents concurrently, calls `on_document_done(index, result)`
+    as each one finishes and returns the results in order.
+    A document which doesn't fit in memory fails with an `error`, unless `wait_for_memory`.
+    Documents are bulk traffic by default, translated when interactive requests leave room.
+    At most `DOCUMENT_WORKERS` documents are in flight, unless another `executor` is given.
+    """
+    executor = executor or documents_executor
+    futures = {executor.submit(translate_document, document, wait_for_memory, priority, client): idx
+               for idx, document in enumerate(documents)}
+    results = [None] * len(documents)
+    for future in as_completed(futures):
+        idx = futures[future]
+        results[idx] = future.result()
+        if on_document_done is not None:
+            on_document_done(idx, results[idx])
+    return results
+
+def read_documents():
+    """
+    Reads the JSON array of documents of a POST request, raises ValueError if it's invalid.
+    """
+    documents = request.get_json(silent=True)
+    if not isinstance(documents, list) or len(documents) == 0:
+        raise ValueError("Expected a non-empty JSON array of documents")
+    for document in documents:
+        parse_document(document)
+    return documents
+
+def job_status(job: dict):
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'total': job['total'],
+        'completed': job['completed'],
+        'progress': job['completed'] / job['total'] if job['total'] else 1.0,
+        'error': job.get('error'),
+    }
+
 @api.route('/translate', methods=['GET'])
 def get_translation():
     try:
         src_text = request.args["text"]   
         langpair = request.args["langpair"]
+        # decoding policy: fast, balanced or best
+        quality = request.args.get("quality")
+        priority, client = get_request_flow(PRIORITY_INTERACTIVE)
+        metadata = {}
         
         success, translated_text = translate(src_text, langpair, 
                                     replace_doi_terms=False,
                                     merge_en_chunks=False,
                                     translate_by_sentence=False,
-                                    max_length=512)
+                                    max_length=512,
+                                    quality=quality,
+                                    priority=priority,
+                                    client=client,
+                                    metadata=metadata)
 
         if success:        
-            return write_response(translated_text)
+            return write_response(translated_text, metadata.get("route"))
         else:
             return write_response("")
         
+    except MemoryBudgetExceeded as ex:
+        return too_many_requests(ex)
     except Exception as ex:
         return write_response("")
 
+@api.route('/translate/stream', methods=['GET'])
+def get_translation_stream():
+    """
+    Same as /translate but streams server-sent events: one per translated paragraph
+    ({"index", "translation", "ext_character"}, concatenate `translation + ext_character`
+    in order) as soon as it's ready, then {"done": true, "translation", "timings"}.
+    """
+    src_text = request.args.get("text", "")
+    langpair = request.args.get("langpair", "")
+    quality = request.args.get("quality")
+    try:
+        priority, client = get_request_flow(PRIORITY_INTERACTIVE)
+    except ValueError as ex:
+        return flask.jsonify({'error': str(ex)}), 400
+
+    # admitted before the response starts, so that a rejection can still be a 429
+    try:
+        reservation = admit_request(src_text, max_length=512)
+    except MemoryBudgetExceeded as ex:
+        return too_many_requests(ex)
+
+    def generate():
+        segments = 0
+        try:
+            for event in iter_translate(src_text, langpair,
+                                        replace_doi_terms=False,
+                                        merge_en_chunks=False,
+                                        translate_by_sentence=False,
+                                        max_length=512,
+                                        quality=quality,
+                                        priority=priority,
+                                        client=client):
+                if event.get("done"):
+                    record_request_metrics(langpair, True, segments, event)
+                else:
+                    segments += 1
+                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+        except Exception as ex:
+            record_request_metrics(langpair, False)
+            yield f"data: {json.dumps({'done': True, 'error': str(ex)}, ensure_ascii=False)}\n\n"
+        finally:
+            reservation.release()
+
+    response = flask.Response(flask.stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Cache-Control', 'no-cache')
+    return response
+
+@api.route('/translate/batch', methods=['POST'])
+def post_batch_translation():
+    """
+    Translates a JSON array of documents, each {"text", "langpair"} plus optional
+    `merge_en_chunks`, `translate_by_sentence`, `replace_doi_terms`, `max_length` and `quality`.
+    Bulk traffic unless the request has `X-Priority: interactive`.
+    """
+    try:
+        documents = read_documents()
+        priority, client = get_request_flow(PRIORITY_BULK)
+    except ValueError as ex:
+        return flask.jsonify({'error': str(ex)}), 400
+
+    results = translate_documents(documents, priority=priority, client=client)
+    rejected = [result for result in results if "retry_after" in result]
+    if len(rejected) == len(results):
+        # none fitted, the whole batch is to be retried
+        return too_many_requests(MemoryBudgetExceeded(rejected[0]["error"], max(r["retry_after"] for r in rejected)))
+    return flask.jsonify({'translations': results})
+
+@api.route('/jobs', methods=['POST'])
+def post_job():
+    """
+    Same body as /translate/batch, but returns at once with a job id to poll.
+    """
+    try:
+        documents = read_documents()
+    except ValueError as ex:
+        return flask.jsonify({'error': str(ex)}), 400
+
+    job = job_runner.submit(documents)
+    return flask.jsonify(job_status(job)), 202
+
+@api.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id: str):
+    job = job_runner.store.load(job_id)
+    if job is None:
+        return flask.jsonify({'error': f'No job {job_id}'}), 404
+    return flask.jsonify(job_status(job))
+
+@api.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id: str):
+    job = job_runner.store.load(job_id)
+    if job is None:
+        return flask.jsonify({'error': f'No job {job_id}'}), 404
+    if job['status'] != JOB_DONE:
+        return flask.jsonify(job_status(job)), 409
+    return flask.jsonify({'id': job_id, 'translations': job['results']})
+
+@api.route('/stats', methods=['GET'])
+def get_stats():
+    stats = {
+        'schedulers': {key: scheduler.stats() for key, scheduler in SCHEDULERS.items()},
+        'translation_memory': translation_memory.stats(),
+        'models': MODEL_REGISTRY.stats(),
+        'single_flight': translate_flights.stats(),
+        'memory': memory_governor.stats(),
+        'routing': ROUTING_GRAPH.stats(),
+    }
+    return flask.jsonify(stats)
+
+@api.route('/healthz', methods=['GET'])
+def get_health():
+    # liveness: the process serves requests, even while models are loading
+    return flask.jsonify({'status': 'ok'})
+
+@api.route('/readyz', methods=['GET'])
+def get_ready():
+    # readiness: models of the start are loaded and warm, 503 until then
+    ready, models = get_readiness()
+    response = {'ready': ready, 'models': models}
+    if startup_error is not None:
+        response['error'] = str(startup_error)
+    return flask.jsonify(response), 200 if ready else 503
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus metrics of this serving process
+    """
+    collect_service_metrics()
+    return flask.Response(METRICS.render(), content_type=METRICS_CONTENT_TYPE)
+
+def is_admin_request():
+    if ADMIN_TOKEN is None:
+        return request.remote_addr in LOCAL_ADDRESSES
+    return hmac.compare_digest(request.headers.get(ADMIN_TOKEN_HEADER, ""), ADMIN_TOKEN)
+
+@api.route('/admin/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    """
+    Drops translation memory entries of one model key (`model` argument, e.g. `zh-en` or `en2vi`)
+    or of all models, to be called after models in config.json changed.
+    Requires the admin token, see `ADMIN_TOKEN`.
+    """
+    if not is_admin_request():
+        return flask.jsonify({'error': 'Forbidden'}), 403
+    model_key = request.args.get("model")
+    dropped = translation_memory.invalidate(model_key)
+    # the tokenizers may have changed with the models
+    count_tokens_cached.cache_clear()
+    return flask.jsonify({'invalidated': model_key or 'all', 'entries': dropped})
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="NMT service")
+    parser.add_argument("--memory-budget-gb", type=float, default=None,
+                        help="RAM budget of loaded models, least recently used models are unloaded beyond it")
+    parser.add_argument("--gpu-memory-budget-gb", type=float, default=None,
+                        help="VRAM budget of loaded models")
+    parser.add_argument("--max-memory-gb", type=float, default=None,
+                        help="RAM of the serving process beyond which requests wait, then get a 429")
+    parser.add_argument("--max-gpu-memory-gb", type=float, default=None,
+                        help="GPU memory of the serving process beyond which requests wait, then get a 429")
+    parser.add_argument("--admission-wait-seconds", type=float, default=10,
+                        help="how long a request waits for memory before it's rejected")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5006)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of serving processes, more than 1 forks workers sharing the models loaded beforehand")
+    parser.add_argument("--torch-threads", type=int, default=0,
+                        help="torch intra-op threads per worker, 0 keeps torch's default")
+    parser.add_argument("--preload", choices=["pinned", "all"], default="pinned",
+                        help="models loaded at start; with several workers, models loaded later are not shared")
+    parser.add_argument("--server", choices=["waitress", "asyncio"], default="waitress",
+                        help="asyncio serves /translate and /translate/stream with aiohttp, "
+                             "cancelling requests whose client disconnects or deadline passes")
+    parser.add_argument("--request-timeout", type=float, default=120,
+                        help="deadline of a request in seconds with the asyncio server")
+    parser.add_argument("--trusted-clients", default="",
+                        help="comma-separated addresses allowed to raise their priority with X-Priority "
+                             "and to name their clients with X-Client-Id, e.g. a reverse proxy")
+    parser.add_argument("--admin-token", default=None,
+                        help="token required in the X-Admin-Token header of /admin routes, "
+                             "without it they only answer requests from localhost")
+    args = parser.parse_args()
+    ADMIN_TOKEN = args.admin_token
+    TRUSTED_CLIENTS.update(address.strip() for address in args.trusted_clients.split(",") if address.strip())
+    if args.server == "asyncio" and args.workers > 1:
+        parser.error("--server asyncio runs a single process, use --workers 1")
+    if args.workers > 1 and torch.cuda.is_available():
+        # models loaded on the GPU before the fork can't be used by the workers
+        parser.error("--workers > 1 shares models loaded on CPU only, a CUDA context doesn't survive a fork; "
+                     "use --workers 1 on a GPU host")
+    if args.memory_budget_gb is not None:
+        MODEL_MEMORY_BUDGET["cpu"] = args.memory_budget_gb * 1e9
+    if args.gpu_memory_budget_gb is not None:
+        MODEL_MEMORY_BUDGET["cuda"] = args.gpu_memory_budget_gb * 1e9
+    if args.max_memory_gb is not None:
+        MEMORY_BUDGET["cpu"] = args.max_memory_gb * 1e9
+    if args.max_gpu_memory_gb is not None:
+        MEMORY_BUDGET["cuda"] = args.max_gpu_memory_gb * 1e9
+    memory_governor.max_wait = args.admission_wait_seconds
+
     init_nemo('config.json')
     init_nmt_multi()
-    serve(api, host="0.0.0.0", port=5006)
+    init_en2vi()
+    preload_keys = list(MODEL_REGISTRY.loaders if args.preload == "all" else MODEL_REGISTRY.pinned)
+
+    if args.workers > 1:
+        # models must be loaded before the fork to be shared, they're warmed up by each worker
+        start_models(preload_keys, warmup=False)
+        # models loaded above are shared copy-on-write by the forked workers
+        server = PreforkServer(api, host=args.host, port=args.port, num_workers=args.workers,
+                               on_worker_start=lambda worker_id, restarted: init_worker(worker_id, restarted, args.torch_threads),
+                               is_healthy=schedulers_healthy)
+        server.run()
+    else:
+        if args.torch_threads > 0:
+            torch.set_num_threads(args.torch_threads)
+        init_translation_memory()
+        if args.server != "asyncio":
+            # the asyncio front end doesn't serve /jobs, its jobs are left to a waitress server
+            init_jobs()
+        # /healthz answers while models load and warm up, /readyz once they're done
+        threading.Thread(target=start_models, args=(preload_keys,), name="start-models", daemon=True).start()
+        if args.server == "asyncio":
+            # aiohttp is only needed by this server
+            from async_service import run_async_app
+            run_async_app(sys.modules[__name__], args.host, args.port, request_timeout=args.request_timeout)
+        else:
+            serve(api, host=args.host, port=args.port)
@@ -0,0 +1,115 @@
+import queue
+import threading
+from typing import Callable, Iterable, List
+
+# number of english segments waiting for the second stage before the first one blocks
+PIVOT_QUEUE_SIZE = 64
+
+_END_OF_STAGE = object()
+
+
+class EnglishChunkMerger:
+    """
+    Merges translated english chunks back into sentences, chunk by chunk,
+    a sentence is complete once a chunk ends with a period.
+    """
+    def __init__(self):
+        self.cur_paragraph = ""
+        self.last_ext_character = ""
+
+    def push(self, p: str, ext: str):
+        """
+        Returns the list of (sentence, ext_character) completed by this chunk.
+        """
+        completed = []
+        if p.strip() != "" and (self.last_ext_character.strip() == "," or self.last_ext_character.startswith("\"")):
+            p = p[0].lower() + p[1:]
+        if ext.strip() == ".":
+            self.cur_paragraph += (p.strip() + ext.strip())
+            # make empty list of ext_characters to have the same structure
+            # as not merging english chunks
+            completed.append((self.cur_paragraph, ' '))
+            self.cur_paragraph = ""
+        else:
+            self.cur_paragraph += (p.strip() + ext)
+
+        self.last_ext_character = ext
+        return completed
+
+    def flush(self):
+        # check very last chunk
+        if self.cur_paragraph.strip() != "":
+            # make empty list of ext_characters to have the same structure
+            # as not merging english chunks
+            return [(self.cur_paragraph.strip(), '')]
+        return []
+
+
+def _run_first_stage(translations: Iterable[str], ext_characters: List[str],
+                     out_queue: queue.Queue, cancelled: threading.Event):
+    try:
+        for translated, ext in zip(translations, ext_characters):
+            if cancelled.is_set():
+                return
+            out_queue.put((translated, ext))
+        out_queue.put(_END_OF_STAGE)
+    except Exception as ex:
+        out_queue.put(ex)
+
+def iter_pivot_pipeline(first_stage: Iterable[str], ext_characters: List[str],
+                        second_stage_fn: Callable[[List[str]], List[str]],
+                        merge_chunks: bool = False,
+                        queue_size: int = PIVOT_QUEUE_SIZE):
+    """
+    Translates segments through two models, e.g. src->en then en->vi, with both stages running at once.
+    `first_stage` yields the translations of the first model in document order, it's consumed on a worker
+    thread which feeds a bounded queue: it should submit all segments to the model at once, so that they're
+    batched together, and yield each translation as soon as it's ready. The second stage translates whatever
+    is waiting in the queue as soon as it's complete (a merged sentence when `merge_chunks` is set).
+    Yields (translation, ext_character) in document order.
+    """
+    in_queue = queue.Queue(maxsize=queue_size)
+    cancelled = threading.Event()
+    worker = threading.Thread(target=_run_first_stage,
+                              args=(first_stage, ext_characters, in_queue, cancelled),
+                              daemon=True)
+    worker.start()
+
+    merger = EnglishChunkMerger() if merge_chunks else None
+    try:
+        finished = False
+        while not finished:
+            # wait for one translated segment, then take all the others already waiting
+            items = [in_queue.get()]
+            while len(items) < queue_size:
+                try:
+                    items.append(in_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            pending = []
+            for item in items:
+                if item is _END_OF_STAGE:
+                    finished = True
+                    if merger is not None:
+                        pending.extend(merger.flush())
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if merger is not None:
+                    pending.extend(merger.push(*item))
+                else:
+                    pending.append(item)
+
+            if len(pending) > 0:
+                translations = second_stage_fn([p for p, _ in pending])
+                for translated, (_, ext) in zip(translations, pending):
+                    yield translated, ext
+    finally:
+        # stop the first stage if the consumer gave up
+        cancelled.set()
+        while worker.is_alive():
+            try:
+                in_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
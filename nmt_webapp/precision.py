@@ -0,0 +1,39 @@
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# per-model `precision` setting in config.json
+PRECISIONS = ["fp32", "bf16", "int8-dynamic"]
+
+
+def get_torch_modules(model):
+    """
+    Returns the torch modules of a model, wrappers like `My_NMT_T2TT` are searched one level deep.
+    """
+    if isinstance(model, torch.nn.Module):
+        return [model]
+    return [v for v in vars(model).values() if isinstance(v, torch.nn.Module)]
+
+def apply_precision(model, precision: str = "fp32"):
+    """
+    Converts a loaded model in place to a reduced precision for inference:
+    - "bf16": weights and activations in bfloat16
+    - "int8-dynamic": weights of Linear layers quantized to int8, activations quantized
+      on the fly (CPU only, the model is left in fp32 on GPU)
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+    if precision == "fp32":
+        return model
+
+    for module in get_torch_modules(model):
+        if precision == "bf16":
+            module.to(torch.bfloat16)
+        elif next(module.parameters()).device.type != "cpu":
+            logger.warning(f"int8 dynamic quantization runs on CPU only, keeping {type(module).__name__} in fp32")
+        else:
+            torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    logger.info(f"Converted {type(model).__name__} to {precision}")
+    return model
@@ -0,0 +1,201 @@
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from multiprocessing.sharedctypes import RawArray
+from typing import Callable
+
+from waitress.server import create_server
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 5
+# a worker without heartbeat for this long is considered hung and restarted
+HEARTBEAT_TIMEOUT = 60
+# time given to a worker to finish its in-flight requests before it's killed
+GRACEFUL_TIMEOUT = 30
+# a worker failing within this many seconds of its start crashed at start, e.g. a model failed to load:
+# it's restarted after an exponential backoff, up to MAX_BACKOFF seconds, and given up after MAX_START_CRASHES in a row
+MIN_UPTIME = 30
+MAX_BACKOFF = 60
+MAX_START_CRASHES = 5
+
+
+class PreforkServer:
+    """
+    Serves a WSGI app from `num_workers` forked processes sharing one listening socket.
+    Everything loaded in the parent before `run()`, e.g. model weights, is shared copy-on-write
+    by the workers. That's for CPU memory only: a CUDA context doesn't survive a fork, so the parent
+    must not initialize CUDA. `on_worker_start(worker_id, restarted)` runs in each worker after the fork:
+    that's where threads, files and database connections must be created.
+    The parent restarts workers that exit or stop sending heartbeats, with a backoff for workers crashing
+    at start, SIGHUP restarts the workers one by one and SIGTERM/SIGINT stops them gracefully.
+    A worker sends heartbeats while `is_healthy()` returns True, e.g. while no model call is stuck:
+    without it only the death of a worker's process is detected.
+    """
+    def __init__(self, app, host: str, port: int, num_workers: int,
+                 on_worker_start: Callable[[int, bool], None] = None,
+                 waitress_threads: int = 4,
+                 is_healthy: Callable[[], bool] = None):
+        self.app = app
+        self.num_workers = num_workers
+        self.on_worker_start = on_worker_start
+        self.waitress_threads = waitress_threads
+        self.is_healthy = is_healthy
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(1024)
+        self.sock.set_inheritable(True)
+
+        # last heartbeat of each worker slot, shared with the forked workers
+        self.heartbeats = RawArray('d', num_workers)
+        self.workers = {}
+        # start time of each worker slot, its crashes at start in a row and when it's due to restart
+        self.start_times = {}
+        self.start_crashes = [0] * num_workers
+        self.restart_times = {}
+        self.stopping = False
+        self.restart_requested = False
+
+    # ---------------------------- parent ------------------------------------------------
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_restart)
+
+        for worker_id in range(self.num_workers):
+            self._spawn(worker_id, restarted=False)
+
+        while not self.stopping:
+            self._reap()
+            self._restart_due()
+            if not self.workers and not self.restart_times:
+                logger.error("All workers crashed at start, stopping")
+                break
+            self._check_heartbeats()
+            if self.restart_requested:
+                self.restart_requested = False
+                self._rolling_restart()
+            time.sleep(1)
+
+        logger.info("Stopping workers")
+        for pid in list(self.workers):
+            self._stop_worker(pid)
+
+    def _spawn(self, worker_id: int, restarted: bool):
+        self.heartbeats[worker_id] = time.time()
+        self.start_times[worker_id] = time.time()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self._run_worker(worker_id, restarted)
+            except BaseException:
+                logger.exception(f"Worker {worker_id} failed")
+                status = 1
+            finally:
+                logging.shutdown()
+                os._exit(status)
+        self.workers[pid] = worker_id
+        logger.info(f"Started worker {worker_id} (pid {pid})")
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker_id = self.workers.pop(pid, None)
+            if worker_id is None or self.stopping:
+                continue
+            # exit code, or minus the signal which killed it
+            status = os.waitstatus_to_exitcode(status)
+            if time.time() - self.start_times[worker_id] < MIN_UPTIME:
+                self.start_crashes[worker_id] += 1
+            else:
+                self.start_crashes[worker_id] = 0
+            crashes = self.start_crashes[worker_id]
+            if crashes >= MAX_START_CRASHES:
+                logger.error(f"Worker {worker_id} (pid {pid}) exited with status {status}, "
+                             f"{crashes} times in a row at start, giving it up")
+                continue
+            backoff = min(2 ** crashes - 1, MAX_BACKOFF)
+            logger.warning(f"Worker {worker_id} (pid {pid}) exited with status {status}, restarting it in {backoff}s")
+            self.restart_times[worker_id] = time.time() + backoff
+
+    def _restart_due(self):
+        for worker_id, restart_time in list(self.restart_times.items()):
+            if time.time() >= restart_time:
+                del self.restart_times[worker_id]
+                self._spawn(worker_id, restarted=True)
+
+    def _check_heartbeats(self):
+        now = time.time()
+        for pid, worker_id in list(self.workers.items()):
+            if now - self.heartbeats[worker_id] > HEARTBEAT_TIMEOUT:
+                logger.warning(f"Worker {worker_id} (pid {pid}) missed its heartbeats, killing it")
+                os.kill(pid, signal.SIGKILL)
+
+    def _stop_worker(self, pid: int):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        deadline = time.time() + GRACEFUL_TIMEOUT + 5
+        while time.time() < deadline:
+            if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                break
+            time.sleep(0.2)
+        else:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.workers.pop(pid, None)
+
+    def _rolling_restart(self):
+        # one worker at a time, so the others keep serving
+        for pid, worker_id in list(self.workers.items()):
+            logger.info(f"Restarting worker {worker_id} (pid {pid})")
+            self._stop_worker(pid)
+            self._spawn(worker_id, restarted=True)
+
+    def _handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def _handle_restart(self, signum, frame):
+        self.restart_requested = True
+
+    # ---------------------------- worker ------------------------------------------------
+    def _run_worker(self, worker_id: int, restarted: bool):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_DFL)
+
+        def send_heartbeats():
+            while True:
+                # a worker whose model calls are stuck stops beating and gets restarted
+                if self.is_healthy is None or self.is_healthy():
+                    self.heartbeats[worker_id] = time.time()
+                time.sleep(HEARTBEAT_INTERVAL)
+
+        threading.Thread(target=send_heartbeats, daemon=True).start()
+
+        if self.on_worker_start is not None:
+            self.on_worker_start(worker_id, restarted)
+
+        server = create_server(self.app, sockets=[self.sock], threads=self.waitress_threads)
+
+        def shutdown():
+            # stop accepting connections, let in-flight requests finish, then exit
+            server.close()
+            deadline = time.time() + GRACEFUL_TIMEOUT
+            while server.active_channels and time.time() < deadline:
+                time.sleep(0.2)
+            os._exit(0)
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=shutdown, daemon=True).start())
+        server.run()
@@ -0,0 +1,148 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, List
+
+# cost of a hop in seconds per segment on top of its model's latency: every hop costs quality
+# and pipeline overhead, so that a direct model wins unless it's much slower than a pivot route
+HOP_PENALTY_SECONDS = 0.05
+# latency per segment of a model when no model was measured yet
+DEFAULT_SEGMENT_SECONDS = 0.05
+# weight of the latest batch in the moving average of a model's latency
+LATENCY_SMOOTHING = 0.1
+# a measurement loses half its weight against the prior every LATENCY_HALF_LIFE seconds without a new one,
+# so that a model measured slow once is tried again later instead of never
+LATENCY_HALF_LIFE = 300
+# longest route considered, e.g. km->en->vi is 2 hops
+MAX_HOPS = 3
+
+
+class Route:
+    """
+    Models to translate from a language to another: `hops` is a list of (model key, source lang, target lang)
+    """
+    def __init__(self, hops: List[tuple], cost: float):
+        self.hops = hops
+        self.cost = cost
+
+    def to_dict(self):
+        return {
+            "hops": [{"model": model_key, "langpair": f"{src}-{tgt}"} for model_key, src, tgt in self.hops],
+            "cost": self.cost,
+        }
+
+
+class RoutingGraph:
+    """
+    Graph of languages whose edges are the language pairs of the registered models (NeMo, Seamless, en2vi),
+    several models may translate the same pair.
+    `find_route` picks the cheapest path of at most `max_hops` models by Dijkstra's algorithm over
+    (language, hops) states. The cost of an edge is the latency per segment of its model times the model's
+    `weight` from config.json (above 1 for a model of lower quality), plus the time to drain the segments
+    queued for the model (`queued_fn(model key)`), plus `hop_penalty`. Ties go to fewer hops.
+    The latency of a model is a moving average fed by `record_latency`, seeded by `set_latency` e.g. after
+    warmup. Without new measurements it fades towards the prior, the slowest measured latency
+    (`default_latency` before any measurement), which is also the latency of models never measured.
+    """
+    def __init__(self, hop_penalty: float = HOP_PENALTY_SECONDS, default_latency: float = DEFAULT_SEGMENT_SECONDS,
+                 max_hops: int = MAX_HOPS, half_life: float = LATENCY_HALF_LIFE,
+                 queued_fn: Callable[[str], int] = None):
+        self.hop_penalty = hop_penalty
+        self.default_latency = default_latency
+        self.max_hops = max_hops
+        self.half_life = half_life
+        self.queued_fn = queued_fn
+        self.lock = threading.Lock()
+        # source lang -> [(target lang, model key)]
+        self.edges = {}
+        self.weights = {}
+        # model key -> (seconds per segment, monotonic time of the last measurement)
+        self.latencies = {}
+
+    def add_model(self, model_key: str, langpairs: List[str], weight: float = 1.0):
+        with self.lock:
+            self.weights[model_key] = weight
+            for langpair in langpairs:
+                source_lang, target_lang = langpair.split("-")
+                if (target_lang, model_key) not in self.edges.get(source_lang, []):
+                    self.edges.setdefault(source_lang, []).append((target_lang, model_key))
+
+    def record_latency(self, model_key: str, seconds: float, segments: int):
+        """
+        Updates the latency of a model from a batch of `segments` translated in `seconds`.
+        """
+        per_segment = seconds / max(segments, 1)
+        with self.lock:
+            if model_key in self.latencies:
+                per_segment = (1 - LATENCY_SMOOTHING) * self._latency(model_key) + LATENCY_SMOOTHING * per_segment
+            self.latencies[model_key] = (per_segment, time.monotonic())
+
+    def set_latency(self, model_key: str, seconds: float, segments: int):
+        """
+        Replaces the latency of a model by that of a batch, e.g. the last warmup batch.
+        """
+        with self.lock:
+            self.latencies[model_key] = (seconds / max(segments, 1), time.monotonic())
+
+    def edge_cost(self, model_key: str):
+        with self.lock:
+            return self._edge_cost(model_key)
+
+    def find_route(self, source_lang: str, target_lang: str):
+        """
+        Returns the cheapest `Route`, raises ValueError if no model chain translates the language pair.
+        """
+        with self.lock:
+            costs = {model_key: self._edge_cost(model_key) for model_key in self.weights}
+            seq = itertools.count()
+            # (cost, hops, tie breaker, language, path)
+            heap = [(0.0, 0, next(seq), source_lang, [])]
+            # fewest hops a language was settled with: a state popped later costs more,
+            # it's only worth exploring if it used fewer hops
+            settled = {}
+            while heap:
+                cost, num_hops, _, lang, path = heapq.heappop(heap)
+                if lang == target_lang and path:
+                    return Route(path, cost)
+                if settled.get(lang, self.max_hops + 1) <= num_hops:
+                    continue
+                settled[lang] = num_hops
+                if num_hops == self.max_hops:
+                    continue
+                visited = {source_lang} | {tgt for _, _, tgt in path}
+                for next_lang, model_key in self.edges.get(lang, []):
+                    if next_lang not in visited:
+                        heapq.heappush(heap, (cost + costs[model_key], num_hops + 1, next(seq), next_lang,
+                                              path + [(model_key, lang, next_lang)]))
+        raise ValueError(f"Got the following langpair: {source_lang}-{target_lang} which was not found.")
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            return {
+                "langpairs": sorted(f"{src}-{tgt} ({model_key})" for src, edges in self.edges.items()
+                                    for tgt, model_key in edges),
+                "costs": {model_key: self._edge_cost(model_key) for model_key in self.weights},
+                "latencies": {model_key: {"seconds_per_segment": self._latency(model_key),
+                                          "measured": latency, "age_s": now - measured_time}
+                              for model_key, (latency, measured_time) in self.latencies.items()},
+            }
+
+    def _prior(self):
+        if not self.latencies:
+            return self.default_latency
+        return max(latency for latency, _ in self.latencies.values())
+
+    def _latency(self, model_key: str):
+        prior = self._prior()
+        if model_key not in self.latencies:
+            return prior
+        latency, measured_time = self.latencies[model_key]
+        decay = 0.5 ** ((time.monotonic() - measured_time) / self.half_life)
+        return prior + (latency - prior) * decay
+
+    def _edge_cost(self, model_key: str):
+        latency = self._latency(model_key)
+        queued = self.queued_fn(model_key) if self.queued_fn is not None else 0
+        return latency * self.weights.get(model_key, 1.0) + latency * queued + self.hop_penalty
@@ -0,0 +1,231 @@
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from queue import Empty
+from typing import Callable, List
+
+from batching import MAX_BATCH_TOKENS, is_empty_segment, make_micro_batches
+from fair_queue import FairQueue, PRIORITIES, PRIORITY_INTERACTIVE, PRIORITY_WEIGHTS
+
+logger = logging.getLogger(__name__)
+
+# log the achieved batch sizes every `STATS_LOG_INTERVAL` batches
+STATS_LOG_INTERVAL = 100
+
+
+def _priority_rank(priority: str):
+    return PRIORITIES.index(priority) if priority in PRIORITIES else len(PRIORITIES)
+
+
+class _SegmentRequest:
+    def __init__(self, text: str, source_lang: str, target_lang: str, decoding=None,
+                 priority: str = PRIORITY_INTERACTIVE, client: str = ""):
+        self.text = text
+        self.source_lang = source_lang
+        self.target_lang = target_lang
+        self.decoding = decoding
+        self.future = Future()
+        # fair queuing: segments of a client and language pair make a flow, costing their characters
+        # (the model's tokenizer may not be loaded yet)
+        self.priority = priority
+        self.flow = (client, source_lang, target_lang)
+        self.cost = len(text)
+        self.submit_time = time.monotonic()
+
+
+class BatchScheduler:
+    """
+    Dynamic batching in front of one model.
+    Segments submitted by concurrent requests are queued, a worker thread gathers them
+    until `max_batch_size` segments are waiting or the oldest one waited `max_wait_ms`,
+    then runs them through `translate_fn(batch, source_lang, target_lang, decoding)` in length-sorted
+    micro-batches and hands every translation back to the request waiting for it.
+    `decoding` is a `decoding.DecodingPolicy`, or None for the model's default decoding.
+    `length_fn` measures segments for micro-batching, e.g. the number of tokens of the model's tokenizer.
+    Segments whose future was cancelled before they're batched are dropped, see `cancellation.CancelScope`.
+    Segments are queued by priority class and served by weighted fair queuing (see `fair_queue.FairQueue`),
+    and the micro-batches of a gathered batch yield to more urgent segments arriving meanwhile:
+    the rest of the batch is queued again, so a long bulk document holds the model one micro-batch at a time.
+    The worker is the only thread calling the model.
+    """
+    def __init__(self, name: str,
+                 translate_fn: Callable[[List[str], str, str, object], List[str]],
+                 max_batch_size: int = 32,
+                 max_wait_ms: float = 10,
+                 max_batch_tokens: int = MAX_BATCH_TOKENS,
+                 length_fn: Callable[[str], int] = len,
+                 priority_weights: dict = PRIORITY_WEIGHTS):
+        self.name = name
+        self.translate_fn = translate_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_tokens = max_batch_tokens
+        self.length_fn = length_fn
+
+        self.queue = FairQueue(priority_weights)
+        self.batch_sizes = Counter()
+        self.num_batches = 0
+        self.num_segments = 0
+        self.num_dropped = 0
+        self.num_preempted = 0
+        # monotonic time the running model call started, None while the worker waits for segments
+        self.busy_since = None
+        # translated segments and their seconds in the queue, by priority class
+        self.priority_segments = Counter()
+        self.priority_wait_seconds = Counter()
+        self._stats_lock = threading.Lock()
+
+        self._worker = threading.Thread(target=self._run, name=f"scheduler-{name}", daemon=True)
+        self._worker.start()
+
+    def submit(self, segments: List[str], source_lang: str, target_lang: str, decoding=None,
+               priority: str = PRIORITY_INTERACTIVE, client: str = ""):
+        """
+        Queues `segments` and returns one future per segment, None for empty segments.
+        `priority` is a class of `fair_queue.PRIORITIES`, `client` identifies the sender for fair queuing.
+        """
+        futures = []
+        for text in segments:
+            if is_empty_segment(text):
+                futures.append(None)
+            else:
+                request = _SegmentRequest(text, source_lang, target_lang, decoding, priority, client)
+                self.queue.put(request)
+                futures.append(request.future)
+        return futures
+
+    def translate(self, segments: List[str], source_lang: str, target_lang: str, decoding=None,
+                  priority: str = PRIORITY_INTERACTIVE, client: str = ""):
+        """
+        Blocks until all `segments` are translated, empty segments are translated to "".
+        """
+        futures = self.submit(segments, source_lang, target_lang, decoding, priority, client)
+        return [f.result() if f is not None else "" for f in futures]
+
+    def busy_seconds(self):
+        """
+        Returns how long the running model call has been running, 0 if there's none.
+        """
+        busy_since = self.busy_since
+        return 0 if busy_since is None else time.monotonic() - busy_since
+
+    def stats(self):
+        waiting = self.queue.waiting()
+        with self._stats_lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "batches": self.num_batches,
+                "segments": self.num_segments,
+                "mean_batch_size": self.num_segments / self.num_batches if self.num_batches else 0,
+                "dropped": self.num_dropped,
+                "preempted": self.num_preempted,
+                "priorities": {
+                    priority: {
+                        "waiting": waiting[priority],
+                        "segments": self.priority_segments[priority],
+                        "wait_seconds": self.priority_wait_seconds[priority],
+                        "mean_wait_s": (self.priority_wait_seconds[priority] / self.priority_segments[priority]
+                                        if self.priority_segments[priority] else 0),
+                    }
+                    for priority in waiting
+                },
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            }
+
+    def _gather(self):
+        # block until there's some work, then wait a little for more
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    # take what is already queued without waiting
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            gathered = self._gather()
+            # segments of cancelled requests are dropped, the others can't be cancelled anymore
+            # (preempted segments are already running)
+            batch = [r for r in gathered if r.future.running() or r.future.set_running_or_notify_cancel()]
+            if len(batch) < len(gathered):
+                with self._stats_lock:
+                    self.num_dropped += len(gathered) - len(batch)
+
+            # a model translates a whole batch to one language pair with one decoding policy
+            groups = {}
+            for request in batch:
+                groups.setdefault((request.source_lang, request.target_lang, request.decoding), []).append(request)
+
+            micro_batches = []
+            for (source_lang, target_lang, decoding), requests in groups.items():
+                texts = [r.text for r in requests]
+                try:
+                    batches = make_micro_batches(texts,
+                                                 max_batch_tokens=self.max_batch_tokens,
+                                                 max_batch_size=self.max_batch_size,
+                                                 length_fn=self.length_fn)
+                except Exception as ex:
+                    # e.g. `length_fn` needs the model's tokenizer and the model failed to load
+                    for r in requests:
+                        r.future.set_exception(ex)
+                    continue
+                micro_batches.extend(([requests[i] for i in micro_batch], source_lang, target_lang, decoding)
+                                     for micro_batch in batches)
+
+            # most urgent micro-batches first
+            micro_batches.sort(key=lambda b: min(_priority_rank(r.priority) for r in b[0]))
+            for i, (requests, source_lang, target_lang, decoding) in enumerate(micro_batches):
+                if i > 0 and self._should_yield(micro_batches[i:]):
+                    rest = [r for b in micro_batches[i:] for r in b[0]]
+                    self.queue.requeue(rest)
+                    with self._stats_lock:
+                        self.num_preempted += len(rest)
+                    break
+                self._run_batch(requests, source_lang, target_lang, decoding)
+
+    def _should_yield(self, micro_batches: list):
+        # a more urgent class is due before the rest of the gathered batch
+        next_priority = self.queue.next_priority()
+        if next_priority is None:
+            return False
+        return _priority_rank(next_priority) < min(_priority_rank(r.priority) for b in micro_batches for r in b[0])
+
+    def _run_batch(self, requests: List[_SegmentRequest], source_lang: str, target_lang: str, decoding):
+        start_time = time.monotonic()
+        with self._stats_lock:
+            for r in requests:
+                self.priority_segments[r.priority] += 1
+                self.priority_wait_seconds[r.priority] += start_time - r.submit_time
+        self.busy_since = start_time
+        try:
+            translations = self.translate_fn([r.text for r in requests], source_lang, target_lang, decoding)
+            if len(translations) != len(requests):
+                raise ValueError(f"Expected {len(requests)} translations from the model, got {len(translations)}")
+        except Exception as ex:
+            for r in requests:
+                r.future.set_exception(ex)
+            return
+        finally:
+            self.busy_since = None
+
+        for r, translated in zip(requests, translations):
+            r.future.set_result(translated)
+        self._record_batch(len(requests))
+
+    def _record_batch(self, size: int):
+        with self._stats_lock:
+            self.batch_sizes[size] += 1
+            self.num_batches += 1
+            self.num_segments += size
+            log_stats = self.num_batches % STATS_LOG_INTERVAL == 0
+        if log_stats:
+            logger.info(f"Scheduler {self.name}: {self.stats()}")
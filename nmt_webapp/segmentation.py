@@ -0,0 +1,227 @@
+import re
+from collections import Counter
+from typing import Callable, List
+
+# chunks of a long passage are merged into paragraphs with balanced quotes, whatever the language
+MERGE_OPEN_QUOTES = '“"‘『「'
+MERGE_CLOSE_QUOTES = '”"’』」'
+
+# english punctuation put back between translated segments
+PERIOD_EN = '.'
+COMMA_EN = ','
+QUOTE_EN = '"'
+
+NEWLINES_SPLITTER = re.compile(r'(\n+)')
+
+
+class LanguageProfile:
+    """
+    Punctuation of a source language, with the regexes splitting its text compiled once.
+    """
+    def __init__(self, period_char: str, comma_char: str, open_quotes: str, close_quotes: str):
+        assert len(open_quotes) == len(close_quotes), "number of open and close quote characters must be equal!"
+        self.period_char = period_char
+        self.comma_char = comma_char
+        self.open_quotes = open_quotes
+        self.close_quotes = close_quotes
+        self.quotes_finder = re.compile(f"[{re.escape(open_quotes + close_quotes)}]")
+        # sentence splitters by the quote characters which are balanced in a text
+        self._sentence_splitters = {}
+
+    def sentence_splitter(self, valid_quotes: str):
+        if valid_quotes not in self._sentence_splitters:
+            splitors = re.escape(valid_quotes + self.period_char + self.comma_char)
+            self._sentence_splitters[valid_quotes] = re.compile(f"(\\n+|[{splitors}])")
+        return self._sentence_splitters[valid_quotes]
+
+    def valid_quotes(self, text: str):
+        """
+        Returns the open then the close quote characters of the pairs with as many open as close quotes in `text`.
+        """
+        counts = Counter(self.quotes_finder.findall(text))
+        pairs = [(q_open, q_close) for q_open, q_close in zip(self.open_quotes, self.close_quotes)
+                 if counts[q_open] == counts[q_close]]
+        return "".join(q_open for q_open, _ in pairs) + "".join(q_close for _, q_close in pairs)
+
+
+DEFAULT_PROFILE = LanguageProfile(period_char=".", comma_char=",", open_quotes='"', close_quotes='"')
+
+LANGUAGE_PROFILES = {
+    "zh": LanguageProfile(period_char="。", comma_char="，", open_quotes='“‘『「', close_quotes='”’』」'),
+    "jp": LanguageProfile(period_char="。", comma_char="，", open_quotes='“‘『「', close_quotes='”’』」'),
+    "km": LanguageProfile(period_char="។", comma_char=",", open_quotes='«“', close_quotes='»”'),
+    "lo": LanguageProfile(period_char=".", comma_char=",", open_quotes='“', close_quotes='”'),
+    "th": DEFAULT_PROFILE,
+    "ru": DEFAULT_PROFILE,
+    "fr": DEFAULT_PROFILE,
+    "en": DEFAULT_PROFILE,
+}
+
+def get_language_profile(lang: str):
+    return LANGUAGE_PROFILES.get(lang, DEFAULT_PROFILE)
+
+
+# ---------------------------- split text based on max_length --------------------------------
+def quote_balance(text: str, open_quotes: str, close_quotes: str, quotes_finder: re.Pattern = None):
+    """
+    Returns the number of open minus close quotes in `text`, `quotes_finder` matching any quote
+    character skips the counting in texts without quotes.
+    """
+    if quotes_finder is not None and quotes_finder.search(text) is None:
+        return 0
+    return sum(text.count(ch) for ch in open_quotes) - sum(text.count(ch) for ch in close_quotes)
+
+def merge_para_chunks(chunks: List[str],
+                      max_length: int = 512,
+                      open_quotes: str = MERGE_OPEN_QUOTES,
+                      close_quotes: str = MERGE_CLOSE_QUOTES,
+                      length_fn: Callable[[str], int] = len):
+    """
+    Merges chunks into paragraphs of up to `max_length` characters (or tokens, measured by `length_fn`),
+    a paragraph is only closed when its quotes are balanced. The quote balance of the current paragraph
+    is kept up to date chunk by chunk instead of being recounted over the whole paragraph.
+    Returns the paragraphs and whether each one ends a passage.
+    """
+    paragraphs, new_paragraphs = [], []
+    parts = []
+    acc_length = 0
+    balance = 0
+    quotes_finder = re.compile(f"[{re.escape(open_quotes + close_quotes)}]")
+    for p in chunks:
+        p_length = length_fn(p)
+        p_balance = quote_balance(p, open_quotes, close_quotes, quotes_finder)
+        if acc_length > 0 and acc_length + p_length < max_length:
+            parts.append(p)
+            acc_length += p_length
+            balance += p_balance
+        elif acc_length > 0 and acc_length + p_length == max_length and balance + p_balance == 0:
+            parts.append(p)
+            paragraphs.append("".join(parts))
+            new_paragraphs.append(False)
+            parts, acc_length, balance = [], 0, 0
+        elif acc_length > 0 and (acc_length + p_length == max_length or balance != 0):
+            # the paragraph grows until its quotes are balanced
+            parts.append(p)
+            acc_length += p_length
+            balance += p_balance
+        else:
+            if acc_length > 0:
+                # over `max_length` with balanced quotes
+                paragraphs.append("".join(parts))
+                new_paragraphs.append(False)
+            # the chunk starts a new paragraph, or is one on its own if it's long enough
+            if p_length >= max_length and p_balance == 0:
+                paragraphs.append(p)
+                new_paragraphs.append(False)
+                parts, acc_length, balance = [], 0, 0
+            else:
+                parts, acc_length, balance = [p], p_length, p_balance
+    if acc_length > 0:
+        paragraphs.append("".join(parts))
+        new_paragraphs.append(True)
+    # set new paragraph flag to the last element
+    new_paragraphs[-1] = True
+
+    return paragraphs, new_paragraphs
+
+def split_by_length(text: str, profile: LanguageProfile = DEFAULT_PROFILE, max_length: int = 512,
+                    length_fn: Callable[[str], int] = len):
+    """
+    Splits text into passages at new lines, passages longer than `max_length` are split at periods
+    and merged back into paragraphs of up to `max_length` characters, or tokens when `length_fn`
+    counts the tokens of a model's tokenizer.
+    Returns the paragraphs and the characters to put back after each translated paragraph.
+    """
+    pieces = NEWLINES_SPLITTER.split(text)
+    passages, new_line_characters = pieces[0::2], pieces[1::2]
+
+    paragraphs, new_paragraphs = [], []
+    for p in passages:
+        if length_fn(p) <= max_length:
+            paragraphs.append(p)
+            new_paragraphs.append(True)
+        else:
+            ext_paragraphs, ext_new_paragraphs = merge_para_chunks(p.split(profile.period_char), max_length=max_length,
+                                                                   length_fn=length_fn)
+            paragraphs.extend(ext_paragraphs)
+            new_paragraphs.extend(ext_new_paragraphs)
+    # set new paragraph flag to the last element
+    new_paragraphs[-1] = False
+
+    # match new-line characters for each paragraph
+    ext_characters = []
+    i = 0
+    for new in new_paragraphs:
+        if new:
+            ext_characters.append(new_line_characters[i])
+            i += 1
+        else:
+            ext_characters.append(" ")
+
+    return paragraphs, ext_characters
+
+
+# ---------------------------- split text by sentence ----------------------------------------
+def split_by_sentence(text: str, profile: LanguageProfile = DEFAULT_PROFILE):
+    """
+    Splits text at new lines, periods, commas and balanced quotes in one pass.
+    Returns the segments and the english punctuation to put back after each translated segment.
+    """
+    pieces = profile.sentence_splitter(profile.valid_quotes(text)).split(text)
+    passages, splitors = pieces[0::2], pieces[1::2]
+
+    # convert all punctuations and quotations to english characters
+    ext_characters = []
+    last_idx = len(splitors) - 1
+    for idx, ch in enumerate(splitors):
+        if ch == profile.period_char or ch == profile.comma_char:
+            ext = PERIOD_EN if ch == profile.period_char else COMMA_EN
+            if idx == last_idx or splitors[idx + 1] in profile.close_quotes:
+                ext_characters.append(ext)
+            else:
+                ext_characters.append(ext + " ")
+        elif ch in profile.open_quotes:
+            ext_characters.append(" " + QUOTE_EN)
+        elif ch in profile.close_quotes:
+            ext_characters.append(QUOTE_EN + " ")
+        else:
+            ext_characters.append(ch)
+    ext_characters.append('')
+
+    return passages, ext_characters
+
+def split_text(text: str, lang: str, translate_by_sentence: bool = True, max_length: int = 64,
+               length_fn: Callable[[str], int] = len):
+    """
+    Splits source text into segments and the characters to put back after each translated segment.
+    """
+    profile = get_language_profile(lang)
+    if translate_by_sentence:
+        return split_by_sentence(text, profile)
+    return split_by_length(text, profile, max_length=max_length, length_fn=length_fn)
+
+
+if __name__ == "__main__":
+    # benchmark against the former splitters of utils.py, see test_segmentation.py for the equivalence check
+    import json
+    import time
+    from test_segmentation import legacy_split_text, MODES
+
+    docs = json.load(open("tests/t5_zh_test.json"))
+    # the former splitters rescan the whole paragraph as long as its quotes are unbalanced,
+    # e.g. a stray quote at the start of a long passage without new lines
+    inputs = [("balanced quotes", "\n".join(docs) * repeat) for repeat in [10, 100, 1000]]
+    inputs += [("unbalanced quote", "“" + "".join(docs).replace("\n", "") * repeat) for repeat in [1, 10]]
+    for name, text in inputs:
+        for mode, by_sentence, max_length in MODES:
+            time_s = time.time()
+            legacy_output = legacy_split_text(text, "zh", by_sentence, max_length)
+            legacy_duration = time.time() - time_s
+
+            time_s = time.time()
+            output = split_text(text, "zh", by_sentence, max_length)
+            duration = time.time() - time_s
+
+            assert output == legacy_output
+            print (f"{name}, {len(text) / 1e6:.1f}M chars, {mode}: legacy {legacy_duration * 1000:.1f} ms, "
+                   f"profile {duration * 1000:.1f} ms, speed-up x{legacy_duration / duration:.1f}")
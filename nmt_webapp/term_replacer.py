@@ -0,0 +1,163 @@
+import logging
+import os
+import threading
+import time
+
+from utils_mapping import read_mapping
+
+logger = logging.getLogger(__name__)
+
+# one mapping file per source language, e.g. metadata/mapping_zh_en.csv
+MAPPING_FILE_PATTERN = "metadata/mapping_{lang}_en.csv"
+# the mtime of a mapping file is checked at most this often, not on every replacement
+RELOAD_CHECK_SECONDS = 1.0
+
+
+class TermReplacer:
+    """
+    Replaces domain of interest terms in a single pass over the text.
+    The mapping is compiled once into a character trie and each position takes the
+    longest term starting there (leftmost-longest), so a short term never clobbers
+    a longer one containing it. The mapping file is reloaded when its mtime changes, checked at most
+    every `RELOAD_CHECK_SECONDS`; while it's missing or unreadable the last mapping loaded is kept.
+    """
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.mtime = None
+        self.checked = 0.0
+        self.trie = {}
+        self.first_chars = frozenset()
+        self.lock = threading.Lock()
+        self.reload_if_changed()
+
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if self.mtime is not None and now - self.checked < RELOAD_CHECK_SECONDS:
+            return
+        self.checked = now
+        try:
+            mtime = os.path.getmtime(self.file_path)
+        except OSError as ex:
+            if self.mtime is None:
+                raise
+            logger.warning(f"Keeping the terms mapping loaded from {self.file_path}: {ex}")
+            return
+        if mtime == self.mtime:
+            return
+
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            try:
+                mapping = read_mapping(self.file_path)
+            except OSError as ex:
+                if self.mtime is None:
+                    raise
+                logger.warning(f"Keeping the terms mapping loaded from {self.file_path}: {ex}")
+                return
+            trie = {}
+            for term, replacement in mapping.items():
+                if term == "":
+                    continue
+                node = trie
+                for ch in term:
+                    node = node.setdefault(ch, {})
+                # `None` can't be a character of the text, it marks the end of a term
+                node[None] = replacement
+
+            self.trie = trie
+            self.first_chars = frozenset(trie)
+            self.mtime = mtime
+        logger.info(f"Loaded terms mapping from {self.file_path}")
+
+    def replace(self, text: str):
+        self.reload_if_changed()
+        trie, first_chars = self.trie, self.first_chars
+
+        pieces = []
+        last = 0
+        i = 0
+        n = len(text)
+        while i < n:
+            if text[i] not in first_chars:
+                i += 1
+                continue
+
+            # walk down the trie and remember the longest term ending on the way
+            node = trie
+            match_end, replacement = -1, None
+            j = i
+            while j < n:
+                node = node.get(text[j])
+                if node is None:
+                    break
+                j += 1
+                if None in node:
+                    match_end, replacement = j, node[None]
+
+            if match_end < 0:
+                i += 1
+            else:
+                pieces.append(text[last:i])
+                pieces.append(replacement)
+                i = last = match_end
+
+        if last == 0:
+            return text
+        pieces.append(text[last:])
+        return "".join(pieces)
+
+
+_term_replacers = {}
+_term_replacers_lock = threading.Lock()
+
+def get_term_replacer(lang: str):
+    """
+    Returns the replacer of a source language, None if there's no mapping file for it.
+    """
+    file_path = MAPPING_FILE_PATTERN.format(lang=lang)
+    with _term_replacers_lock:
+        if lang not in _term_replacers:
+            if not os.path.exists(file_path):
+                return None
+            _term_replacers[lang] = TermReplacer(file_path)
+        return _term_replacers[lang]
+
+def replace_terms(text: str, lang: str = "zh"):
+    replacer = get_term_replacer(lang)
+    if replacer is None:
+        return text
+    return replacer.replace(text)
+
+
+if __name__ == "__main__":
+    # micro-benchmark against the former per-request csv parsing and sequential `str.replace`
+    import json
+    import time
+    from utils_mapping import read_mapping_zh_en
+
+    def legacy_replace_doi_terms(text: str):
+        dict_terms = read_mapping_zh_en()
+        for k,v in dict_terms.items():
+            text = text.replace(k,v)
+        return text
+
+    docs = json.load(open("tests/t5_zh_test.json"))
+    replacer = get_term_replacer("zh")
+
+    for repeat in [1, 10, 100]:
+        long_doc = "\n".join(docs) * repeat
+        time_s = time.time()
+        legacy_replace_doi_terms(long_doc)
+        legacy_duration = time.time() - time_s
+
+        time_s = time.time()
+        replacer.replace(long_doc)
+        duration = time.time() - time_s
+
+        print (f"{len(long_doc)} chars: legacy {legacy_duration * 1000:.1f} ms, "
+               f"trie {duration * 1000:.1f} ms, speed-up x{legacy_duration / duration:.1f}")
+
+    # outputs differ where a shorter term used to clobber a longer one, e.g. 海军 inside 海军陆战
+    changed = [d for d in docs if replacer.replace(d) != legacy_replace_doi_terms(d)]
+    print (f"{len(changed)} of {len(docs)} documents changed by leftmost-longest matching")
@@ -0,0 +1,67 @@
+"""
+Smoke tests of the evaluate_corpus.py and translate_corpus.py command lines, with a stand-in for nmt_service
+whose model upper-cases the text: they catch a script out of step with the functions it calls.
+"""
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip("torch")
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# nmt_service as the scripts use it, imported by their worker processes instead of the real one
+STUB_SERVICE = textwrap.dedent('''
+    def init_nemo(config_path):
+        pass
+
+    def init_nmt_multi():
+        pass
+
+    def init_en2vi():
+        pass
+
+    def translate_documents(documents, on_document_done=None, wait_for_memory=False,
+                            priority="bulk", client="", executor=None):
+        translate = lambda document: {"success": True, "translation": document["text"].upper()}
+        return list(executor.map(translate, documents))
+''')
+
+
+def run_script(tmp_path, module, *args):
+    # run as a module from tmp_path, so that the stand-in comes before the modules next to the script
+    (tmp_path / "nmt_service.py").write_text(STUB_SERVICE, encoding="utf-8")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(tmp_path), ROOT_DIR, os.environ.get("PYTHONPATH", "")]))
+    result = subprocess.run([sys.executable, "-m", module, *args], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr
+
+def write_lines(path, lines):
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+
+def test_evaluate_corpus(tmp_path):
+    pytest.importorskip("sacrebleu")
+    # long enough for BLEU's 4-grams
+    lines = [f"this is line {i} of the corpus" for i in range(10)]
+    write_lines(tmp_path / "corpus.en", lines)
+    write_lines(tmp_path / "corpus.ref", [line.upper() for line in lines])
+    run_script(tmp_path, "evaluate_corpus", "corpus.en", "corpus.ref",
+               "--langpair", "en-xx", "--sample", "6", "--batch-size", "4", "--score-workers", "1",
+               "--output", "evaluation.jsonl")
+
+    with open(tmp_path / "evaluation.scores.json", encoding="utf-8") as f:
+        scores = json.load(f)
+    assert scores["lines"] == 6 and scores["errors"] == 0
+    assert scores["bleu"] == pytest.approx(100.0)
+
+def test_translate_corpus(tmp_path):
+    lines = [f"line {i}" for i in range(10)]
+    write_lines(tmp_path / "corpus.en", lines)
+    run_script(tmp_path, "translate_corpus", "corpus.en", "corpus.out",
+               "--langpair", "en-xx", "--chunk-lines", "4")
+
+    assert (tmp_path / "corpus.out").read_text(encoding="utf-8").splitlines() == [line.upper() for line in lines]
@@ -0,0 +1,26 @@
+"""
+Equivalence check of the onnx en2vi backend with the PyTorch one, skipped without optimum
+or an export in models/en2vi-onnx (``python export_onnx_en2vi.py``).
+"""
+import os
+
+import pytest
+
+pytest.importorskip("transformers")
+pytest.importorskip("optimum.onnxruntime")
+
+from export_onnx_en2vi import check_onnx_equivalence, CHECK_TEXTS
+from nmt_en2vi import EN2VI_MODEL_NAME, EN2VI_ONNX_DIR
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+ONNX_DIR = os.path.join(ROOT_DIR, EN2VI_ONNX_DIR)
+
+
+@pytest.mark.skipif(not os.path.isdir(ONNX_DIR), reason=f"no onnx export in {EN2VI_ONNX_DIR}")
+def test_onnx_matches_torch():
+    try:
+        differences = check_onnx_equivalence(EN2VI_MODEL_NAME, ONNX_DIR, CHECK_TEXTS)
+    except OSError as ex:
+        # transformers raises OSError when the weights can't be found or downloaded
+        pytest.skip(f"en2vi model not available: {ex}")
+    assert differences == 0
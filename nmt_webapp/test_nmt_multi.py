@@ -0,0 +1,29 @@
+"""
+Equivalence check of the batched SeamlessM4T translation, skipped without seamless_communication or its weights.
+"""
+import pytest
+
+pytest.importorskip("seamless_communication")
+
+from nmt_multi import My_NMT_T2TT
+
+KM_TEXTS = ["យ៉ាង ណា ក៏ ដោយ បូតុលូសស៊ី ស៊ុត ចូល លើក ទី ៤ នៃ ការ ទាត់ បាល់ ពិន័យ នៃ ប្រកួត នេះ ហើយ បន្ទាប់ មក ម័ររូ ប៊ីហ្គាម៉ាស្កូ និង អេនត្រា ម៉ាស៊ី បាន ស៊ុត ចូល នាំ អោយ អ៊ីតាលី ឈ្នះ ។",
+            "អ៊ីតាលី ឈ្នះ ។",
+            "បន្ទាប់ មក ម័ររូ ប៊ីហ្គាម៉ាស្កូ និង អេនត្រា ម៉ាស៊ី បាន ស៊ុត ចូល ។"]
+
+
+def translate_one_by_one(m4t_model: My_NMT_T2TT, km_texts: list):
+    # one predict call per input, as before batching
+    return [m4t_model.translator.predict(text, task_str="t2tt", tgt_lang="eng", src_lang="khm")[0][0].__str__()
+            for text in km_texts]
+
+@pytest.fixture(scope="module")
+def m4t_model():
+    try:
+        return My_NMT_T2TT()
+    except Exception as ex:
+        pytest.skip(f"seamless model not available: {ex}")
+
+def test_batched_translation(m4t_model):
+    batched = m4t_model.translate(KM_TEXTS, source_lang="km", target_lang="en")
+    assert batched == translate_one_by_one(m4t_model, KM_TEXTS)
@@ -0,0 +1,55 @@
+import time
+
+from routing import RoutingGraph
+
+
+def test_route_through_expensive_hop_within_max_hops():
+    # x->y->z is cheaper up to z but can't reach w within 2 hops, x->z->w must still be found
+    graph = RoutingGraph(max_hops=2)
+    graph.add_model("A", ["x-y"])
+    graph.add_model("B", ["y-z"])
+    graph.add_model("C", ["x-z"], weight=100)
+    graph.add_model("D", ["z-w"])
+    route = graph.find_route("x", "w")
+    assert [model_key for model_key, _, _ in route.hops] == ["C", "D"]
+
+def test_direct_model_preferred_over_pivot():
+    graph = RoutingGraph()
+    graph.add_model("km-en", ["km-en"])
+    graph.add_model("en-vi", ["en-vi"])
+    graph.add_model("km-vi", ["km-vi"])
+    assert [model_key for model_key, _, _ in graph.find_route("km", "vi").hops] == ["km-vi"]
+
+def test_no_route():
+    graph = RoutingGraph()
+    graph.add_model("A", ["x-y"])
+    try:
+        graph.find_route("y", "x")
+    except ValueError:
+        return
+    assert False, "expected ValueError"
+
+def test_measurements_fade_towards_prior():
+    graph = RoutingGraph(hop_penalty=0.0, half_life=0.05)
+    graph.add_model("fast", ["x-y"])
+    graph.add_model("slow", ["x-y"])
+    graph.set_latency("fast", 0.1, 10)
+    graph.set_latency("slow", 10.0, 10)
+    assert graph.edge_cost("fast") < graph.edge_cost("slow") == 1.0
+    # without new measurements the slow model, measured once, gets tried again
+    time.sleep(0.5)
+    assert abs(graph.edge_cost("fast") - graph.edge_cost("slow")) < 0.01
+
+def test_unmeasured_model_costs_slowest_measured():
+    graph = RoutingGraph(hop_penalty=0.0)
+    graph.add_model("measured", ["x-y"])
+    graph.add_model("new", ["x-y"])
+    graph.set_latency("measured", 2.0, 10)
+    assert graph.edge_cost("new") == graph.edge_cost("measured") == 0.2
+
+def test_queued_segments_add_to_cost():
+    queued = {"busy": 100, "idle": 0}
+    graph = RoutingGraph(queued_fn=queued.get)
+    graph.add_model("busy", ["x-y"])
+    graph.add_model("idle", ["x-y"], weight=2)
+    assert [model_key for model_key, _, _ in graph.find_route("x", "y").hops] == ["idle"]
@@ -0,0 +1,36 @@
+import random
+
+from segmentation import split_text, get_language_profile, LANGUAGE_PROFILES
+from utils import split_long_text, split_long_text_by_sentence_and_quotation
+
+MODES = [("sentence", True, 64), ("chunk64", False, 64), ("chunk512", False, 512)]
+
+
+def legacy_split_text(text: str, lang: str, translate_by_sentence: bool, max_length: int):
+    # the former splitters of utils.py
+    profile = get_language_profile(lang)
+    if translate_by_sentence:
+        return split_long_text_by_sentence_and_quotation(text, period_char=profile.period_char,
+                                                         comma_char=profile.comma_char,
+                                                         open_quotes=profile.open_quotes,
+                                                         close_quotes=profile.close_quotes)
+    return split_long_text(text, max_length=max_length, period_char=profile.period_char)
+
+def outcome(split_fn, *args):
+    # a passage made of periods only fails in both, compare the errors too
+    try:
+        return split_fn(*args)
+    except Exception as ex:
+        return type(ex)
+
+def test_split_text_matches_legacy():
+    # random texts full of punctuation, quotes and new lines, in every language profile
+    rng = random.Random(0)
+    alphabet = "ab 。，.,។“”‘’『』「」«»\"\n"
+    for _ in range(20000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 120)))
+        lang = rng.choice(list(LANGUAGE_PROFILES) + ["xx"])
+        for _, by_sentence, max_length in MODES:
+            max_length = rng.choice([1, 2, 5, 16, max_length])
+            args = (text, lang, by_sentence, max_length)
+            assert outcome(split_text, *args) == outcome(legacy_split_text, *args), args
@@ -1,10 +1,29 @@
+"""
+Regression checks on tests/t5_zh_test.json, under pytest:
+
+    python -m pytest test_translation.py
+
+They are skipped when NeMo isn't installed or the models can't be loaded.
+Run as a script, it also writes the zh->vi translations of the test documents to tests/.
+"""
 import json
-from nmt_service import translate
+import os
+
+import pytest
+
+pytest.importorskip("nemo.collections.nlp")
+
+import nmt_service
+from nmt_service import translate, init_nemo, init_en2vi, PRIORITY_BULK, EN2VI_MODEL_KEY
+from batching import translate_segments
+from segmentation import split_by_sentence, get_language_profile
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # init params
-merge_en_chunks = True, 
+merge_en_chunks = True,
 replace_doi_terms = True,
-translate_by_sentence = True, 
+translate_by_sentence = True,
 max_length = 64
 
 merge_en = ""
@@ -25,17 +44,70 @@ if translate_by_sentence:
 else:
     by_sentence = f"_BYchunk{max_length}"
 
-outfile_name = f"tests/t5_zh_output{merge_en}{doi_term}{by_sentence}.json"
+outfile_name = os.path.join(ROOT_DIR, f"tests/t5_zh_output{merge_en}{doi_term}{by_sentence}.json")
+
+def load_test_data():
+    with open(os.path.join(ROOT_DIR, "tests/t5_zh_test.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+def init_models(langpair: str = "zh-en"):
+    """
+    Registers the models of config.json and loads those of `langpair` and en2vi, once per process.
+    """
+    if langpair not in nmt_service.MODEL_REGISTRY.loaders:
+        init_nemo(os.path.join(ROOT_DIR, "config.json"))
+        init_en2vi()
+    nmt_service.MODEL_REGISTRY.get(langpair)
+    nmt_service.MODEL_REGISTRY.get(EN2VI_MODEL_KEY)
+
+@pytest.fixture(scope="module")
+def models():
+    try:
+        init_models()
+    except Exception as ex:
+        pytest.skip(f"models not available: {ex}")
+
+def check_batched_translation(docs, langpair: str = "zh-en"):
+    """
+    Regression check: translating all segments of a document in length-sorted micro-batches
+    must give the same output as translating one segment at a time.
+    """
+    src_lang, dest_lang = langpair.split('-')
+    mt_model = nmt_service.MODEL_REGISTRY.get(langpair)
+    mt_translate = lambda batch: mt_model.translate(batch, source_lang=src_lang, target_lang=dest_lang)
+    # the registry's en2vi model, not a second copy
+    en2vi_model = nmt_service.MODEL_REGISTRY.get(EN2VI_MODEL_KEY)
+    translate_en2vi = lambda batch: en2vi_model.translate(batch)
+
+    for doc_idx, doc in enumerate(docs):
+        paragraphs, _ = split_by_sentence(doc, get_language_profile(src_lang))
+
+        batched = translate_segments(paragraphs, mt_translate)
+        single = translate_segments(paragraphs, mt_translate, max_batch_size=1)
+        assert batched == single, f"document {doc_idx}: batched src->en translation differs from single translation"
+
+        batched_vi = translate_segments(single, translate_en2vi)
+        single_vi = translate_segments(single, translate_en2vi, max_batch_size=1)
+        assert batched_vi == single_vi, f"document {doc_idx}: batched en->vi translation differs from single translation"
+
+    print (f"Batched translation matches single translation on {len(docs)} documents.")
+
+def test_batched_translation(models):
+    check_batched_translation(load_test_data())
+
+
+if __name__ == "__main__":
+    data = load_test_data()
+    init_models()
+    # compare batched translation with segment-by-segment translation before writing outputs
+    check_batched_translation(data)
+
+    outfile = open(outfile_name, 'w', encoding='utf-8')
 
-# load test data 
-data = json.load(open('tests/t5_zh_test.json'))
+    for src in data:
 
-outfile = open(outfile_name, 'w', encoding='utf-8')
+        _, translated_text = translate(src, langpair="zh-vi", priority=PRIORITY_BULK)
 
-for src in data:
-    
-    translated_text = translate(src, langpair="zh-vi")
-    
-    outfile.write(translated_text + "\n\n")
+        outfile.write(translated_text + "\n\n")
 
-outfile.close()
\ No newline at end of file
+    outfile.close()
@@ -0,0 +1,180 @@
+"""
+Translates a line-oriented corpus file, one translation per line, with the pipeline of nmt_service.
+
+    python translate_corpus.py data/train.merged_data.km data/train.merged_data.km.en --langpair km-en
+    python translate_corpus.py corpus.zh corpus.vi --langpair zh-vi --workers 2 --torch-threads 4
+
+The input is read as a stream in chunks of `--chunk-lines` lines, chunks are shared out to `--workers`
+processes which each load the models of config.json and translate all lines of a chunk concurrently,
+so that the model schedulers batch them together: a chunk should be at least a few model batches. Translations are written in input order as chunks
+complete, and a checkpoint next to the output (`<output>.checkpoint`) records how many lines are done:
+running the same command again after a crash resumes where it stopped.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# chunks handed to the workers ahead of the one written next, per worker
+CHUNKS_AHEAD = 2
+
+# translates the lines of a chunk in a worker process, one thread per line: the executor of
+# nmt_service's batch requests runs too few documents at once to fill the model batches
+chunk_executor = None
+
+
+def read_checkpoint(checkpoint_path: str, input_path: str, langpair: str):
+    """
+    Returns the lines done and output bytes written by a previous run, zero if there's no checkpoint.
+    Raises ValueError if the checkpoint belongs to another input or language pair.
+    """
+    if not os.path.exists(checkpoint_path):
+        return {"lines": 0, "bytes": 0}
+    with open(checkpoint_path, encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    if checkpoint["input"] != os.path.abspath(input_path) or checkpoint["langpair"] != langpair:
+        raise ValueError(f"{checkpoint_path} is the checkpoint of {checkpoint['input']} ({checkpoint['langpair']}), "
+                         f"remove it to start over")
+    return checkpoint
+
+def write_checkpoint(checkpoint_path: str, input_path: str, langpair: str, lines: int, num_bytes: int):
+    # write to a temporary file first so a crash never leaves a truncated checkpoint behind
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"input": os.path.abspath(input_path), "langpair": langpair,
+                   "lines": lines, "bytes": num_bytes, "updated": time.time()}, f)
+    os.replace(tmp_path, checkpoint_path)
+
+def iter_chunks(input_path: str, chunk_lines: int, skip_lines: int = 0):
+    """
+    Yields the lines of a file in chunks of `chunk_lines`, without their line breaks, after `skip_lines` lines.
+    """
+    with open(input_path, encoding="utf-8") as f:
+        lines = (line.rstrip("\r\n") for line in itertools.islice(f, skip_lines, None))
+        while True:
+            chunk = list(itertools.islice(lines, chunk_lines))
+            if not chunk:
+                return
+            yield chunk
+
+def init_worker(config_path: str, torch_threads: int, chunk_lines: int):
+    # runs once in each worker process, models are loaded by the first chunk which needs them
+    import torch
+    import nmt_service
+
+    global chunk_executor
+    chunk_executor = ThreadPoolExecutor(max_workers=chunk_lines)
+    if torch_threads > 0:
+        torch.set_num_threads(torch_threads)
+    nmt_service.init_nemo(config_path)
+    nmt_service.init_nmt_multi()
+    nmt_service.init_en2vi()
+
+def translate_chunk(lines: list, langpair: str, options: dict):
+    """
+    Translates the lines of a chunk, None for the lines which failed
+    """
+    import nmt_service
+
+    documents = [dict(options, text=line, langpair=langpair) for line in lines]
+    results = nmt_service.translate_documents(documents, executor=chunk_executor)
+    # one translation per line
+    return [r["translation"].replace("\n", " ") if r["success"] else None for r in results]
+
+def translate_corpus(input_path: str, output_path: str, langpair: str, options: dict,
+                     workers: int = 1, chunk_lines: int = 256, checkpoint_path: str = None,
+                     config_path: str = "config.json", torch_threads: int = 0):
+    """
+    Translates `input_path` line by line into `output_path`, resuming from the checkpoint if any.
+    Returns the number of lines translated by this run and of lines which failed (written as empty lines).
+    """
+    checkpoint_path = checkpoint_path or output_path + ".checkpoint"
+    checkpoint = read_checkpoint(checkpoint_path, input_path, langpair)
+    lines_done = checkpoint["lines"]
+    output_bytes = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+    if lines_done > 0 and output_bytes < checkpoint["bytes"]:
+        # the output was removed or cut, its lines before the checkpoint are missing
+        print (f"{output_path} is shorter than its checkpoint, starting over")
+        lines_done = 0
+    if lines_done > 0:
+        print (f"Resuming after line {lines_done}")
+
+    # output past the checkpoint was written by a run which stopped, those lines are translated again
+    output = open(output_path, "r+b" if lines_done > 0 else "wb")
+    if lines_done > 0:
+        output.truncate(checkpoint["bytes"])
+        output.seek(checkpoint["bytes"])
+
+    lines_run, errors = 0, 0
+    time_s = time.time()
+    # spawned workers don't inherit a CUDA context or locked threads of the parent
+    with output, ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=init_worker, initargs=(config_path, torch_threads, chunk_lines)) as executor:
+        chunks = iter_chunks(input_path, chunk_lines, skip_lines=lines_done)
+        pending = {}
+        submitted, next_index = 0, 0
+        while True:
+            # a bounded number of chunks in flight, the input is never read as a whole
+            while len(pending) < workers * CHUNKS_AHEAD:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending[submitted] = executor.submit(translate_chunk, chunk, langpair, options)
+                submitted += 1
+            if next_index not in pending:
+                break
+
+            # chunks are written in input order, later chunks which are done wait for this one
+            translations = pending.pop(next_index).result()
+            next_index += 1
+            for translated in translations:
+                if translated is None:
+                    errors += 1
+                output.write((translated or "").encode("utf-8") + b"\n")
+            output.flush()
+            os.fsync(output.fileno())
+
+            lines_done += len(translations)
+            lines_run += len(translations)
+            write_checkpoint(checkpoint_path, input_path, langpair, lines_done, output.tell())
+            print (f"{lines_done} lines done, {lines_run / (time.time() - time_s):.1f} lines/s, {errors} errors")
+
+    duration = time.time() - time_s
+    print (f"Translated {lines_run} lines in {duration:.1f}s ({lines_run / max(duration, 1e-9):.1f} lines/s), "
+           f"{errors} errors, output: {output_path}")
+    return lines_run, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Translate a corpus file line by line")
+    parser.add_argument("input", help="text file, one segment per line")
+    parser.add_argument("output", help="translations, one per line in input order")
+    parser.add_argument("--langpair", required=True, help="e.g. km-en or zh-vi")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, each one loads its own models")
+    parser.add_argument("--torch-threads", type=int, default=0, help="torch intra-op threads per worker, 0 keeps torch's default")
+    parser.add_argument("--chunk-lines", type=int, default=256, help="lines per chunk handed to a worker")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file, <output>.checkpoint by default")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--quality", default="", help="decoding policy: fast, balanced or best")
+    parser.add_argument("--by-sentence", action="store_true", help="split lines by sentence and quotation")
+    parser.add_argument("--max-length", type=int, default=512, help="chunk length when not splitting by sentence")
+    parser.add_argument("--merge-en", action="store_true", help="merge english chunks before en->vi")
+    parser.add_argument("--doi-terms", action="store_true", help="replace special terms before translating")
+    args = parser.parse_args()
+
+    options = {
+        "merge_en_chunks": args.merge_en,
+        "replace_doi_terms": args.doi_terms,
+        "translate_by_sentence": args.by_sentence,
+        "max_length": args.max_length,
+        "quality": args.quality,
+    }
+    translate_corpus(args.input, args.output, args.langpair, options,
+                     workers=args.workers,
+                     chunk_lines=args.chunk_lines,
+                     checkpoint_path=args.checkpoint,
+                     config_path=args.config,
+                     torch_threads=args.torch_threads)
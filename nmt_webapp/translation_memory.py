@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# entries put in the translation memory are written to sqlite by a background thread,
+# at most every WRITE_INTERVAL_SECONDS in one transaction
+WRITE_INTERVAL_SECONDS = 1.0
+
+
+def normalize_segment(segment: str):
+    segment = unicodedata.normalize("NFC", segment)
+    return re.sub(r"\s+", " ", segment).strip()
+
+
+class TranslationMemory:
+    """
+    Segment-level translation cache.
+    Entries are keyed by (model key, model version, langpair, decoding settings, normalized segment),
+    see `make_key`. A bounded LRU lives in process memory, an optional sqlite database at `db_path`
+    keeps every entry across restarts and refills the LRU on a memory miss.
+    `lock` only guards the LRU, the database has its own `db_lock`: new entries are queued in `pending`
+    and written in batches by a writer thread, so a miss doesn't wait for a commit.
+    """
+    def __init__(self, max_entries: int = 100000, db_path: str = None,
+                 write_interval: float = WRITE_INTERVAL_SECONDS):
+        self.max_entries = max_entries
+        self.write_interval = write_interval
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        # rows not written to the database yet
+        self.pending = []
+        self.pending_condition = threading.Condition()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = None
+        if db_path is not None:
+            db_dir = os.path.dirname(db_path)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS translations "
+                            "(key TEXT PRIMARY KEY, model_key TEXT, translation TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS translations_model_key ON translations (model_key)")
+            self.db.commit()
+            threading.Thread(target=self._write_pending, name="translation-memory-writer", daemon=True).start()
+            logger.info(f"Translation memory persisted to {db_path}")
+
+    @staticmethod
+    def make_key(model_key: str, model_version: str, langpair: str, decoding: str, segment: str):
+        return (model_key, model_version, langpair, decoding, normalize_segment(segment))
+
+    def get(self, key: tuple):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            if self.db is None:
+                self.misses += 1
+                return None
+
+        with self.db_lock:
+            row = self.db.execute("SELECT translation FROM translations WHERE key = ?",
+                                  (json.dumps(key, ensure_ascii=False),)).fetchone()
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self._remember(key, row[0])
+            self.hits += 1
+            self.disk_hits += 1
+            return row[0]
+
+    def put(self, key: tuple, translation: str):
+        with self.lock:
+            self._remember(key, translation)
+        if self.db is not None:
+            with self.pending_condition:
+                self.pending.append((json.dumps(key, ensure_ascii=False), key[0], translation))
+                self.pending_condition.notify()
+
+    def flush(self):
+        """
+        Writes the pending entries to the database.
+        """
+        if self.db is None:
+            return
+        with self.db_lock:
+            with self.pending_condition:
+                rows, self.pending = self.pending, []
+            if rows:
+                self.db.executemany("INSERT OR REPLACE INTO translations (key, model_key, translation) "
+                                    "VALUES (?, ?, ?)", rows)
+                self.db.commit()
+
+    def invalidate(self, model_key: str = None):
+        """
+        Drops the entries of one model key, or all entries if `model_key` is None.
+        Returns the number of entries dropped from process memory.
+        """
+        with self.lock:
+            if model_key is None:
+                dropped = len(self.entries)
+                self.entries.clear()
+            else:
+                keys = [k for k in self.entries if k[0] == model_key]
+                for k in keys:
+                    del self.entries[k]
+                dropped = len(keys)
+
+        if self.db is not None:
+            # the writer takes pending rows under db_lock, none of them is written after the delete
+            with self.db_lock:
+                with self.pending_condition:
+                    self.pending = [row for row in self.pending if model_key is not None and row[1] != model_key]
+                if model_key is None:
+                    self.db.execute("DELETE FROM translations")
+                else:
+                    self.db.execute("DELETE FROM translations WHERE model_key = ?", (model_key,))
+                self.db.commit()
+
+        logger.info(f"Invalidated translation memory of {model_key or 'all models'}")
+        return dropped
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+                "pending_writes": len(self.pending),
+            }
+
+    def _remember(self, key: tuple, translation: str):
+        self.entries[key] = translation
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _write_pending(self):
+        while True:
+            with self.pending_condition:
+                self.pending_condition.wait_for(lambda: self.pending)
+            # lets a burst of misses accumulate into one transaction
+            time.sleep(self.write_interval)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                logger.exception("Failed to write the translation memory")
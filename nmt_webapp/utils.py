@@ -1,6 +1,9 @@
 import re
 from typing import List
-from utils_mapping import read_mapping_zh_en
+from term_replacer import replace_terms
+
+# the service splits text with `segmentation`, the splitters below are the reference
+# of its equivalence check and benchmark (python segmentation.py)
 
 # ---------------------------- split text based on max_length --------------------------------
 def count_quotation_marks(text: str, quote_characters: str):
@@ -191,24 +194,14 @@ def split_long_text_by_sentence_and_quotation(
     
     ext_characters += ['']
 
-    print (passages, ext_characters)
-    print (len(passages), len(ext_characters))
-
     return passages, ext_characters
 
 def replace_doi_terms(text: str, lang: str="zh"):
     """
-    Fast replace domain of interest terms from chinese to english
+    Fast replace domain of interest terms from given language to english,
+    languages without a mapping file are left untouched
     """
-    if lang == "zh":
-        dict_terms = read_mapping_zh_en()
-
-        for k,v in dict_terms.items():
-            text = text.replace(k,v)
-
-        return text
-    else:
-        return text
+    return replace_terms(text, lang=lang)
 
 def remove_troll_characters(text: str):
     troll_characters = ["\u200b"]
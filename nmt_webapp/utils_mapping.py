@@ -1,13 +1,15 @@
-
-def read_mapping_zh_en():
+def read_mapping(file_path: str):
     dict_map = {}
-    with open("metadata/mapping_zh_en.csv") as f:
+    with open(file_path, encoding="utf-8") as f:
         lines = [line.strip(" \n").split(",") for line in f.readlines() if line.strip() != "" and line.count(",") == 1]
     
     for line in lines:
-        zh_text = line[0]
+        src_text = line[0]
         en_text = line[1]
-        if zh_text not in dict_map:
-            dict_map[zh_text] = en_text
+        if src_text not in dict_map:
+            dict_map[src_text] = en_text
     
-    return dict_map
\ No newline at end of file
+    return dict_map
+
+def read_mapping_zh_en():
+    return read_mapping("metadata/mapping_zh_en.csv")